@@ -1,17 +1,48 @@
+import json
 import math
-import statistics
-from datetime import datetime
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from flask import current_app
 from google.cloud import firestore
 from pytz import timezone
 import os
 import google.generativeai as genai
+import numpy as np
+from geodesy import TrackIndex, filter_track
+from session_telemetry import SessionTelemetry
+from focus_history import load_focus_history, make_entry, record_focus_history
+from llm_cache import create_llm_cache
+from prompt_compaction import compact_series, estimate_tokens
 
 JST = timezone("Asia/Tokyo")
 
 # === Firestore Helper ===
 db = firestore.Client()
 
+# === 並列評価の設定 ===
+# ピン評価のスレッド数（1セッションあたり）
+FOCUS_PIN_WORKERS = int(os.getenv("FOCUS_PIN_WORKERS", "8"))
+# Gemini への同時リクエスト数の上限（プロセス全体。解析ジョブが複数走っても超えない）
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# 1回の Gemini 呼び出しのタイムアウト・同時実行枠の待ち時間（秒）
+GEMINI_TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "30"))
+GEMINI_QUEUE_TIMEOUT_S = float(os.getenv("GEMINI_QUEUE_TIMEOUT_S", "120"))
+_LLM_SEMAPHORE = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+# 応答キャッシュ（同じモデル・同じプロンプトなら Gemini を呼ばない。LLM_CACHE_DISABLED=1 で無効）
+llm_cache = create_llm_cache()
+
+# === AIコメントの生成モード ===
+# structured: 1回の呼び出しで長文コメントと3行要約をJSONで受け取る（不正な応答なら two_call で作り直す）
+# two_call:   長文コメントを生成してから、それを要約する（従来の2回呼び出し）
+# session:    ルートの通過ピンをまとめて1回で評価する（受け取れなかったピンは structured で個別に評価）
+FOCUS_FEEDBACK_MODE = os.getenv("FOCUS_FEEDBACK_MODE", "structured")
+# ピン1つ分のプロンプトの概算トークン数の上限（超える分は計測データを間引く。session モードではピンごとに適用）
+FOCUS_PROMPT_TOKEN_BUDGET = int(os.getenv("FOCUS_PROMPT_TOKEN_BUDGET", "2000"))
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
 # === 通過しなかった時の定義 ===
 NOT_PASSED_STATS = {
     "avg_speed": 0, "mean_gx": 0, "mean_gz": 0,
@@ -21,6 +52,8 @@ NOT_PASSED_STATS = {
     "speed_range": 0, "acceleration_count": 0, "deceleration_count": 0,
     "sharp_turn_count": 0, "data_points": 0
 }
+# ピンからこの距離（m）以内をGPSが通っていれば通過とみなす
+PASS_RADIUS_M = 30.0
 NOT_PASSED_COMMENT = "この重点ポイントは今回の走行で通過しなかったようです。次回、挑戦してみましょう！"
 
 # ==========================================================
@@ -45,6 +78,45 @@ def get_gemini_model(model_name: str = "gemini-2.0-flash"):
         return None
 
 
+def generate_content_limited(model, prompt: str, generation_config=None):
+    """
+    同時実行数の上限とタイムアウト付きで model.generate_content を呼ぶ
+    枠が空くのを GEMINI_QUEUE_TIMEOUT_S 以上待った場合は TimeoutError
+    """
+    if not _LLM_SEMAPHORE.acquire(timeout=GEMINI_QUEUE_TIMEOUT_S):
+        raise TimeoutError("Gemini の同時実行枠が空きませんでした")
+    try:
+        if generation_config:
+            return model.generate_content(
+                prompt, generation_config=generation_config, request_options={"timeout": GEMINI_TIMEOUT_S}
+            )
+        return model.generate_content(prompt, request_options={"timeout": GEMINI_TIMEOUT_S})
+    finally:
+        _LLM_SEMAPHORE.release()
+
+
+def generate_text(model, prompt: str, generation_config=None, validate=None) -> str:
+    """
+    応答本文を返す（キャッシュにあればそれを返し、なければ generate_content_limited で生成して保存）
+    空の応答と、validate を渡した場合にそれを満たさない応答は保存しない
+    """
+    model_name = getattr(model, "model_name", type(model).__name__)
+    if generation_config:
+        # 出力形式の指定が違えば別のキーにする
+        model_name += "|" + json.dumps(generation_config, sort_keys=True)
+    if llm_cache is not None:
+        cached = llm_cache.get(model_name, prompt)
+        if cached is not None:
+            return cached
+
+    response = generate_content_limited(model, prompt, generation_config)
+    # google-generativeai は通常 .text で本文が取れる
+    text = (response.text or "").strip()
+    if text and llm_cache is not None and (validate is None or validate(text)):
+        llm_cache.set(model_name, prompt, text)
+    return text
+
+
 # ==========================================================
 #  フォーカスタイプごとのデータ範囲設定（拡張版）
 # ==========================================================
@@ -107,43 +179,65 @@ def get_focus_rating(stats, focus_type):
 #  詳細統計データの計算
 # ==========================================================
 def calculate_detailed_stats(gx_vals, gz_vals, speeds):
-    """より詳細な統計データを計算"""
+    """
+    より詳細な統計データを計算
+    リストでもNumPy配列（時間範囲のビュー）でもよい。値は Firestore に保存できる float / int で返す。
+    """
+    gx = np.asarray(gx_vals, dtype=np.float64)
+    gz = np.asarray(gz_vals, dtype=np.float64)
+    sp = np.asarray(speeds, dtype=np.float64)
+
+    def mean(v):
+        return float(v.mean()) if len(v) else 0
+
+    def pstdev(v):
+        return float(v.std()) if len(v) > 1 else 0
+
+    def median(v):
+        return float(np.median(v)) if len(v) else 0
+
+    def vmax(v):
+        return float(v.max()) if len(v) else 0
+
+    def vmin(v):
+        return float(v.min()) if len(v) else 0
+
     stats = {
-        "avg_speed": sum(speeds)/len(speeds) if speeds else 0,
-        "mean_gx": sum(gx_vals)/len(gx_vals) if gx_vals else 0,
-        "mean_gz": sum(gz_vals)/len(gz_vals) if gz_vals else 0,
-        "std_gx": statistics.pstdev(gx_vals) if len(gx_vals) > 1 else 0,
-        "std_gz": statistics.pstdev(gz_vals) if len(gz_vals) > 1 else 0,
-        "max_gx": max(gx_vals, default=0),
-        "max_gz": max(gz_vals, default=0),
-        "min_gx": min(gx_vals, default=0),
-        "min_gz": min(gz_vals, default=0),
-        "median_gx": statistics.median(gx_vals) if gx_vals else 0,
-        "median_gz": statistics.median(gz_vals) if gz_vals else 0,
-        "std_speed": statistics.pstdev(speeds) if len(speeds) > 1 else 0,
-        "max_speed": max(speeds, default=0),
-        "min_speed": min(speeds, default=0),
-        "median_speed": statistics.median(speeds) if speeds else 0,
-        "speed_range": (max(speeds, default=0) - min(speeds, default=0)),
-        "data_points": len(gx_vals)
+        "avg_speed": mean(sp),
+        "mean_gx": mean(gx),
+        "mean_gz": mean(gz),
+        "std_gx": pstdev(gx),
+        "std_gz": pstdev(gz),
+        "max_gx": vmax(gx),
+        "max_gz": vmax(gz),
+        "min_gx": vmin(gx),
+        "min_gz": vmin(gz),
+        "median_gx": median(gx),
+        "median_gz": median(gz),
+        "std_speed": pstdev(sp),
+        "max_speed": vmax(sp),
+        "min_speed": vmin(sp),
+        "median_speed": median(sp),
+        "speed_range": vmax(sp) - vmin(sp),
+        "data_points": int(len(gx))
     }
     
     # 急加速・急減速の回数をカウント（閾値: 0.25G以上）
-    stats["acceleration_count"] = sum(1 for gz in gz_vals if gz > 0.25)
-    stats["deceleration_count"] = sum(1 for gz in gz_vals if gz < -0.25)
+    stats["acceleration_count"] = int(np.count_nonzero(gz > 0.25))
+    stats["deceleration_count"] = int(np.count_nonzero(gz < -0.25))
     
     # 急ハンドルの回数をカウント（閾値: 0.25G以上）
-    stats["sharp_turn_count"] = sum(1 for gx in gx_vals if abs(gx) > 0.25)
+    stats["sharp_turn_count"] = int(np.count_nonzero(np.abs(gx) > 0.25))
     
     # 時系列パターン分析（前半・後半の比較）
-    if len(gx_vals) >= 4:
-        mid_point = len(gx_vals) // 2
-        first_half_std_gx = statistics.pstdev(gx_vals[:mid_point]) if mid_point > 1 else 0
-        second_half_std_gx = statistics.pstdev(gx_vals[mid_point:]) if mid_point > 1 else 0
+    if len(gx) >= 4:
+        mid_point = len(gx) // 2
+        first_half_std_gx = pstdev(gx[:mid_point]) if mid_point > 1 else 0
+        second_half_std_gx = pstdev(gx[mid_point:]) if mid_point > 1 else 0
         stats["gx_stability_trend"] = second_half_std_gx - first_half_std_gx
         
-        first_half_std_gz = statistics.pstdev(gz_vals[:mid_point]) if mid_point > 1 else 0
-        second_half_std_gz = statistics.pstdev(gz_vals[mid_point:]) if mid_point > 1 else 0
+        first_half_std_gz = pstdev(gz[:mid_point]) if mid_point > 1 else 0
+        second_half_std_gz = pstdev(gz[mid_point:]) if mid_point > 1 else 0
         stats["gz_stability_trend"] = second_half_std_gz - first_half_std_gz
     else:
         stats["gx_stability_trend"] = 0
@@ -156,38 +250,11 @@ def calculate_detailed_stats(gx_vals, gz_vals, speeds):
 #  複数回の走行データ取得（直近3回分）
 # ==========================================================
 def get_historical_stats(user_id, session_id, pin_id, limit=3):
-    """直近N回分の走行データを取得して比較"""
-    prev_sessions = (
-        db.collection("sessions")
-        .where("user_id", "==", user_id)
-        .where("status", "==", "completed")
-        .order_by("end_time", direction=firestore.Query.DESCENDING)
-        .stream()
-    )
-    
-    historical_data = []
-    for sdoc in prev_sessions:
-        if sdoc.id == session_id:
-            continue  # 今回のセッションを除外
-
-        fb_ref = db.collection("sessions").document(sdoc.id)\
-            .collection("focus_feedbacks").document(pin_id)
-
-        fb_doc = fb_ref.get()
-        if fb_doc.exists:
-            fb_data = fb_doc.to_dict()
-            stats = fb_data.get("stats")
-            # statsがNoneまたはNOT_PASSED_STATS（全て0）の場合は追加しない
-            if stats and any(v != 0 for v in stats.values()):
-                historical_data.append({
-                    "session_id": sdoc.id,
-                    "stats": stats,
-                    "rating": fb_data.get("rating"),
-                    "created_at": fb_data.get("created_at")
-                })
-                if len(historical_data) >= limit:
-                    break
-    return historical_data
+    """
+    直近N回分の走行データを取得して比較
+    focus_history/{user_id}_{pin_id} の1件を読むだけ（focus_feedbacks 保存時に更新している）
+    """
+    return load_focus_history(db, user_id, pin_id, exclude_session_id=session_id, limit=limit)
 
 
 # ==========================================================
@@ -252,15 +319,53 @@ def compare_focus_stats(prev_stats, current_stats):
 # ==========================================================
 #  AIフィードバック生成（Gemini 呼び出し・生データ版）
 # ==========================================================
-def generate_ai_focus_feedback(focus_type_name, current_stats, diff, rating, diff_text, historical_data=None, raw_data=None):
+FOCUS_COMMENT_RULES = """
+    出力条件（厳守）:
+    - 上記の時系列データから運転パターンを分析してください
+    - **具体的な秒数（例：「63-75秒付近」「128-130秒」）は一切言及しない**
+    - **具体的な速度の数値（例：「20km/h」「0km/hから」）は一切言及しない**
+    - 時間表現は「最初は」「途中で」「前半は」「後半は」「全体的に」のような抽象的な表現のみを使う
+    - 速度表現は「ほぼ一定」「少し変動」「停止した場面」のような定性的な表現のみを使う
+    - 例：「最初は安定していましたが、途中で少し揺れが大きくなる箇所がありました」
+    - 例：「速度はほぼ一定で、途中で停止した場面がありました」
+    - 専門用語や数値(Gx, Gzなど)を使わず、わかりやすい言葉で説明する
+    - 「前後の揺れ」→加減速、「左右の揺れ」→ハンドル操作やカーブの滑らかさ として自然に説明する
+    - 優しい口調で3〜5文程度
+    - 良くなった点、安定している点、改善できる点をバランス良く述べる
+    - 時系列データから見える「運転の癖」や「改善のヒント」を具体的に提示する
+    - 過去の走行との比較から「成長の軌跡」や「継続している課題」にも触れる
+    - 最後に前向きな一言と絵文字を添える（例：「この調子です！😊」「着実に上達していますね🚗✨」）
     """
-    Gemini を使って詳細なフィードバック文章を生成する。
-    生のgセンサーデータと速度データをすべて渡して、より詳細な分析を実現。
+
+# 構造化出力（1回の呼び出しでコメントと要約を受け取る）の指示
+STRUCTURED_OUTPUT_RULES = """
+    回答は次の形式のJSONだけを出力してください（説明文やコードブロックは付けない）:
+    {"comment": "上記の出力条件に沿ったコメント",
+     "summary": {"good": "良い点を1行で", "improve": "改善点を1行で", "compare": "前回との比較を1行で"}}
     """
-    model = get_gemini_model()
-    if model is None:
-        return "AIフィードバック用の設定がまだ完了していないため、自動コメントを生成できませんでした。"
 
+SESSION_OUTPUT_RULES = """
+    出力条件は各ポイントのコメントそれぞれに適用してください。
+    回答は次の形式のJSONだけを出力してください（説明文やコードブロックは付けない）。pins には全ポイントを含めること:
+    {"pins": [{"pin_id": "ポイントID",
+               "comment": "上記の出力条件に沿ったコメント",
+               "summary": {"good": "良い点を1行で", "improve": "改善点を1行で", "compare": "前回との比較を1行で"}}]}
+    """
+
+# 要約の各行（summary のキー, 表示ラベル）
+SUMMARY_LINES = (("good", "😊 良い点"), ("improve", "⚠ 改善点"), ("compare", "📈 比較"))
+DEFAULT_SHORT_COMMENT = (
+    "😊 良い点: 全体的に安定した走行でした。\n"
+    "⚠ 改善点: カーブ時の揺れに注意しましょう。\n"
+    "📈 比較: 前回とほぼ同じ傾向です。"
+)
+
+
+def build_focus_data_text(current_stats, rating, diff_text, historical_data=None, raw_data=None):
+    """
+    プロンプトのデータ部分（計測データ・統計サマリー・過去との比較・総合評価）
+    raw_data は compact_series の結果（CompactedSeries）
+    """
     # 過去データとの比較（直近3回分）
     historical_comparison = ""
     if historical_data and len(historical_data) > 0:
@@ -284,23 +389,10 @@ def generate_ai_focus_feedback(focus_type_name, current_stats, diff, rating, dif
                 else:
                     historical_comparison += "（ほぼ同じ）\n"
     
-    # 生データをフォーマット（時系列で表示）
-    raw_data_text = ""
-    if raw_data:
-        raw_data_text = "\n【この地点の全計測データ（時系列）】\n"
-        raw_data_text += "時刻, 左右G(gx), 前後G(gz), 速度(km/h)\n"
-        for i, point in enumerate(raw_data, 1):
-            raw_data_text += f"{i}, {point['gx']:.3f}, {point['gz']:.3f}, {point['speed']:.1f}\n"
-        
-        raw_data_text += "\n※ 左右G(gx): 正=右旋回、負=左旋回\n"
-        raw_data_text += "※ 前後G(gz): 正=加速、負=減速\n"
-    
-    # --- 詳細プロンプト構築（生データを含む＋抽象化指示強化） ---
-    prompt = f"""
-    あなたは運転コーチAI『ドライボ』です。
-    この地点は「{focus_type_name}」を意識するよう設定されていました。
-    以下の**実際の計測データすべて**をもとに、今回の運転の特徴と改善点をコメントしてください。
+    # 計測データ（時系列。トークン予算に合わせて間引き済み）と特徴量
+    raw_data_text = raw_data.text if raw_data is not None else ""
 
+    return f"""
     {raw_data_text}
 
     【統計サマリー】
@@ -316,46 +408,54 @@ def generate_ai_focus_feedback(focus_type_name, current_stats, diff, rating, dif
 
     【今回の総合評価】
     {rating}
+    """
 
-    出力条件（厳守）:
-    - 上記の時系列データから運転パターンを分析してください
-    - **具体的な秒数（例：「63-75秒付近」「128-130秒」）は一切言及しない**
-    - **具体的な速度の数値（例：「20km/h」「0km/hから」）は一切言及しない**
-    - 時間表現は「最初は」「途中で」「前半は」「後半は」「全体的に」のような抽象的な表現のみを使う
-    - 速度表現は「ほぼ一定」「少し変動」「停止した場面」のような定性的な表現のみを使う
-    - 例：「最初は安定していましたが、途中で少し揺れが大きくなる箇所がありました」
-    - 例：「速度はほぼ一定で、途中で停止した場面がありました」
-    - 専門用語や数値(Gx, Gzなど)を使わず、わかりやすい言葉で説明する
-    - 「前後の揺れ」→加減速、「左右の揺れ」→ハンドル操作やカーブの滑らかさ として自然に説明する
-    - 優しい口調で3〜5文程度
-    - 良くなった点、安定している点、改善できる点をバランス良く述べる
-    - 時系列データから見える「運転の癖」や「改善のヒント」を具体的に提示する
-    - 過去の走行との比較から「成長の軌跡」や「継続している課題」にも触れる
-    - 最後に前向きな一言と絵文字を添える（例：「この調子です！😊」「着実に上達していますね🚗✨」）
+
+def build_focus_prompt(focus_type_name, current_stats, rating, diff_text, historical_data=None, raw_data=None):
+    """ピン1つ分のコメント生成プロンプト（出力形式の指示は呼び出し側で付ける）"""
+    return f"""
+    あなたは運転コーチAI『ドライボ』です。
+    この地点は「{focus_type_name}」を意識するよう設定されていました。
+    以下の**実際の計測データ**をもとに、今回の運転の特徴と改善点をコメントしてください。
+    {build_focus_data_text(current_stats, rating, diff_text, historical_data, raw_data)}
+    {FOCUS_COMMENT_RULES}
+    """
+
+
+def append_trend(feedback_text, diff):
+    """前回との比較を考慮してトーンを追加"""
+    if not diff:
+        return feedback_text
+    if diff["std_gx_diff"] < -0.01 or diff["std_gz_diff"] < -0.01:
+        trend = "（前回より安定しています👏）"
+    elif diff["std_gx_diff"] > 0.02 or diff["std_gz_diff"] > 0.02:
+        trend = "（少し揺れが増えているようです💦）"
+    else:
+        trend = "（前回と同じくらい安定しています✨）"
+    return feedback_text + "\n" + trend
+
+
+def generate_ai_focus_feedback(focus_type_name, current_stats, diff, rating, diff_text, historical_data=None, raw_data=None):
+    """
+    Gemini を使って詳細なフィードバック文章を生成する。
+    生のgセンサーデータと速度データをすべて渡して、より詳細な分析を実現。
     """
+    model = get_gemini_model()
+    if model is None:
+        return "AIフィードバック用の設定がまだ完了していないため、自動コメントを生成できませんでした。"
+
+    # --- 詳細プロンプト構築（生データを含む＋抽象化指示強化） ---
+    prompt = build_focus_prompt(focus_type_name, current_stats, rating, diff_text, historical_data, raw_data)
 
     try:
-        response = model.generate_content(prompt)
-        # google-generativeai は通常 .text で本文が取れる
-        feedback_text = (response.text or "").strip()
+        feedback_text = generate_text(model, prompt)
         if not feedback_text:
             feedback_text = "AIフィードバックの生成結果が空でした。"
     except Exception as e:
         print(f"⚠️ AI生成エラー (Gemini): {e}")
         feedback_text = "AIフィードバック生成中にエラーが発生しました。"
 
-    # --- 前回との比較を考慮してトーンを追加 ---
-    if diff:
-        trend = ""
-        if diff["std_gx_diff"] < -0.01 or diff["std_gz_diff"] < -0.01:
-            trend = "（前回より安定しています👏）"
-        elif diff["std_gx_diff"] > 0.02 or diff["std_gz_diff"] > 0.02:
-            trend = "（少し揺れが増えているようです💦）"
-        else:
-            trend = "（前回と同じくらい安定しています✨）"
-        feedback_text += "\n" + trend
-
-    return feedback_text
+    return append_trend(feedback_text, diff)
 
 
 # ==========================================================
@@ -366,11 +466,7 @@ def summarize_feedback(ai_comment: str, diff_text: str) -> str:
     model = get_gemini_model()
     if model is None:
         # モデルが使えないときのデフォルト
-        return (
-            "😊 良い点: 全体的に安定した走行でした。\n"
-            "⚠ 改善点: カーブ時の揺れに注意しましょう。\n"
-            "📈 比較: 前回とほぼ同じ傾向です。"
-        )
+        return DEFAULT_SHORT_COMMENT
 
     prompt = f"""
     以下は運転に関するAIフィードバックです。
@@ -385,179 +481,430 @@ def summarize_feedback(ai_comment: str, diff_text: str) -> str:
     """
 
     try:
-        res = model.generate_content(prompt)
-        summary = (res.text or "").strip()
+        summary = generate_text(model, prompt)
         if not summary:
-            summary = (
-                "😊 良い点: 全体的に安定した走行でした。\n"
-                "⚠ 改善点: カーブ時の揺れに注意しましょう。\n"
-                "📈 比較: 前回とほぼ同じ傾向です。"
-            )
+            summary = DEFAULT_SHORT_COMMENT
     except Exception as e:
         print(f"⚠️ 要約生成エラー (Gemini): {e}")
-        summary = (
-            "😊 良い点: 全体的に安定した走行でした。\n"
-            "⚠ 改善点: カーブ時の揺れに注意しましょう。\n"
-            "📈 比較: 前回とほぼ同じ傾向です。"
-        )
+        summary = DEFAULT_SHORT_COMMENT
     return summary
 
 
 # ==========================================================
-#  メイン：重点ポイント解析
+#  構造化フィードバック生成（コメント＋要約を1回で）
 # ==========================================================
-def analyze_focus_points_for_session(session_id: str, user_id: str) -> dict:
-    sess_ref = db.collection("sessions").document(session_id)
-    sess_doc = sess_ref.get()
+def load_json_response(text: str):
+    """応答本文をJSONとして読む（```json ... ``` で囲まれていても読む。不正なら ValueError）"""
+    text = text.strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    return json.loads(text)
 
-    if not sess_doc.exists:
-        print(f"Session not found: {session_id}")
-        return {}
 
-    session_data = sess_doc.to_dict()
+def parse_structured_feedback(item):
+    """
+    {"comment": str, "summary": {"good", "improve", "compare"}} を検証して
+    (ai_comment, short_comment) を返す（形式が違えば ValueError）
+    """
+    if not isinstance(item, dict):
+        raise ValueError("feedback is not an object")
+    comment = item.get("comment")
+    if not isinstance(comment, str) or not comment.strip():
+        raise ValueError("comment is missing")
+    summary = item.get("summary")
+    if not isinstance(summary, dict):
+        raise ValueError("summary is missing")
+    lines = []
+    for key, label in SUMMARY_LINES:
+        value = summary.get(key)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"summary.{key} is missing")
+        # 1項目1行に揃える
+        lines.append(f"{label}: {' '.join(value.split())}")
+    return comment.strip(), "\n".join(lines)
+
+
+def _is_valid_structured(text: str) -> bool:
+    try:
+        parse_structured_feedback(load_json_response(text))
+        return True
+    except ValueError:
+        return False
 
-    # 🔥 ここで route_id を取得する（重要！）
-    route_id = session_data.get("route_id")
-    if not route_id:
-        print("⚠️ このセッションに route_id が設定されていません。")
-        return {}
 
-    print(f"🎯 Using route_id={route_id} for evaluation")
+def generate_structured_focus_feedback(focus_type_name, current_stats, diff, rating, diff_text, historical_data=None, raw_data=None):
+    """
+    1回の Gemini 呼び出しで長文コメントと3行要約をJSONで受け取る
+    Returns:
+        (ai_comment, short_comment)。モデルが使えない・応答が不正な場合は None
+    """
+    model = get_gemini_model()
+    if model is None:
+        return None
 
-    # GPS & AVG-G logs
-    gps_logs = [
-        d.to_dict()
-        for d in sess_ref.collection("gps_logs").order_by("timestamp").stream()
-    ]
-    avg_g_logs = [
-        d.to_dict()
-        for d in sess_ref.collection("avg_g_logs").order_by("timestamp").stream()
-    ]
+    prompt = build_focus_prompt(focus_type_name, current_stats, rating, diff_text, historical_data, raw_data)
+    prompt += STRUCTURED_OUTPUT_RULES
+    try:
+        text = generate_text(model, prompt, JSON_GENERATION_CONFIG, validate=_is_valid_structured)
+        ai_comment, short_comment = parse_structured_feedback(load_json_response(text))
+    except Exception as e:
+        print(f"⚠️ 構造化フィードバック生成エラー (Gemini): {e}")
+        return None
+    return append_trend(ai_comment, diff), short_comment
 
-    # 🔥 ピンを route_id で絞り込む（ここが最重要）
-    pin_query = (
-        db.collection("priority_pins")
-        .where("user_id", "==", user_id)
-        .where("route_id", "==", route_id)
+
+def generate_focus_comments(focus_type_name, current_stats, diff, rating, diff_text, historical_data=None, raw_data=None):
+    """
+    FOCUS_FEEDBACK_MODE に応じて (ai_comment, short_comment) を生成する
+    structured の応答が使えなければ従来の2回呼び出しで作り直す
+    """
+    if FOCUS_FEEDBACK_MODE != "two_call":
+        comments = generate_structured_focus_feedback(
+            focus_type_name, current_stats, diff, rating, diff_text, historical_data, raw_data
+        )
+        if comments is not None:
+            return comments
+        print("↩️ Falling back to two-call feedback generation")
+
+    ai_comment = generate_ai_focus_feedback(
+        focus_type_name, current_stats, diff, rating, diff_text, historical_data, raw_data
     )
+    return ai_comment, summarize_feedback(ai_comment, diff_text)
 
-    pins = [dict(p.to_dict(), id=p.id) for p in pin_query.stream()]
 
-    print(f"📌 Loaded {len(pins)} pins for this route.")
+def _is_valid_session_response(text: str) -> bool:
+    try:
+        return isinstance(load_json_response(text).get("pins"), list)
+    except (ValueError, AttributeError):
+        return False
 
-    results = {}
-    for pin in pins:
-        focus_type = pin.get("focus_type", "smooth_overall")
-        focus_type_name = pin.get("focus_label", "全体の滑らかさ")
-        lat, lng, pin_id = float(pin["lat"]), float(pin["lng"]), pin["id"]
-
-        # --- 最近のGPSから最接近点を特定 ---
-        nearest_point, nearest_dist = None, float("inf")
-        for g in gps_logs:
-            dist = ((lat - g.get("latitude", 0))**2 + (lng - g.get("longitude", 0))**2)**0.5
-            if dist < nearest_dist:
-                nearest_dist = dist
-                nearest_point = g
-
-        # --- 通過判定 ---
-        if not nearest_point or nearest_dist > 0.0003:  # 約30m
-            comment = NOT_PASSED_COMMENT
-            sess_ref.collection("focus_feedbacks").document(pin_id).set({
-                "created_at": datetime.now(JST),
-                "pin_label": pin.get("label", ""),
-                "focus_type": focus_type,
-                "focus_label": focus_type_name,
-                "passed": False,
-                "ai_comment": comment,
-                "rating": "なし",
-                "stats": NOT_PASSED_STATS,
-            })
-            results[pin_id] = {"ai_comment": comment, "rating": "なし", "passed": False}
-            continue
 
-        # --- focus_type別の時間範囲取得 ---
-        before_ms, after_ms = get_time_window_for_focus(focus_type)
-        center_time = nearest_point.get("timestamp_ms", 0)
-
-        nearby = [
-            g for g in avg_g_logs
-            if -before_ms <= g.get("timestamp_ms", 0) - center_time <= after_ms
-        ]
-        if not nearby:
-            comment = "通過しましたが、この地点のGログが不足して解析できませんでした。"
-            sess_ref.collection("focus_feedbacks").document(pin_id).set({
-                "created_at": datetime.now(JST),
-                "pin_label": pin.get("label", ""),
-                "focus_type": focus_type,
-                "focus_label": focus_type_name,
-                "passed": True,
-                "ai_comment": comment,
-                "rating": "なし",
-                "stats": NOT_PASSED_STATS,
-            })
-            results[pin_id] = {"ai_comment": comment, "rating": "なし", "passed": True}
+def generate_session_focus_feedback(pin_inputs):
+    """
+    ルートの通過ピンをまとめて1回の Gemini 呼び出しで評価する
+    Args:
+        pin_inputs: {pin_id: generate_focus_comments の引数（dict）}（プロンプトにはこの順で並べる）
+    Returns:
+        {pin_id: (ai_comment, short_comment)}（応答に含まれなかった・形式が不正なピンは含まない）
+    """
+    if not pin_inputs:
+        return {}
+    model = get_gemini_model()
+    if model is None:
+        return {}
+
+    blocks = [
+        f"""
+    ■ ポイントID: {pin_id}
+    この地点は「{args['focus_type_name']}」を意識するよう設定されていました。
+    {build_focus_data_text(args['current_stats'], args['rating'], args['diff_text'],
+                           args.get('historical_data'), args.get('raw_data'))}
+    """
+        for pin_id, args in pin_inputs.items()
+    ]
+    prompt = f"""
+    あなたは運転コーチAI『ドライボ』です。
+    今回の走行で通過した重点ポイントごとに、以下の**実際の計測データ**をもとに、運転の特徴と改善点をコメントしてください。
+    {"".join(blocks)}
+    {FOCUS_COMMENT_RULES}
+    {SESSION_OUTPUT_RULES}
+    """
+
+    try:
+        text = generate_text(model, prompt, JSON_GENERATION_CONFIG, validate=_is_valid_session_response)
+        items = load_json_response(text).get("pins")
+        if not isinstance(items, list):
+            raise ValueError("pins is missing")
+    except Exception as e:
+        print(f"⚠️ セッション一括フィードバック生成エラー (Gemini): {e}")
+        return {}
+
+    comments = {}
+    for item in items:
+        pin_id = item.get("pin_id") if isinstance(item, dict) else None
+        if pin_id not in pin_inputs or pin_id in comments:
+            continue
+        try:
+            ai_comment, short_comment = parse_structured_feedback(item)
+        except ValueError as e:
+            print(f"⚠️ Invalid feedback for pin {pin_id}: {e}")
             continue
+        comments[pin_id] = (append_trend(ai_comment, pin_inputs[pin_id]["diff"]), short_comment)
+    print(f"🧩 Session-level feedback covered {len(comments)}/{len(pin_inputs)} pins")
+    return comments
+
 
-        # --- 詳細統計値算出 ---
-        gx_vals = [g.get("g_x", 0) for g in nearby]
-        gz_vals = [g.get("g_z", 0) for g in nearby]
-        speeds = [g.get("speed", 0) for g in nearby]
+# ==========================================================
+#  ピン1つ分の評価
+# ==========================================================
+def _passage_window(avg_g, center_time, before_ms, after_ms):
+    """
+    時刻順の avg_g 列から [center_time - before_ms, center_time + after_ms] の範囲を二分探索で求める
+    （両端を含む。返すのはスライスなので、列はコピーせずビューとして使える）
+    """
+    ts = avg_g["timestamp_ms"]
+    lo = int(np.searchsorted(ts, center_time - before_ms, side="left"))
+    hi = int(np.searchsorted(ts, center_time + after_ms, side="right"))
+    return slice(lo, hi)
 
-        current_stats = calculate_detailed_stats(gx_vals, gz_vals, speeds)
 
-        # --- 生データを整形（AIに渡すため） ---
-        raw_data_points = []
-        for g in nearby:
-            raw_data_points.append({
-                "gx": g.get("g_x", 0),
-                "gz": g.get("g_z", 0),
-                "speed": g.get("speed", 0)
-            })
+def _passage_stats(avg_g, center_time, before_ms, after_ms):
+    """通過1回分の時間範囲を切り出して統計を計算する（Gログが無ければ (None, 空のスライス)）"""
+    window = _passage_window(avg_g, center_time, before_ms, after_ms)
+    if window.stop <= window.start:
+        return None, window
+    stats = calculate_detailed_stats(avg_g["g_x"][window], avg_g["g_z"][window], avg_g["speed"][window])
+    return stats, window
 
-        # --- 過去データ取得（直近3回分） ---
-        historical_data = get_historical_stats(user_id, session_id, pin_id, limit=3)
-        
-        # 直前のデータを取得
-        prev_stats = historical_data[0].get("stats") if historical_data else None
-
-        diff, diff_text = compare_focus_stats(prev_stats, current_stats)
-        rating, score = get_focus_rating(current_stats, focus_type)
-
-        ai_comment = generate_ai_focus_feedback(
-            focus_type_name,
-            current_stats,
-            diff,
-            rating,
-            diff_text,
-            historical_data,
-            raw_data_points
-        )
 
-        short_comment = summarize_feedback(ai_comment, diff_text)
+def _prepare_focus_pin(sess_ref, session_id, user_id, pin, created_at, track_index, avg_g):
+    """
+    ピン1つ分の通過判定・統計・過去との比較を行う（AIコメントの生成の手前まで）
+    （スレッドプールから呼ばれる。track_index / avg_g（時刻順の列）は読み取りのみ）
+
+    同じピンを複数回通過した場合は、通過ごとに統計・評価を計算して passages に記録し、
+    Gログのある最初の通過を代表としてAIコメントを生成する。
+    未通過・Gログ不足のピンはAIコメントが不要なので、ここで保存まで済ませる。
 
+    Returns:
+        (pin_id, 結果dict, None)  保存済みの場合
+        (pin_id, None, pending)   AIコメント待ちの場合（pending = {"pin_id", "feedback", "llm_input"}）
+    """
+    focus_type = pin.get("focus_type", "smooth_overall")
+    focus_type_name = pin.get("focus_label", "全体の滑らかさ")
+    lat, lng, pin_id = float(pin["lat"]), float(pin["lng"]), pin["id"]
+
+    # --- 通過判定（半径 PASS_RADIUS_M 以内を通った区間をすべて取得） ---
+    passages = track_index.passages(lat, lng, PASS_RADIUS_M)
+    if not passages:
+        comment = NOT_PASSED_COMMENT
         sess_ref.collection("focus_feedbacks").document(pin_id).set({
-            "created_at": datetime.now(JST),
+            "created_at": created_at,
             "pin_label": pin.get("label", ""),
             "focus_type": focus_type,
             "focus_label": focus_type_name,
-            "stats": current_stats,
-            "diff": diff,
+            "passed": False,
+            "ai_comment": comment,
+            "rating": "なし",
+            "stats": NOT_PASSED_STATS,
+        })
+        return pin_id, {"ai_comment": comment, "rating": "なし", "passed": False}, None
+
+    # --- focus_type別の時間範囲で、通過ごとに統計・評価 ---
+    before_ms, after_ms = get_time_window_for_focus(focus_type)
+    passage_summaries = []
+    primary = None
+    for passage in passages:
+        stats, window = _passage_stats(avg_g, passage.closest_ms, before_ms, after_ms)
+        rating, score = get_focus_rating(stats, focus_type) if stats else ("なし", 0)
+        passage_summaries.append({
+            "entry_ms": passage.entry_ms,
+            "exit_ms": passage.exit_ms,
+            "closest_ms": passage.closest_ms,
+            "closest_m": round(passage.closest_m, 1),
             "rating": rating,
             "score": score,
-            "ai_comment": ai_comment,
-            "short_comment": short_comment,
-            "passed": True
+            "data_points": window.stop - window.start,
         })
+        if primary is None and stats:
+            primary = (stats, window)
 
-        results[pin_id] = {
+    if primary is None:
+        comment = "通過しましたが、この地点のGログが不足して解析できませんでした。"
+        sess_ref.collection("focus_feedbacks").document(pin_id).set({
+            "created_at": created_at,
             "pin_label": pin.get("label", ""),
             "focus_type": focus_type,
             "focus_label": focus_type_name,
-            "rating": rating,
-            "score": score,
-            "ai_comment": ai_comment,
-            "stats": current_stats
-        }
+            "passed": True,
+            "ai_comment": comment,
+            "rating": "なし",
+            "stats": NOT_PASSED_STATS,
+            "passages": passage_summaries,
+            "passage_count": len(passages),
+        })
+        return pin_id, {"ai_comment": comment, "rating": "なし", "passed": True}, None
 
+    current_stats, window = primary
+
+    # --- 過去データ取得（直近3回分） ---
+    historical_data = get_historical_stats(user_id, session_id, pin_id, limit=3)
+    
+    # 直前のデータを取得
+    prev_stats = historical_data[0].get("stats") if historical_data else None
+
+    diff, diff_text = compare_focus_stats(prev_stats, current_stats)
+    rating, score = get_focus_rating(current_stats, focus_type)
+
+    # --- 生データを整形（AIに渡すため。プロンプト全体が予算に収まるよう計測データを間引く） ---
+    fixed_tokens = estimate_tokens(
+        build_focus_prompt(focus_type_name, current_stats, rating, diff_text, historical_data)
+        + STRUCTURED_OUTPUT_RULES
+    )
+    raw_data = compact_series(
+        avg_g["timestamp_ms"][window], avg_g["g_x"][window], avg_g["g_z"][window], avg_g["speed"][window],
+        token_budget=max(0, FOCUS_PROMPT_TOKEN_BUDGET - fixed_tokens),
+    )
+
+    feedback = {
+        "created_at": created_at,
+        "pin_label": pin.get("label", ""),
+        "focus_type": focus_type,
+        "focus_label": focus_type_name,
+        "stats": current_stats,
+        "diff": diff,
+        "rating": rating,
+        "score": score,
+        "passed": True,
+        "passages": passage_summaries,
+        "passage_count": len(passages),
+        "prompt_compaction": raw_data.to_record(),
+    }
+    llm_input = {
+        "focus_type_name": focus_type_name,
+        "current_stats": current_stats,
+        "diff": diff,
+        "rating": rating,
+        "diff_text": diff_text,
+        "historical_data": historical_data,
+        "raw_data": raw_data,
+    }
+    return pin_id, None, {"pin_id": pin_id, "feedback": feedback, "llm_input": llm_input}
+
+
+def _finish_focus_pin(sess_ref, session_id, user_id, pending, comments=None, end_time=None):
+    """
+    AIコメントを付けて focus_feedbacks/{pin_id} に保存し、ユーザー×ピンの履歴にも記録する
+    comments（(ai_comment, short_comment)）が無ければここで生成する
+
+    Returns:
+        (pin_id, 結果dict)
+    """
+    pin_id, feedback = pending["pin_id"], pending["feedback"]
+    if comments is None:
+        comments = generate_focus_comments(**pending["llm_input"])
+    feedback["ai_comment"], feedback["short_comment"] = comments
+
+    sess_ref.collection("focus_feedbacks").document(pin_id).set(feedback)
+    # 次回以降の比較用に、ユーザー×ピンの履歴にも書いておく
+    record_focus_history(db, user_id, pin_id, make_entry(session_id, feedback, end_time))
+
+    return pin_id, {
+        "pin_label": feedback["pin_label"],
+        "focus_type": feedback["focus_type"],
+        "focus_label": feedback["focus_label"],
+        "rating": feedback["rating"],
+        "score": feedback["score"],
+        "ai_comment": feedback["ai_comment"],
+        "stats": feedback["stats"],
+        "passages": feedback["passages"],
+    }
+
+
+def _evaluate_focus_pin(sess_ref, session_id, user_id, pin, created_at, track_index, avg_g, end_time=None):
+    """
+    ピン1つ分の通過判定・統計・AIコメント生成を行い focus_feedbacks/{pin_id} に保存する
+
+    Returns:
+        (pin_id, 結果dict)
+    """
+    pin_id, result, pending = _prepare_focus_pin(sess_ref, session_id, user_id, pin, created_at, track_index, avg_g)
+    if pending is None:
+        return pin_id, result
+    return _finish_focus_pin(sess_ref, session_id, user_id, pending, end_time=end_time)
+
+
+# ==========================================================
+#  メイン：重点ポイント解析
+# ==========================================================
+def analyze_focus_points_for_session(session_id: str, user_id: str, *, telemetry=None) -> dict:
+    """
+    route_id のピンごとに通過判定・統計・AIコメントを作り focus_feedbacks に保存する
+    telemetry（SessionTelemetry）を渡すと、読み込み済みのログを使い回す。
+    """
+    sess_ref = db.collection("sessions").document(session_id)
+    sess_doc = sess_ref.get()
+
+    if not sess_doc.exists:
+        print(f"Session not found: {session_id}")
+        return {}
+
+    session_data = sess_doc.to_dict()
+
+    # 🔥 ここで route_id を取得する（重要！）
+    route_id = session_data.get("route_id")
+    if not route_id:
+        print("⚠️ このセッションに route_id が設定されていません。")
+        return {}
+
+    print(f"🎯 Using route_id={route_id} for evaluation")
+
+    # GPS & AVG-G logs（チャンク→時刻順のNumPy列）
+    if telemetry is None:
+        telemetry = SessionTelemetry(sess_ref)
+    telemetry.prefetch(("gps_logs", "avg_g_logs"))
+    gps = telemetry.columns("gps_logs")
+    gps_valid = filter_track(gps["latitude"], gps["longitude"], gps["timestamp_ms"], gps["speed"], gps["quality"])
+    # 飛び・ふらつきを除いた点で格子インデックスを作り、全ピンの通過判定で共有する
+    track_index = TrackIndex(gps["latitude"], gps["longitude"], gps["timestamp_ms"], mask=gps_valid)
+    avg_g = telemetry.columns("avg_g_logs")
+
+    # 🔥 ピンを route_id で絞り込む（ここが最重要）
+    pin_query = (
+        db.collection("priority_pins")
+        .where("user_id", "==", user_id)
+        .where("route_id", "==", route_id)
+    )
+
+    # 評価結果・created_at の順序を固定するため、ピンIDの順に並べる
+    pins = sorted((dict(p.to_dict(), id=p.id) for p in pin_query.stream()), key=lambda p: p["id"])
+
+    print(f"📌 Loaded {len(pins)} pins for this route.")
+
+    # 🚀 ピンごとの評価を並列に実行（LLM呼び出しの同時実行数は _LLM_SEMAPHORE で全体を制限）
+    # created_at はピンの順に1マイクロ秒ずつずらし、並列でも表示順が変わらないようにする
+    started = time.monotonic()
+    evaluated_at = datetime.now(JST)
+    end_time = session_data.get("end_time")
+    workers = max(1, min(FOCUS_PIN_WORKERS, len(pins)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="focus-pin") as pool:
+        if FOCUS_FEEDBACK_MODE == "session":
+            # 通過判定・統計をピンごとに並列で求め、通過したピンのAIコメントは1回の呼び出しでまとめて生成する
+            prepared = [
+                future.result() for future in [
+                    pool.submit(
+                        _prepare_focus_pin, sess_ref, session_id, user_id, pin,
+                        evaluated_at + timedelta(microseconds=index), track_index, avg_g,
+                    )
+                    for index, pin in enumerate(pins)
+                ]
+            ]
+            pending = [p for _, _, p in prepared if p is not None]
+            comments = generate_session_focus_feedback({p["pin_id"]: p["llm_input"] for p in pending})
+            # 一括の応答に含まれなかったピンは _finish_focus_pin の中で個別に生成する
+            finished = {
+                p["pin_id"]: pool.submit(
+                    _finish_focus_pin, sess_ref, session_id, user_id, p, comments.get(p["pin_id"]), end_time
+                )
+                for p in pending
+            }
+            results = {
+                pin_id: result if pending_pin is None else finished[pin_id].result()[1]
+                for pin_id, result, pending_pin in prepared
+            }
+        else:
+            futures = [
+                pool.submit(
+                    _evaluate_focus_pin, sess_ref, session_id, user_id, pin,
+                    evaluated_at + timedelta(microseconds=index), track_index, avg_g, end_time,
+                )
+                for index, pin in enumerate(pins)
+            ]
+            # 結果はピンの順に集める（失敗したピンがあれば例外を呼び出し側へ伝える）
+            results = dict(future.result() for future in futures)
+
+    print(f"⏱️ Evaluated {len(pins)} pins in {time.monotonic() - started:.1f}s "
+          f"({workers} workers, feedback mode={FOCUS_FEEDBACK_MODE})")
     print(f"✅ focus_feedbacks updated for session {session_id}")
     return results
\ No newline at end of file
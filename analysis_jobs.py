@@ -0,0 +1,329 @@
+# analysis_jobs.py
+"""
+走行後解析のバックグラウンドジョブ機能モジュール
+/sessions/end は解析ジョブを積んで即座に返し、ワーカースレッドが
+集計の作り直し → 注目ポイントのAIフィードバック → 総合スコア の順に実行する。
+
+ジョブの状態はセッションドキュメントに保存し、recording_completed 画面から参照する。
+    analysis_status       queued / running / done / failed
+    analysis_step         実行中（最後に実行した）ステップ名
+    analysis_steps_done   完了済みのステップ名（再試行時はここから再開する）
+    analysis_attempts     試行回数
+    analysis_error        直近の失敗内容
+    analysis_updated_at   最終更新時刻
+
+- 失敗したジョブは指数バックオフで max_attempts 回まで再試行する
+- 同じセッションのジョブは1プロセス内で同時に1つだけ。queued/running のまま
+  stale_after_s を過ぎたもの（プロセスの再起動などで止まったもの）は再投入できる
+- shutdown() は実行中のジョブを待ってから停止する（atexit で自動的に呼ばれる）
+- テレメトリは SessionTelemetry で1ジョブにつきストリームごとに1回だけ読み込み、全ステップで共有する
+  （再試行時も読み込み済みの列を使い回す）
+
+aggregate_backfill_runner は集計導入前のセッションの aggregates を作り直すだけのランナー
+（セッション一覧の表示時に積む）。状態は aggregates_backfill_status などに保存し、解析ジョブの状態とは分ける。
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+from models import db
+from session_telemetry import SessionTelemetry
+
+
+ANALYSIS_QUEUED = 'queued'
+ANALYSIS_RUNNING = 'running'
+ANALYSIS_DONE = 'done'
+ANALYSIS_FAILED = 'failed'
+
+
+# ===== 解析ステップ =====
+# (ステップ名, 関数(session_id, user_id, telemetry), 事前に並列で読み込むストリーム)
+def _step_aggregates(session_id: str, user_id: str, telemetry: SessionTelemetry) -> None:
+    """集計が無い・一部失敗していた場合は、保存済みデータから作り直す（一覧表示用）"""
+    from session_aggregates import backfill_aggregates
+
+    session_ref = telemetry.session_ref
+    aggregates = (session_ref.get().to_dict() or {}).get('aggregates')
+    if not aggregates or aggregates.get('dirty'):
+        backfill_aggregates(session_ref, telemetry=telemetry)
+
+
+def _step_focus_feedback(session_id: str, user_id: str, telemetry: SessionTelemetry) -> None:
+    from ai_evaluation import analyze_focus_points_for_session
+    analyze_focus_points_for_session(session_id, user_id, telemetry=telemetry)
+
+
+def _step_overall_score(session_id: str, user_id: str, telemetry: SessionTelemetry) -> None:
+    from score import calculate_session_overall_score
+    calculate_session_overall_score(session_id, user_id, telemetry=telemetry)
+
+
+AnalysisStep = Tuple[str, Callable[[str, str, SessionTelemetry], Any], Tuple[str, ...]]
+
+ANALYSIS_STEPS: List[AnalysisStep] = [
+    ('aggregates', _step_aggregates, ()),
+    ('focus_feedback', _step_focus_feedback, ('gps_logs', 'avg_g_logs')),
+    ('overall_score', _step_overall_score, ('avg_g_logs',)),
+]
+
+
+_STOP = object()
+
+
+# ===== ジョブランナー =====
+class AnalysisJobRunner:
+    """走行後解析をワーカープールで実行し、状態をセッションドキュメントに記録する"""
+
+    def __init__(self, db_client, steps: Optional[List[AnalysisStep]] = None,
+                 num_workers: int = 2, max_attempts: int = 3, backoff_base_s: float = 2.0,
+                 stale_after_s: float = 900.0, field_prefix: str = 'analysis'):
+        self._db = db_client
+        self._steps = steps if steps is not None else ANALYSIS_STEPS
+        self._field_prefix = field_prefix   # 状態を保存するフィールド名の接頭辞（{prefix}_status など）
+        self._num_workers = num_workers
+        self._max_attempts = max_attempts
+        self._backoff_base_s = backoff_base_s
+        self._stale_after_s = stale_after_s
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._timers: Dict[str, threading.Timer] = {}
+        self._inflight: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._counters = {
+            'submitted': 0,
+            'succeeded': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+
+    # ----- ライフサイクル -----
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        for index in range(self._num_workers):
+            thread = threading.Thread(target=self._worker, name=f"analysis-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.shutdown)
+        print(f"🧠 Analysis job runner started ({self._num_workers} workers)")
+
+    def shutdown(self, timeout: float = 60.0) -> None:
+        """実行中のジョブを待ってから停止する（バックオフ待ちのジョブは queued のまま残る）"""
+        if not self._running:
+            return
+        self._running = False
+        with self._lock:
+            timers = list(self._timers.values())
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        print(f"🛑 Analysis job runner stopped: {self.stats()}")
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    # ----- 投入 -----
+    def submit(self, session_id: str, user_id: str, force: bool = False,
+               telemetry: Optional[SessionTelemetry] = None) -> str:
+        """
+        解析ジョブを積み、投入後の analysis_status を返す
+        完了済み・実行中のセッションは積み直さない（force=True で完了済みも再実行する）
+        telemetry を渡すと、呼び出し側で読み込み済みのストリームをジョブでも使う。
+        """
+        with self._lock:
+            if session_id in self._inflight:
+                return self._inflight[session_id]
+
+        session_ref = self._db.collection('sessions').document(session_id)
+        session_doc = session_ref.get()
+        data = (session_doc.to_dict() or {}) if session_doc.exists else {}
+        status = data.get(self._field('status'))
+        if not force:
+            if status == ANALYSIS_DONE:
+                return status
+            if status in (ANALYSIS_QUEUED, ANALYSIS_RUNNING) and not self._is_stale(data):
+                return status
+
+        with self._lock:
+            if session_id in self._inflight:
+                return self._inflight[session_id]
+            self._inflight[session_id] = ANALYSIS_QUEUED
+            self._counters['submitted'] += 1
+
+        steps_done = [] if force else list(data.get(self._field('steps_done')) or [])
+        self._update(session_id, {
+            self._field('status'): ANALYSIS_QUEUED,
+            self._field('steps_done'): steps_done,
+            self._field('attempts'): 0,
+            self._field('error'): None,
+        })
+        if not self._running:
+            self.start()
+        self._queue.put({
+            'session_id': session_id,
+            'user_id': user_id,
+            'attempt': 0,
+            'steps_done': steps_done,
+            'telemetry': telemetry if telemetry is not None else SessionTelemetry(session_ref),
+        })
+        return ANALYSIS_QUEUED
+
+    def status(self, session_id: str) -> Dict[str, Any]:
+        """セッションドキュメントに記録された解析状態"""
+        session_doc = self._db.collection('sessions').document(session_id).get()
+        data = (session_doc.to_dict() or {}) if session_doc.exists else {}
+        steps_done = list(data.get(self._field('steps_done')) or [])
+        updated_at = data.get(self._field('updated_at'))
+        return {
+            'analysis_status': data.get(self._field('status')),
+            'step': data.get(self._field('step')),
+            'steps_done': steps_done,
+            'steps_total': len(self._steps),
+            'progress': round(len(steps_done) / len(self._steps), 2) if self._steps else 1.0,
+            'attempts': int(data.get(self._field('attempts'), 0) or 0),
+            'max_attempts': self._max_attempts,
+            'error': data.get(self._field('error')),
+            'updated_at': updated_at.isoformat() if hasattr(updated_at, 'isoformat') else None,
+        }
+
+    # ----- 監視 -----
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            inflight = len(self._inflight)
+            backoff = len(self._timers)
+        return {
+            'running': self._running,
+            'workers': self._num_workers,
+            'queue_depth': self._queue.qsize(),
+            'inflight': inflight,
+            'waiting_retry': backoff,
+            **counters,
+        }
+
+    # ----- ワーカー -----
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            try:
+                self._run(job)
+            except Exception as e:
+                # 状態の書き込み自体が失敗した場合など。ジョブは諦めて次へ進む
+                print(f"❌ Analysis job crashed for session {job['session_id']}: {e}")
+                with self._lock:
+                    self._inflight.pop(job['session_id'], None)
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        session_id = job['session_id']
+        job['attempt'] += 1
+        with self._lock:
+            self._inflight[session_id] = ANALYSIS_RUNNING
+        self._update(session_id, {
+            self._field('status'): ANALYSIS_RUNNING,
+            self._field('attempts'): job['attempt'],
+        })
+
+        started = time.monotonic()
+        telemetry: SessionTelemetry = job['telemetry']
+        remaining = [step for step in self._steps if step[0] not in job['steps_done']]
+        for name, step, streams in remaining:
+            self._update(session_id, {self._field('step'): name})
+            try:
+                # 残りのステップが使うストリームを最初にまとめて並列に読む（読み込み済みは読まない）
+                telemetry.prefetch(sorted({s for _, _, needed in remaining for s in needed}))
+                step(session_id, job['user_id'], telemetry)
+            except Exception as e:
+                self._on_failure(job, name, e)
+                return
+            job['steps_done'].append(name)
+            self._update(session_id, {self._field('steps_done'): list(job['steps_done'])})
+
+        self._update(session_id, {self._field('status'): ANALYSIS_DONE, self._field('error'): None})
+        with self._lock:
+            self._inflight.pop(session_id, None)
+            self._counters['succeeded'] += 1
+        reads = telemetry.read_stats()
+        print(f"✅ Analysis done for session {session_id} "
+              f"(attempt {job['attempt']}, {time.monotonic() - started:.1f}s, "
+              f"telemetry reads: {reads['queries']} queries / {reads['documents']} docs)")
+
+    def _on_failure(self, job: Dict[str, Any], step_name: str, error: Exception) -> None:
+        session_id = job['session_id']
+        message = f"{step_name}: {error}"
+        if job['attempt'] >= self._max_attempts or not self._running:
+            self._update(session_id, {self._field('status'): ANALYSIS_FAILED, self._field('error'): message})
+            with self._lock:
+                self._inflight.pop(session_id, None)
+                self._counters['failed'] += 1
+            print(f"❌ Analysis failed for session {session_id} after {job['attempt']} attempts: {message}")
+            return
+
+        delay = self._backoff_base_s * (2 ** (job['attempt'] - 1))
+        self._update(session_id, {self._field('status'): ANALYSIS_QUEUED, self._field('error'): message})
+        timer = threading.Timer(delay, self._requeue, args=(job,))
+        timer.daemon = True
+        with self._lock:
+            self._inflight[session_id] = ANALYSIS_QUEUED
+            self._timers[session_id] = timer
+            self._counters['retried'] += 1
+        timer.start()
+        print(f"⚠️ Analysis step '{step_name}' failed for session {session_id} "
+              f"(attempt {job['attempt']}/{self._max_attempts}), retrying in {delay:.1f}s: {error}")
+
+    def _requeue(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._timers.pop(job['session_id'], None)
+        if self._running:
+            self._queue.put(job)
+
+    # ----- 状態の保存 -----
+    def _field(self, name: str) -> str:
+        return f"{self._field_prefix}_{name}"
+
+    def _update(self, session_id: str, fields: Dict[str, Any]) -> None:
+        fields = dict(fields, **{self._field('updated_at'): firestore.SERVER_TIMESTAMP})
+        self._db.collection('sessions').document(session_id).update(fields)
+
+    def _is_stale(self, data: Dict[str, Any]) -> bool:
+        updated_at = data.get(self._field('updated_at'))
+        if not isinstance(updated_at, datetime):
+            return True
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - updated_at).total_seconds() > self._stale_after_s
+
+
+analysis_runner = AnalysisJobRunner(
+    db,
+    num_workers=int(os.getenv('ANALYSIS_WORKERS', '2')),
+    max_attempts=int(os.getenv('ANALYSIS_MAX_ATTEMPTS', '3')),
+)
+
+# 集計導入前のセッションの集計作り直し（一覧の表示で全件読み込みをしないよう、バックグラウンドで1件ずつ）
+AGGREGATE_BACKFILL_STEPS: List[AnalysisStep] = [
+    ('aggregates', _step_aggregates, ()),
+]
+
+aggregate_backfill_runner = AnalysisJobRunner(
+    db,
+    steps=AGGREGATE_BACKFILL_STEPS,
+    num_workers=int(os.getenv('AGGREGATE_BACKFILL_WORKERS', '1')),
+    field_prefix='aggregates_backfill',
+)
@@ -0,0 +1,72 @@
+"""
+既存の focus_feedbacks から focus_history（ユーザー×ピンの評価履歴）を作成するスクリプト
+
+使い方:
+    python backfill_focus_history.py                # 全ユーザー
+    python backfill_focus_history.py --user <id>    # 指定ユーザーのみ
+    python backfill_focus_history.py --dry-run      # 書き込まずに件数だけ表示
+"""
+import argparse
+from collections import defaultdict
+from google.cloud import firestore
+from bulk_writer import FirestoreBulkWriter
+from focus_history import (
+    FOCUS_HISTORY_COLLECTION,
+    HISTORY_LIMIT,
+    history_doc_id,
+    make_entry,
+    merge_entries,
+)
+
+
+def collect_history(db, user_id=None, limit=HISTORY_LIMIT):
+    """完了済みセッションの focus_feedbacks を (user_id, pin_id) ごとの履歴にまとめる"""
+    query = db.collection("sessions").where("status", "==", "completed")
+    if user_id:
+        query = query.where("user_id", "==", user_id)
+
+    history = defaultdict(list)
+    sessions = 0
+    for sdoc in query.stream():
+        session = sdoc.to_dict()
+        sessions += 1
+        for fb in sdoc.reference.collection("focus_feedbacks").stream():
+            key = (session.get("user_id"), fb.id)
+            entry = make_entry(sdoc.id, fb.to_dict(), session.get("end_time"))
+            history[key] = merge_entries(history[key], [entry], limit)
+    return history, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="focus_history を既存の評価から作成")
+    parser.add_argument("--user", help="対象ユーザーID（省略時は全ユーザー）")
+    parser.add_argument("--limit", type=int, default=HISTORY_LIMIT, help="1ピンあたりの保存件数")
+    parser.add_argument("--dry-run", action="store_true", help="書き込まずに件数だけ表示する")
+    args = parser.parse_args()
+
+    # Firestore初期化
+    db = firestore.Client()
+
+    history, sessions = collect_history(db, args.user, args.limit)
+    print(f"📚 {sessions} sessions scanned, {len(history)} (user, pin) histories")
+
+    operations = [
+        ("set", db.collection(FOCUS_HISTORY_COLLECTION).document(history_doc_id(user_id, pin_id)), {
+            "user_id": user_id,
+            "pin_id": pin_id,
+            "entries": entries,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+        for (user_id, pin_id), entries in history.items()
+        if user_id and entries
+    ]
+    if args.dry_run:
+        print(f"🔎 Dry run: {len(operations)} documents would be written")
+        return
+
+    result = FirestoreBulkWriter(db).commit(operations)
+    print(f"完了: {result['written']}件の履歴を書き込みました（失敗 {result['failed']}件）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# bulk_writer.py
+"""
+Firestore一括書き込み機能モジュール
+Firestoreのバッチ上限（500操作 / 約10MiB）を超えないように操作を分割し、
+スレッドプールで並列コミットする。失敗したバッチは指数バックオフで再試行する。
+スレッドプールは書き込み器ごとに1つ作って使い回す（受信のたびに作り直さない）。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from google.api_core import exceptions as gexc
+    RETRYABLE_ERRORS: Tuple[type, ...] = (
+        gexc.Aborted,
+        gexc.DeadlineExceeded,
+        gexc.InternalServerError,
+        gexc.ResourceExhausted,
+        gexc.ServiceUnavailable,
+        gexc.TooManyRequests,
+    )
+except ImportError:  # google-api-core が無い環境では全例外を再試行対象にする
+    RETRYABLE_ERRORS = (Exception,)
+
+
+# 操作は ('set', doc_ref, data) / ('update', doc_ref, fields) / ('delete', doc_ref, None)
+Operation = Tuple[str, Any, Optional[Dict[str, Any]]]
+
+
+def estimate_size(value: Any) -> int:
+    """Firestoreのストレージサイズ計算に近い概算バイト数"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, dict):
+        return sum(len(str(k)) + 1 + estimate_size(v) for k, v in value.items()) + 32
+    if isinstance(value, (list, tuple)):
+        # 数値配列は先頭要素で概算（テレメトリ列の大半は同じ型）
+        if value and isinstance(value[0], (int, float)) and not isinstance(value[0], bool):
+            return 8 * len(value)
+        return sum(estimate_size(v) for v in value)
+    return 16  # datetime / SERVER_TIMESTAMP など
+
+
+class FirestoreBulkWriter:
+    """Firestoreのバッチ上限を守りつつ並列にコミットする書き込み器"""
+
+    MAX_BATCH_OPERATIONS = 500
+    MAX_BATCH_BYTES = 9 * 1024 * 1024   # コミット要求の上限 10MiB に余裕を持たせる
+
+    def __init__(self, db_client, batch_size: int = MAX_BATCH_OPERATIONS, max_workers: int = 4,
+                 max_retries: int = 3, backoff_base_s: float = 0.2):
+        if not 0 < batch_size <= self.MAX_BATCH_OPERATIONS:
+            raise ValueError(f"batch_size must be 1..{self.MAX_BATCH_OPERATIONS}: {batch_size}")
+        self._db = db_client
+        self._batch_size = batch_size
+        self._max_workers = max_workers
+        self._max_retries = max_retries
+        self._backoff_base_s = backoff_base_s
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def split(self, operations: List[Operation]) -> List[List[Operation]]:
+        """操作列を件数・サイズ上限に収まるバッチに分割"""
+        batches: List[List[Operation]] = []
+        current: List[Operation] = []
+        current_bytes = 0
+        for op in operations:
+            op_bytes = estimate_size(op[2]) + 128  # ドキュメントパス分の余裕
+            if current and (len(current) >= self._batch_size
+                            or current_bytes + op_bytes > self.MAX_BATCH_BYTES):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(op)
+            current_bytes += op_bytes
+        if current:
+            batches.append(current)
+        return batches
+
+    def commit(self, operations: List[Operation]) -> Dict[str, Any]:
+        """
+        全操作をコミットしてバッチごとの結果を返す
+
+        Returns:
+            {
+                'ok': bool,            # 全バッチ成功
+                'written': int,        # 成功した操作数
+                'failed': int,         # 失敗した操作数
+                'chunks': [{'index', 'offset', 'size', 'ok', 'attempts', 'error'}, ...],
+                'elapsed_s': float,
+            }
+        """
+        started = time.perf_counter()
+        batches = self.split(operations)
+        if not batches:
+            return {'ok': True, 'written': 0, 'failed': 0, 'chunks': [], 'elapsed_s': 0.0}
+
+        offsets = []
+        offset = 0
+        for ops in batches:
+            offsets.append(offset)
+            offset += len(ops)
+
+        jobs = list(zip(range(len(batches)), offsets, batches))
+        if len(batches) == 1 or self._max_workers <= 1:
+            chunks = [self._commit_with_retry(*job) for job in jobs]
+        else:
+            # 同じ書き込み器を使う全セッションで max_workers 本のスレッドを共有する
+            chunks = list(self._pool().map(lambda job: self._commit_with_retry(*job), jobs))
+
+        written = sum(c['size'] for c in chunks if c['ok'])
+        failed = sum(c['size'] for c in chunks if not c['ok'])
+        return {
+            'ok': failed == 0,
+            'written': written,
+            'failed': failed,
+            'chunks': chunks,
+            'elapsed_s': round(time.perf_counter() - started, 4),
+        }
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """並列コミット用のスレッドプール（最初に必要になったときに作る）"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                    thread_name_prefix='bulk-writer')
+            return self._executor
+
+    def _commit_with_retry(self, index: int, offset: int, ops: List[Operation]) -> Dict[str, Any]:
+        attempts = 0
+        last_error: Optional[str] = None
+        while attempts <= self._max_retries:
+            attempts += 1
+            try:
+                batch = self._db.batch()
+                for kind, doc_ref, data in ops:
+                    if kind == 'delete':
+                        batch.delete(doc_ref)
+                    elif kind == 'update':
+                        batch.update(doc_ref, data)
+                    else:
+                        batch.set(doc_ref, data)
+                batch.commit()
+                return {'index': index, 'offset': offset, 'size': len(ops), 'ok': True,
+                        'attempts': attempts, 'error': None}
+            except RETRYABLE_ERRORS as e:
+                last_error = str(e)
+                print(f"⚠️ Batch {index} commit failed (attempt {attempts}): {e}")
+                if attempts <= self._max_retries:
+                    time.sleep(self._backoff_base_s * (2 ** (attempts - 1)))
+            except Exception as e:
+                # 引数不正など再試行しても成功しないエラー
+                last_error = str(e)
+                print(f"❌ Batch {index} commit failed (non-retryable): {e}")
+                break
+        return {'index': index, 'offset': offset, 'size': len(ops), 'ok': False,
+                'attempts': attempts, 'error': last_error}
@@ -0,0 +1,146 @@
+# focus_history.py
+"""
+重点ポイントの評価履歴（ユーザー×ピン単位の非正規化コレクション）機能モジュール
+過去の走行との比較のたびに全セッションを走査しないよう、focus_feedbacks を保存するときに
+直近 HISTORY_LIMIT 件の stats / rating をここにも書いておく。履歴の参照はドキュメント1件の読み込みで済む。
+
+Firestore構造:
+    focus_history/{user_id}_{pin_id}
+        user_id, pin_id, updated_at
+        entries: [{session_id, stats, rating, score, created_at, end_time}, ...]   新しい走行順
+
+既存データは backfill_focus_history.py で作成する。作成前のピンは従来どおり完了済みセッションを走査して
+履歴を求め（scan_focus_history）、最初の記録時にその結果からドキュメントを作る。
+セッションを削除したときは remove_session_history でそのセッションの記録を取り除く。
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from google.cloud import firestore
+
+
+FOCUS_HISTORY_COLLECTION = "focus_history"
+HISTORY_LIMIT = 10
+
+
+def history_doc_id(user_id: str, pin_id: str) -> str:
+    return f"{user_id}_{pin_id}"
+
+
+def is_comparable_stats(stats: Optional[Dict[str, Any]]) -> bool:
+    """比較に使える stats か（未通過・Gログ不足の NOT_PASSED_STATS は全て0）"""
+    return bool(stats) and any(v != 0 for v in stats.values())
+
+
+def make_entry(session_id: str, feedback: Dict[str, Any], end_time=None) -> Dict[str, Any]:
+    """focus_feedbacks のドキュメントから履歴1件分を作る"""
+    return {
+        "session_id": session_id,
+        "stats": feedback.get("stats"),
+        "rating": feedback.get("rating"),
+        "score": feedback.get("score"),
+        "created_at": feedback.get("created_at"),
+        "end_time": end_time,
+    }
+
+
+def _sort_key(entry: Dict[str, Any]) -> float:
+    moment = entry.get("end_time") or entry.get("created_at")
+    return moment.timestamp() if isinstance(moment, datetime) else 0.0
+
+
+def merge_entries(entries: List[Dict[str, Any]], new_entries: List[Dict[str, Any]],
+                  limit: int = HISTORY_LIMIT) -> List[Dict[str, Any]]:
+    """同じセッションの古い記録を置き換え、新しい走行順に並べて limit 件に切り詰める"""
+    replaced = {e["session_id"] for e in new_entries}
+    merged = [e for e in entries if e.get("session_id") not in replaced] + list(new_entries)
+    merged = [e for e in merged if is_comparable_stats(e.get("stats"))]
+    merged.sort(key=_sort_key, reverse=True)
+    return merged[:limit]
+
+
+def scan_focus_history(db, user_id: str, pin_id: str, limit: int = HISTORY_LIMIT) -> List[Dict[str, Any]]:
+    """
+    完了済みセッションの focus_feedbacks/{pin_id} を新しい順に走査して履歴を作る
+    （focus_history のドキュメントがまだ無いピン向けのフォールバック）
+    """
+    sessions = (
+        db.collection("sessions")
+        .where("user_id", "==", user_id)
+        .where("status", "==", "completed")
+        .order_by("end_time", direction=firestore.Query.DESCENDING)
+        .stream()
+    )
+    entries: List[Dict[str, Any]] = []
+    for sdoc in sessions:
+        fb_doc = sdoc.reference.collection("focus_feedbacks").document(pin_id).get()
+        if not fb_doc.exists:
+            continue
+        entry = make_entry(sdoc.id, fb_doc.to_dict(), sdoc.to_dict().get("end_time"))
+        if is_comparable_stats(entry.get("stats")):
+            entries.append(entry)
+            if len(entries) >= limit:
+                break
+    return merge_entries([], entries, limit)
+
+
+def record_focus_history(db, user_id: str, pin_id: str, entry: Dict[str, Any],
+                         limit: int = HISTORY_LIMIT) -> None:
+    """
+    履歴に1件追加する（同じセッションの再解析は上書き）
+    ピンごとに別ドキュメントなので、並列評価しても同じドキュメントを取り合わない。
+    ドキュメントがまだ無い場合は、既存のセッションを走査した履歴に足して作る。
+    """
+    if not is_comparable_stats(entry.get("stats")):
+        return
+    doc_ref = db.collection(FOCUS_HISTORY_COLLECTION).document(history_doc_id(user_id, pin_id))
+
+    @firestore.transactional
+    def _update(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if snapshot.exists:
+            entries = (snapshot.to_dict() or {}).get("entries", [])
+        else:
+            entries = scan_focus_history(db, user_id, pin_id, limit)
+        transaction.set(doc_ref, {
+            "user_id": user_id,
+            "pin_id": pin_id,
+            "entries": merge_entries(entries, [entry], limit),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+
+    _update(db.transaction())
+
+
+def load_focus_history(db, user_id: str, pin_id: str, exclude_session_id: Optional[str] = None,
+                       limit: int = 3) -> List[Dict[str, Any]]:
+    """直近 limit 件の履歴（exclude_session_id の走行は除く。ドキュメントが無ければ走査する）"""
+    snapshot = db.collection(FOCUS_HISTORY_COLLECTION).document(history_doc_id(user_id, pin_id)).get()
+    if snapshot.exists:
+        entries = (snapshot.to_dict() or {}).get("entries", [])
+    else:
+        entries = scan_focus_history(db, user_id, pin_id, limit + 1)
+    return [e for e in entries if e.get("session_id") != exclude_session_id][:limit]
+
+
+def remove_session_history(db, user_id: str, session_id: str, pin_ids: List[str]) -> int:
+    """削除したセッションの記録を各ピンの履歴から取り除き、更新したドキュメント数を返す"""
+    updated = 0
+    for pin_id in pin_ids:
+        doc_ref = db.collection(FOCUS_HISTORY_COLLECTION).document(history_doc_id(user_id, pin_id))
+
+        @firestore.transactional
+        def _remove(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            entries = (snapshot.to_dict() or {}).get("entries", [])
+            kept = [e for e in entries if e.get("session_id") != session_id]
+            if len(kept) == len(entries):
+                return False
+            transaction.update(doc_ref, {"entries": kept, "updated_at": firestore.SERVER_TIMESTAMP})
+            return True
+
+        if _remove(db.transaction()):
+            updated += 1
+    return updated
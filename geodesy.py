@@ -0,0 +1,284 @@
+# geodesy.py
+"""
+GPS座標の距離計算・ノイズ除去機能モジュール（NumPyでベクトル化）
+走行距離（終了処理・集計）、重点ポイントの通過判定で共通に使う。
+
+- haversine_km                 配列同士のハバースイン距離
+- segment_distances_km         連続する点の間の距離
+- cumulative_distance_km       軌跡に沿った累積距離
+- point_speeds_kmh             連続する点の間の速度（距離 / 時間差）
+- filter_track                 無効点・飛び（ジャンプ）・停車中のふらつきを除く
+- track_distance_km            filter_track を通した軌跡の距離
+- nearest_point                指定座標に最も近い点
+- TrackIndex                   軌跡の格子インデックス（半径内の通過区間を入退出時刻つきで返す）
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0
+
+# 品質ラベルがこれらの点は距離計算に使わない
+REJECTED_QUALITIES = frozenset({'bad', 'poor', 'low', 'invalid'})
+
+# この速度を超える移動は測位の飛びとみなす（km/h）
+MAX_PLAUSIBLE_SPEED_KMH = 250.0
+# この速度未満で、直前の採用点からの距離がこの距離未満なら停車中のふらつきとみなす
+STATIONARY_SPEED_KMH = 3.0
+STATIONARY_JITTER_M = 5.0
+
+# (0, 0) 付近は測位失敗の既定値
+_NULL_ISLAND_DEG = 0.0001
+_MAX_JUMP_PASSES = 3
+# 停車中のふらつきを判定するときに一度に距離を求める点数（見つからなければ倍にする）
+_JITTER_WINDOW = 32
+
+
+# ===== 距離・速度 =====
+def haversine_km(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """配列同士（スカラーも可）のハバースイン距離（km）"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def segment_distances_km(lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    """連続する点の間の距離（長さ n-1）"""
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    if len(lat) < 2:
+        return np.empty(0, dtype=np.float64)
+    return haversine_km(lat[:-1], lng[:-1], lat[1:], lng[1:])
+
+
+def cumulative_distance_km(lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    """先頭からの累積距離（長さ n、先頭は 0）"""
+    distances = segment_distances_km(lat, lng)
+    return np.concatenate([np.zeros(min(len(lat), 1)), np.cumsum(distances)])
+
+
+def point_speeds_kmh(lat: np.ndarray, lng: np.ndarray, timestamp_ms: np.ndarray) -> np.ndarray:
+    """連続する点の間の速度（長さ n-1）。時間差が 0 以下の区間は NaN"""
+    distances = segment_distances_km(lat, lng)
+    dt_h = np.diff(np.asarray(timestamp_ms, dtype=np.float64)) / 3_600_000.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(dt_h > 0, distances / np.where(dt_h > 0, dt_h, 1.0), np.nan)
+
+
+# ===== ノイズ除去 =====
+def filter_track(lat: np.ndarray, lng: np.ndarray, timestamp_ms: Optional[np.ndarray] = None,
+                 speed: Optional[np.ndarray] = None, quality: Optional[np.ndarray] = None,
+                 max_speed_kmh: float = MAX_PLAUSIBLE_SPEED_KMH,
+                 stationary_speed_kmh: float = STATIONARY_SPEED_KMH,
+                 stationary_jitter_m: float = STATIONARY_JITTER_M) -> np.ndarray:
+    """
+    距離計算に使う点のマスク（True = 採用）を返す。点は時刻順に並んでいること。
+
+    1. 非数・範囲外・(0, 0)・品質ラベルが REJECTED_QUALITIES の点を除く
+    2. 前後どちらの点からも max_speed_kmh を超える速さで離れている点（1点だけの飛び）を除く
+       （timestamp_ms がある場合のみ。除いた結果で新たに飛びになる点のため数回繰り返す）
+    3. 停車中（報告速度 < stationary_speed_kmh）に、直前の採用点から stationary_jitter_m 未満しか
+       動いていない点を除く（speed が無い場合は区間速度で判定する。徐行も採用点の間の距離として残る）
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    keep = (
+        np.isfinite(lat) & np.isfinite(lng)
+        & (np.abs(lat) <= 90.0) & (np.abs(lng) <= 180.0)
+        & ~((np.abs(lat) < _NULL_ISLAND_DEG) & (np.abs(lng) < _NULL_ISLAND_DEG))
+    )
+    if quality is not None and len(quality):
+        keep &= ~np.isin(np.asarray(quality).astype(str), list(REJECTED_QUALITIES))
+
+    ts = np.asarray(timestamp_ms, dtype=np.float64) if timestamp_ms is not None else None
+    if ts is not None:
+        for _ in range(_MAX_JUMP_PASSES):
+            index = np.flatnonzero(keep)
+            if len(index) < 3:
+                break
+            too_fast = point_speeds_kmh(lat[index], lng[index], ts[index]) > max_speed_kmh
+            # 区間 i-1→i と i→i+1 の両方が速すぎる点 i が飛び
+            # 末尾は直前の区間だけで判定する（直前の点が飛びの場合は末尾を残す）
+            jump = np.zeros(len(index), dtype=bool)
+            jump[1:-1] = too_fast[:-1] & too_fast[1:]
+            jump[-1] = too_fast[-1] and not jump[-2]
+            if not jump.any():
+                break
+            keep[index[jump]] = False
+
+    index = np.flatnonzero(keep)
+    if len(index) >= 2:
+        if speed is not None:
+            slow = np.asarray(speed, dtype=np.float64)[index[1:]] < stationary_speed_kmh
+        elif ts is not None:
+            slow = ~(point_speeds_kmh(lat[index], lng[index], ts[index]) >= stationary_speed_kmh)
+        else:
+            slow = np.ones(len(index) - 1, dtype=bool)
+        keep[index[1:][_stationary_jitter(lat[index], lng[index], slow, stationary_jitter_m)]] = False
+    return keep
+
+
+def _stationary_jitter(lat: np.ndarray, lng: np.ndarray, slow: np.ndarray, jitter_m: float) -> np.ndarray:
+    """
+    点 1..n-1 のうち、直前の採用点から jitter_m 未満しか離れていない低速の点（長さ n-1 のマスク）
+    低速でない点は必ず採用するので、低速の点が続く区間ごとに、区間の直前の点を起点として
+    「起点から jitter_m 以上離れた最初の点を採用して起点にする」を繰り返す
+    （1点ごとの移動が小さい徐行でも、採用点の間の距離として積み上がる）。
+    """
+    jitter = np.zeros(len(slow), dtype=bool)
+    if not slow.any():
+        return jitter
+    # 低速の点が続く区間 [start, end)（点の番号は 1..n-1、slow[i-1] が点 i）
+    edges = np.diff(np.concatenate(([0], slow.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1) + 1
+    ends = np.flatnonzero(edges == -1) + 1
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        origin = start - 1
+        window = _JITTER_WINDOW
+        while start < end:
+            # 起点から順に窓を広げながら探す（長い停車で区間全体との距離を毎回計算しない）
+            stop = min(start + window, end)
+            distance_m = haversine_km(lat[start:stop], lng[start:stop], lat[origin], lng[origin]) * 1000.0
+            far = np.flatnonzero(distance_m >= jitter_m)
+            if len(far) == 0:
+                jitter[start - 1:stop - 1] = True
+                start = stop
+                window *= 2
+                continue
+            jitter[start - 1:start - 1 + far[0]] = True
+            origin = start + int(far[0])
+            start = origin + 1
+            window = _JITTER_WINDOW
+    return jitter
+
+
+def track_distance_km(lat: np.ndarray, lng: np.ndarray, timestamp_ms: Optional[np.ndarray] = None,
+                      speed: Optional[np.ndarray] = None, quality: Optional[np.ndarray] = None) -> float:
+    """ノイズを除いた軌跡の距離（km）"""
+    keep = filter_track(lat, lng, timestamp_ms, speed, quality)
+    return float(segment_distances_km(np.asarray(lat)[keep], np.asarray(lng)[keep]).sum())
+
+
+# ===== 近傍検索 =====
+def nearest_point(lat: np.ndarray, lng: np.ndarray, target_lat: float, target_lng: float,
+                  mask: Optional[np.ndarray] = None) -> Tuple[int, float]:
+    """
+    (target_lat, target_lng) に最も近い点の (index, 距離m) を返す
+    点が無い場合は (-1, inf)
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    candidates = np.flatnonzero(mask) if mask is not None else np.arange(len(lat))
+    if len(candidates) == 0:
+        return -1, float('inf')
+    distances_m = haversine_km(lat[candidates], lng[candidates], target_lat, target_lng) * 1000.0
+    best = int(np.argmin(distances_m))
+    return int(candidates[best]), float(distances_m[best])
+
+
+# ===== 軌跡の空間インデックス =====
+@dataclass
+class Passage:
+    """ある地点の半径内を通過した1回分の区間"""
+    entry_ms: int          # 半径に入った最初の点の時刻
+    exit_ms: int           # 半径内の最後の点の時刻
+    closest_ms: int        # 最接近点の時刻
+    closest_m: float       # 最接近距離（m）
+    closest_index: int     # 最接近点の元配列でのインデックス
+    points: int            # 半径内の点数
+
+
+class TrackIndex:
+    """
+    1セッションの軌跡に対する一様格子インデックス
+    緯度経度を軌跡の平均緯度での正距円筒図法でメートルに投影し、cell_m 四方のセルに分ける。
+    半径検索は周囲のセルの候補点だけをハバースイン距離で確かめる。
+    """
+
+    def __init__(self, lat: np.ndarray, lng: np.ndarray, timestamp_ms: np.ndarray,
+                 mask: Optional[np.ndarray] = None, cell_m: float = 50.0):
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        ts = np.asarray(timestamp_ms, dtype=np.int64)
+        # 対象の点（元配列でのインデックス。時刻順であること）
+        self._source = np.flatnonzero(mask) if mask is not None else np.arange(len(lat))
+        self._lat = lat[self._source]
+        self._lng = lng[self._source]
+        self._ts = ts[self._source]
+        self._cell_m = float(cell_m)
+        self._lat0 = float(np.radians(self._lat.mean())) if len(self._lat) else 0.0
+
+        ix, iy = self._cells(self._lat, self._lng)
+        order = np.lexsort((iy, ix))
+        keys = np.stack([ix[order], iy[order]], axis=1)
+        self._order = order
+        self._buckets: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        if len(order):
+            starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+            bounds = np.concatenate([[0], starts, [len(order)]])
+            for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                self._buckets[(int(keys[lo, 0]), int(keys[lo, 1]))] = (lo, hi)
+
+    def __len__(self) -> int:
+        return len(self._source)
+
+    def _project(self, lat, lng) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.radians(lng) * np.cos(self._lat0) * EARTH_RADIUS_KM * 1000.0
+        y = np.radians(lat) * EARTH_RADIUS_KM * 1000.0
+        return x, y
+
+    def _cells(self, lat, lng) -> Tuple[np.ndarray, np.ndarray]:
+        x, y = self._project(np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64))
+        return np.floor(x / self._cell_m).astype(np.int64), np.floor(y / self._cell_m).astype(np.int64)
+
+    def query_radius(self, lat: float, lng: float, radius_m: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        半径 radius_m 以内の点を返す
+
+        Returns:
+            (インデックス内の位置（時刻順）, 距離m)
+        """
+        if not len(self._source):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        cx, cy = self._cells(lat, lng)
+        # 投影の誤差の分だけ1セル余分に見る
+        reach = int(np.ceil(radius_m / self._cell_m)) + 1
+        parts = []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                bucket = self._buckets.get((int(cx) + dx, int(cy) + dy))
+                if bucket is not None:
+                    parts.append(self._order[bucket[0]:bucket[1]])
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        candidates = np.sort(np.concatenate(parts))
+        distances_m = haversine_km(self._lat[candidates], self._lng[candidates], lat, lng) * 1000.0
+        inside = distances_m <= radius_m
+        return candidates[inside], distances_m[inside]
+
+    def passages(self, lat: float, lng: float, radius_m: float, max_gap_ms: int = 30_000) -> List[Passage]:
+        """
+        半径内を通過した区間を時刻順に返す
+        半径外の点を挟んだ場合、または max_gap_ms を超えて測位が途切れた場合は別の通過とみなす。
+        """
+        positions, distances_m = self.query_radius(lat, lng, radius_m)
+        if not len(positions):
+            return []
+        ts = self._ts[positions]
+        breaks = np.flatnonzero((np.diff(positions) > 1) | (np.diff(ts) > max_gap_ms)) + 1
+        bounds = np.concatenate([[0], breaks, [len(positions)]])
+
+        result = []
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            best = lo + int(np.argmin(distances_m[lo:hi]))
+            result.append(Passage(
+                entry_ms=int(ts[lo]),
+                exit_ms=int(ts[hi - 1]),
+                closest_ms=int(ts[best]),
+                closest_m=float(distances_m[best]),
+                closest_index=int(self._source[positions[best]]),
+                points=hi - lo,
+            ))
+        return result
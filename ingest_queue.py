@@ -0,0 +1,269 @@
+# ingest_queue.py
+"""
+テレメトリ書き込みの Write-Behind キュー機能モジュール
+受信エンドポイントは検証済みの列データをキューに積んで即座に 202 を返し、
+バックグラウンドのライタースレッドが Firestore への書き込みを行う。
+
+- セッションIDのハッシュでライターを固定するため、同一セッションの書き込み順序は保たれる
+- ライターは同一セッションの複数バッチを結合し、時間またはサンプル数の上限で書き込む
+- 書き込みに失敗したセッションの分は指数バックオフで max_attempts 回まで書き直す。
+  それでも失敗した場合は aggregates.dirty を立て、終了時に保存済みの全件から再計算させる
+  （保存済み連番 ingest_cursor は抜けの手前で止まるので、端末が未保存の点を捨てることはない）
+- shutdown() はキューを空にしてから停止する（atexit で自動的に呼ばれる）
+"""
+import atexit
+import queue
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class _FlushRequest:
+    """特定セッションの保留分を即時に書き込ませるためのマーカー"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.done = threading.Event()
+        self.ok = True
+
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """セッション単位で結合しながら非同期に書き込むキュー"""
+
+    def __init__(self, chunk_writer, num_workers: int = 2, max_queue_items: int = 2000,
+                 flush_interval_s: float = 2.0, flush_max_samples: int = 5000,
+                 max_attempts: int = 3, backoff_base_s: float = 0.5):
+        self._chunk_writer = chunk_writer
+        self._num_workers = num_workers
+        self._max_attempts = max_attempts
+        self._backoff_base_s = backoff_base_s
+        self._flush_interval_s = flush_interval_s
+        self._flush_max_samples = flush_max_samples
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=max_queue_items) for _ in range(num_workers)]
+        self._threads: List[threading.Thread] = []
+        self._oldest_pending: List[Optional[float]] = [None] * num_workers
+        self._pending_samples: List[int] = [0] * num_workers
+        self._lock = threading.Lock()
+        self._running = False
+        self._counters = {
+            'enqueued_batches': 0,
+            'enqueued_samples': 0,
+            'rejected_batches': 0,
+            'written_samples': 0,
+            'failed_samples': 0,
+            'flushes': 0,
+            'retried_flushes': 0,
+        }
+
+    # ----- ライフサイクル -----
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        for index in range(self._num_workers):
+            thread = threading.Thread(target=self._worker, args=(index,), name=f"ingest-writer-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.shutdown)
+        print(f"🚚 Write-behind ingest queue started ({self._num_workers} writers)")
+
+    def shutdown(self, timeout: float = 30.0) -> None:
+        """キューに残ったデータを書き込んでからライターを停止する"""
+        if not self._running:
+            return
+        self._running = False
+        deadline = time.monotonic() + timeout
+        for index, q in enumerate(self._queues):
+            try:
+                # 満杯でもライターが取り出して空きができる。待ちきれない場合は終了を優先する
+                q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                print(f"⚠️ Write-behind writer {index} queue still full at shutdown; "
+                      f"{q.qsize()} batches not written")
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        print(f"🛑 Write-behind ingest queue stopped: {self.stats()}")
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    # ----- 投入 -----
+    def enqueue(self, session_id: str, session_ref, columns_by_stream: Dict[str, Dict[str, np.ndarray]]) -> bool:
+        """
+        列データをキューに積む。キューが満杯の場合は False を返す（呼び出し側で 503 にする）
+        """
+        samples = sum(len(c['timestamp_ms']) for c in columns_by_stream.values())
+        item = {
+            'session_id': session_id,
+            'session_ref': session_ref,
+            'columns': columns_by_stream,
+            'samples': samples,
+            'enqueued_at': time.monotonic(),
+        }
+        try:
+            self._queues[self._shard(session_id)].put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected_batches'] += 1
+            return False
+        with self._lock:
+            self._counters['enqueued_batches'] += 1
+            self._counters['enqueued_samples'] += samples
+        return True
+
+    def flush_session(self, session_id: str, timeout: float = 10.0) -> bool:
+        """
+        指定セッションについて、これまでに積まれた分の書き込み完了を待つ
+        （セッション終了時に、集計の前に呼ぶ）
+        再試行しても書き込めなかった分がある場合も False を返す。
+        """
+        if not self._running:
+            return True
+        request = _FlushRequest(session_id)
+        try:
+            self._queues[self._shard(session_id)].put(request, timeout=timeout)
+        except queue.Full:
+            return False
+        return request.done.wait(timeout) and request.ok
+
+    # ----- 監視 -----
+    def stats(self) -> Dict[str, Any]:
+        """キュー深さ・遅延などの運用向け指標"""
+        now = time.monotonic()
+        oldest = []
+        depth = 0
+        for index, q in enumerate(self._queues):
+            depth += q.qsize()
+            with q.mutex:
+                head = next((item for item in q.queue if isinstance(item, dict)), None)
+            if head is not None:
+                oldest.append(head['enqueued_at'])
+            if self._oldest_pending[index] is not None:
+                oldest.append(self._oldest_pending[index])
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            'running': self._running,
+            'workers': self._num_workers,
+            'queue_depth': depth,
+            'pending_samples': sum(self._pending_samples),
+            'lag_s': round(now - min(oldest), 3) if oldest else 0.0,
+            **counters,
+        }
+
+    # ----- ライター -----
+    def _shard(self, session_id: str) -> int:
+        return zlib.crc32(session_id.encode('utf-8')) % self._num_workers
+
+    def _worker(self, index: int) -> None:
+        q = self._queues[index]
+        pending: Dict[str, Dict[str, Any]] = {}
+        stopping = False
+
+        while True:
+            try:
+                item = q.get(timeout=self._flush_interval_s / 2)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                stopping = True
+            elif isinstance(item, _FlushRequest):
+                # セッション終了を待たせているので、バックオフを待ちながらこの場で書き直す
+                entry = pending.pop(item.session_id, None)
+                while entry is not None:
+                    time.sleep(max(0.0, entry.get('retry_at', 0.0) - time.monotonic()))
+                    retry = self._flush(index, entry)
+                    if retry is None and entry.get('gave_up'):
+                        item.ok = False
+                    entry = retry
+                item.done.set()
+            elif item is not None:
+                entry = pending.setdefault(item['session_id'], {
+                    'session_id': item['session_id'],
+                    'session_ref': item['session_ref'],
+                    'columns': {},
+                    'samples': 0,
+                    'first_enqueued_at': item['enqueued_at'],
+                })
+                for stream, columns in item['columns'].items():
+                    entry['columns'].setdefault(stream, []).append(columns)
+                entry['samples'] += item['samples']
+
+            # 時間またはサンプル数の上限に達したセッションを書き込む（再試行待ちはバックオフ後）
+            now = time.monotonic()
+            for session_id in list(pending):
+                entry = pending[session_id]
+                if now < entry.get('retry_at', 0.0):
+                    continue
+                if (stopping or entry['samples'] >= self._flush_max_samples
+                        or now - entry['first_enqueued_at'] >= self._flush_interval_s):
+                    retry = self._flush(index, pending.pop(session_id))
+                    if retry is not None:
+                        pending[session_id] = retry
+
+            self._oldest_pending[index] = min(
+                (e['first_enqueued_at'] for e in pending.values()), default=None
+            )
+            self._pending_samples[index] = sum(e['samples'] for e in pending.values())
+
+            # 停止マーカー以降に残っている分も書き込んでから終了する
+            if stopping and q.empty() and not pending:
+                return
+
+    def _flush(self, index: int, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        セッションの保留分を書き込む。再試行する場合はバックオフ後の時刻を付けた entry を返す
+        （チャンクIDは内容から決まり、集計は連番で重複を除くので、全体を書き直してよい）
+        """
+        merged = {
+            stream: {name: np.concatenate([c[name] for c in parts]) for name in parts[0]}
+            for stream, parts in entry['columns'].items()
+        }
+        try:
+            result = self._chunk_writer.write_many(entry['session_ref'], merged)
+            written = sum(result['saved_counts'].values())
+        except Exception as e:
+            print(f"❌ Write-behind flush failed for session {entry['session_id']}: {e}")
+            written = 0
+        with self._lock:
+            self._counters['flushes'] += 1
+        if written >= entry['samples']:
+            with self._lock:
+                self._counters['written_samples'] += written
+            return None
+
+        attempts = entry.get('attempts', 0) + 1
+        if attempts < self._max_attempts:
+            delay = self._backoff_base_s * (2 ** (attempts - 1))
+            with self._lock:
+                self._counters['retried_flushes'] += 1
+            print(f"⚠️ Write-behind: {entry['samples'] - written} samples not persisted "
+                  f"for session {entry['session_id']} (attempt {attempts}/{self._max_attempts}), "
+                  f"retrying in {delay:.1f}s")
+            return dict(entry, attempts=attempts, retry_at=time.monotonic() + delay)
+
+        with self._lock:
+            self._counters['written_samples'] += written
+            self._counters['failed_samples'] += entry['samples'] - written
+        print(f"❌ Write-behind: giving up {entry['samples'] - written} samples "
+              f"for session {entry['session_id']} after {attempts} attempts")
+        entry['gave_up'] = True
+        self._mark_dirty(entry)
+        return None
+
+    @staticmethod
+    def _mark_dirty(entry: Dict[str, Any]) -> None:
+        """受信済み（202）の点を保存できなかったので、集計・スコアの途中状態を使わせない"""
+        try:
+            entry['session_ref'].update({'aggregates.dirty': True, 'score_state': None})
+        except Exception as e:
+            print(f"❌ Failed to mark aggregates dirty for session {entry['session_id']}: {e}")
@@ -0,0 +1,144 @@
+# jerk.py
+"""
+ジャーク（加加速度）計算機能モジュール（NumPyでベクトル化）
+固定の dt（1 / サンプリングレート）ではなく実際の timestamp_ms の間隔で微分する。
+
+- valid_sample_mask      時刻が前の点から進んでいない点（重複・逆行）を除くマスク
+- segment_ids            時間差が max_gap_ms を超えたところで区切った区間番号
+- uniform_grid           再サンプリングの格子（秒）
+- resample_uniform       区間ごとに一定間隔の格子へ再サンプリング（格子点ごとに平均してから補間）
+- jerk_series            区間をまたがない差分で求めたジャーク列
+
+アップロードの途切れ・端末の間引き・60Hz端末などでサンプル間隔が一定でなくても、
+ジャークの値は実際の時間差で求まる。resample_hz を指定するとイベント数（閾値超えのサンプル数）も
+端末のサンプリングレートによらず同じ格子で数えられる。
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+# この時間差（ms）を超えたら別の区間として扱う（区間をまたいでは微分しない）
+DEFAULT_MAX_GAP_MS = 1000.0
+
+
+@dataclass
+class JerkSeries:
+    """区間ごとに求めたジャーク（各チャンネルは全区間を連結した配列）"""
+    jerks: List[np.ndarray]     # 入力チャンネルと同じ順
+    segments: int               # 2点以上ある区間の数
+    gaps: int                   # max_gap_ms を超えた途切れの数
+    duration_s: float           # 区間の長さの合計（途切れは含まない）
+    samples: int                # 計算に使ったサンプル数（再サンプリング後）
+    timestamps_ms: Optional[np.ndarray] = None  # 各ジャークの時刻（差分の後ろ側の点。区間ごとの集計用）
+
+
+def valid_sample_mask(timestamp_ms: np.ndarray) -> np.ndarray:
+    """直前に残した点より時刻が進んでいる点だけ True（先頭は常に True）"""
+    ts = np.asarray(timestamp_ms, dtype=float)
+    if len(ts) == 0:
+        return np.zeros(0, dtype=bool)
+    # 累積最大より大きい点だけを残すと、重複・逆行した点が落ちる
+    running_max = np.maximum.accumulate(ts)
+    mask = np.ones(len(ts), dtype=bool)
+    mask[1:] = ts[1:] > running_max[:-1]
+    return mask
+
+
+def segment_ids(timestamp_ms: np.ndarray, max_gap_ms: float = DEFAULT_MAX_GAP_MS) -> np.ndarray:
+    """時間差が max_gap_ms を超えるごとに1増える区間番号（時刻は昇順であること）"""
+    ts = np.asarray(timestamp_ms, dtype=float)
+    if len(ts) == 0:
+        return np.zeros(0, dtype=int)
+    ids = np.zeros(len(ts), dtype=int)
+    ids[1:] = np.cumsum(np.diff(ts) > max_gap_ms)
+    return ids
+
+
+def _bin_means(t_s: np.ndarray, values: np.ndarray, rate_hz: float):
+    bins = np.rint((t_s - t_s[0]) * rate_hz).astype(np.int64)
+    counts = np.bincount(bins)
+    filled = counts > 0
+    return (np.bincount(bins, weights=t_s)[filled] / counts[filled],
+            np.bincount(bins, weights=values)[filled] / counts[filled])
+
+
+def uniform_grid(t_s: np.ndarray, rate_hz: float) -> np.ndarray:
+    """resample_uniform が値を返す格子の時刻（秒）"""
+    t_s = np.asarray(t_s, dtype=float)
+    mean_t, _ = _bin_means(t_s, t_s, rate_hz)
+    return mean_t[0] + np.arange(int(np.floor((mean_t[-1] - mean_t[0]) * rate_hz)) + 1) / rate_hz
+
+
+def resample_uniform(t_s: np.ndarray, values: np.ndarray, rate_hz: float) -> np.ndarray:
+    """
+    1区間分の値を 1 / rate_hz 間隔の格子に再サンプリングする
+    区間の先頭からの時刻を格子点に丸めて（最も近い格子点ごとに）時刻・値を平均し、その平均点を線形補間する。
+    サンプルの方が細かければ平均で間引きによる折り返しを抑え、粗ければ元の点をそのまま補間する。
+    平均時刻で補間するので、格子点の前後でサンプル数が偏っても傾きは歪まない。
+    格子は最初の平均点から始まり、最後の平均点を超えない（端の値に張り付かない）。
+
+    ビンの割り当ては区間の先頭時刻だけで決まるので、online_score で受信バッチごとに
+    逐次計算しても同じ格子・同じ値になる。
+    """
+    t_s = np.asarray(t_s, dtype=float)
+    mean_t, mean_v = _bin_means(t_s, np.asarray(values, dtype=float), rate_hz)
+    grid = mean_t[0] + np.arange(int(np.floor((mean_t[-1] - mean_t[0]) * rate_hz)) + 1) / rate_hz
+    return np.interp(grid, mean_t, mean_v)
+
+
+def jerk_series(timestamp_ms: np.ndarray, channels: Sequence[np.ndarray],
+                max_gap_ms: float = DEFAULT_MAX_GAP_MS, resample_hz: Optional[float] = None) -> JerkSeries:
+    """
+    各チャンネル（加速度, G）のジャーク（G/s）を実際の時間差で求める
+    max_gap_ms を超える途切れでは区切り、区間をまたいだ差分は使わない。
+    resample_hz を指定すると、区間ごとに一定間隔の格子へ再サンプリングしてから微分する。
+    """
+    mask = valid_sample_mask(timestamp_ms)
+    ts = np.asarray(timestamp_ms, dtype=float)[mask]
+    channels = [np.asarray(c, dtype=float)[mask] for c in channels]
+    if len(ts) < 2:
+        return JerkSeries([np.zeros(0) for _ in channels], 0, 0, 0.0, len(ts), np.zeros(0))
+
+    ids = segment_ids(ts, max_gap_ms)
+    gaps = int(ids[-1])
+    t_s = (ts - ts[0]) / 1000.0
+
+    if resample_hz is None:
+        # 区間内の隣り合う点の差分だけを使う（途切れをまたぐ差分を落とす）
+        dt = np.diff(t_s)
+        same_segment = ids[1:] == ids[:-1]
+        jerks = [np.diff(c)[same_segment] / dt[same_segment] for c in channels]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        ends = np.r_[starts[1:], len(ts)] - 1
+        lengths = ends - starts
+        return JerkSeries(
+            jerks=jerks,
+            segments=int(np.count_nonzero(lengths > 0)),
+            gaps=gaps,
+            duration_s=float(np.sum(t_s[ends] - t_s[starts])),
+            samples=len(ts),
+            timestamps_ms=ts[1:][same_segment],
+        )
+
+    # 区間ごとに格子へ再サンプリングしてから一定の dt で微分する
+    dt = 1.0 / float(resample_hz)
+    parts = [[] for _ in channels]
+    times = []
+    segments = samples = 0
+    duration_s = 0.0
+    bounds = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1], True])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if hi - lo < 2:
+            continue
+        segments += 1
+        duration_s += float(t_s[hi - 1] - t_s[lo])
+        for part, channel in zip(parts, channels):
+            resampled = resample_uniform(t_s[lo:hi], channel[lo:hi], resample_hz)
+            part.append(np.diff(resampled) / dt)
+        times.append(ts[0] + uniform_grid(t_s[lo:hi], resample_hz)[1:] * 1000.0)
+        samples += len(parts[0][-1]) + 1
+    jerks = [np.concatenate(part) if part else np.zeros(0) for part in parts]
+    timestamps_ms = np.concatenate(times) if times else np.zeros(0)
+    return JerkSeries(jerks, segments, gaps, duration_s, samples, timestamps_ms)
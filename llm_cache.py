@@ -0,0 +1,168 @@
+# llm_cache.py
+"""
+LLM応答キャッシュ機能モジュール
+同じモデル・同じプロンプト（空白を正規化したもの）への応答を保存し、
+データの変わっていないセッションのフィードバック再生成で Gemini を呼ばないようにする。
+
+- メモリ層: プロセス内の TTLCache（LRU）
+- ディスク層: SQLite（同じマシンの複数ワーカープロセスで共有。WALモード）
+  件数が上限を超えたら最終アクセスの古い順に削除し、期限切れは読み込み時・書き込み時に削除する
+
+キー = sha256(モデル名 + 正規化したプロンプト)
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from ttl_cache import TTLCache
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm_cache.db')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """行頭・行末の空白と空行を取り除く（インデントだけ違うプロンプトを同じキーにする）"""
+    return '\n'.join(line.strip() for line in prompt.splitlines() if line.strip())
+
+
+def prompt_fingerprint(model_name: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model_name}\n{normalize_prompt(prompt)}".encode('utf-8')).hexdigest()
+
+
+# ===== ディスク層 =====
+class SQLiteResponseStore:
+    """SQLite の応答ストア（1プロセス1接続をロックで共有する）"""
+
+    def __init__(self, path: str, max_entries: int = 20_000, ttl_s: float = 7 * 24 * 3600.0):
+        self._path = path
+        self._max_entries = max_entries
+        self._ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                ' key TEXT PRIMARY KEY, model TEXT, response TEXT,'
+                ' created_at REAL, expires_at REAL, last_access REAL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)')
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT response, expires_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key: str, model_name: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, expires_at, last_access)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model_name, response, now, now + self._ttl_s, now),
+            )
+            self._conn.execute('DELETE FROM llm_cache WHERE expires_at < ?', (now,))
+            # 件数上限を超えた分を、最終アクセスの古い順に削除
+            self._conn.execute(
+                'DELETE FROM llm_cache WHERE key IN ('
+                ' SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                (self._max_entries,),
+            )
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0])
+
+
+# ===== 2層キャッシュ =====
+class LLMResponseCache:
+    """メモリ → SQLite の順に引く応答キャッシュ（SQLite が使えない場合はメモリのみ）"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_CACHE_PATH, memory_entries: int = 512,
+                 disk_entries: int = 20_000, ttl_s: float = 7 * 24 * 3600.0):
+        self._memory = TTLCache(max_entries=memory_entries, ttl_s=ttl_s)
+        self._disk: Optional[SQLiteResponseStore] = None
+        if path:
+            try:
+                self._disk = SQLiteResponseStore(path, max_entries=disk_entries, ttl_s=ttl_s)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache database unavailable ({e}); using in-memory cache only")
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'errors': 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, model_name: str, prompt: str) -> Optional[str]:
+        key = prompt_fingerprint(model_name, prompt)
+        response = self._memory.get(key)
+        if response is not None:
+            self._count('memory_hits')
+            return response
+        if self._disk is not None:
+            try:
+                response = self._disk.get(key)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache read error: {e}")
+                self._count('errors')
+                response = None
+            if response is not None:
+                self._memory.set(key, response)
+                self._count('disk_hits')
+                return response
+        self._count('misses')
+        return None
+
+    def set(self, model_name: str, prompt: str, response: str) -> None:
+        key = prompt_fingerprint(model_name, prompt)
+        self._memory.set(key, response)
+        if self._disk is not None:
+            try:
+                self._disk.set(key, model_name, response)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache write error: {e}")
+                self._count('errors')
+                return
+        self._count('stores')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters['memory_hits'] + counters['disk_hits'] + counters['misses']
+        return {
+            **counters,
+            'hit_rate': round((counters['memory_hits'] + counters['disk_hits']) / lookups, 3) if lookups else 0.0,
+            'memory': self._memory.stats(),
+            'disk_entries': self._disk.count() if self._disk is not None else None,
+        }
+
+
+def create_llm_cache() -> Optional[LLMResponseCache]:
+    """環境変数から作る（LLM_CACHE_DISABLED=1 で無効、LLM_CACHE_PATH を空にするとメモリのみ）"""
+    if os.getenv('LLM_CACHE_DISABLED', '0') == '1':
+        return None
+    return LLMResponseCache(
+        path=os.getenv('LLM_CACHE_PATH', DEFAULT_CACHE_PATH) or None,
+        memory_entries=int(os.getenv('LLM_CACHE_MEMORY_ENTRIES', '512')),
+        disk_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', '20000')),
+        ttl_s=float(os.getenv('LLM_CACHE_TTL_S', str(7 * 24 * 3600))),
+    )
@@ -0,0 +1,76 @@
+"""
+旧形式（1サンプル1ドキュメント）のテレメトリをチャンク形式に変換するスクリプト
+
+使い方:
+    python migrate_telemetry_chunks.py                 # 全セッションを変換（旧データは残す）
+    python migrate_telemetry_chunks.py --delete-legacy # 変換後に旧ドキュメントを削除
+    python migrate_telemetry_chunks.py --session <id>  # 指定セッションのみ
+"""
+import argparse
+from google.cloud import firestore
+from bulk_writer import FirestoreBulkWriter
+from telemetry_store import (
+    CHUNK_COLLECTIONS,
+    STREAM_SCHEMAS,
+    TelemetryChunkWriter,
+    load_legacy_columns,
+)
+
+
+def migrate_session(db, session_ref, writer, delete_legacy=False):
+    """1セッション分を変換して、ストリームごとの変換件数を返す"""
+    migrated = {}
+    for stream in STREAM_SCHEMAS:
+        # すでにチャンクがあるストリームは変換済みとみなす
+        if list(session_ref.collection(CHUNK_COLLECTIONS[stream]).limit(1).stream()):
+            continue
+
+        columns = load_legacy_columns(session_ref, stream)
+        if len(columns["timestamp_ms"]) == 0:
+            continue
+
+        result = writer.write(session_ref, stream, columns)
+        migrated[stream] = result['saved_count']
+        if not result['ok']:
+            # 一部失敗した場合は旧データを残す（再実行で変換し直せるように）
+            print(f"⚠️ {session_ref.id}/{stream}: {result['failed']} chunk writes failed")
+            continue
+
+        if delete_legacy:
+            FirestoreBulkWriter(db).commit([
+                ('delete', doc.reference, None)
+                for doc in session_ref.collection(stream).stream()
+            ])
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="テレメトリをチャンク形式に変換")
+    parser.add_argument("--session", help="変換するセッションID（省略時は全セッション）")
+    parser.add_argument("--delete-legacy", action="store_true", help="変換後に旧ドキュメントを削除する")
+    args = parser.parse_args()
+
+    # Firestore初期化
+    db = firestore.Client()
+    writer = TelemetryChunkWriter(db)
+
+    if args.session:
+        session_refs = [db.collection("sessions").document(args.session)]
+    else:
+        session_refs = [s.reference for s in db.collection("sessions").stream()]
+
+    migrated_sessions = 0
+    for session_ref in session_refs:
+        try:
+            migrated = migrate_session(db, session_ref, writer, delete_legacy=args.delete_legacy)
+        except Exception as e:
+            print(f"Error for session {session_ref.id}: {e}")
+            continue
+        if migrated:
+            migrated_sessions += 1
+            print(f"Migrated session {session_ref.id}: {migrated}")
+    print(f"完了: {migrated_sessions}件のセッションをチャンク形式に変換しました")
+
+
+if __name__ == "__main__":
+    main()
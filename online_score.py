@@ -0,0 +1,274 @@
+# online_score.py
+"""
+総合スコアのオンライン（受信バッチごとの逐次）計算機能モジュール
+avg_g_logs を受信するたびに、ジャーク統計の途中状態を sessions/{id}.score_state に持ち回る。
+走行中でも暫定スコアが出せ、終了時は全件を読み直さずに最終スコアが出る。
+
+計算は score.JerkCalculator（jerk.jerk_series の再サンプリング版）と同じ手順を逐次に行う。
+    - 直前の点より時刻が進んでいない点は捨てる
+      （同時刻の点は全件からの計算でも捨てるので duplicate_samples、前の時刻の点は late_samples に数える）
+    - max_gap_ms を超える途切れで区間を切る
+    - 区間の先頭からの時刻で格子点に丸めて平均し（ビン）、確定したビンの平均点を線形補間して格子値を出す
+      （最後のビンは次の点が来るまで open のまま持ち越す）
+    - 格子値の差分からジャークを求め、チャンネルごとに件数・Welford の平均/分散・|j| の合計・最大・
+      閾値超え（イベント）・安定（閾値の半分未満）の数を足し込む
+速度の標準偏差も Welford、距離は GPS 集計の距離（無ければ速度×時間）を使う。
+
+score_state（Firestoreに保存できるよう数値・dict・None だけで構成する）:
+    rate_hz, max_gap_ms, threshold_g_per_s   計算条件
+    origin_ms, last_ms, last_speed           基準時刻・直前の点
+    data_points                              受信した点数
+    duplicate_samples, late_samples          捨てた点数（直前と同時刻・直前より前の時刻）
+    speed                                    速度の {n, mean, m2}
+    speed_integral_km, gps_distance_km       速度×時間の距離・GPS集計の距離
+    segments, gaps, duration_s               確定した区間の数・途切れの数・区間の長さの合計
+    segment                                  走行中の区間（先頭時刻・点数・open ビン・直前の平均点・格子位置）
+    jerk.{z,x}                               {n, mean, m2, sum_abs, max_abs, events, stable}
+"""
+import copy
+import math
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from jerk import DEFAULT_MAX_GAP_MS, valid_sample_mask
+
+
+# score.calculate_session_overall_score と同じ条件
+SCORE_RATE_HZ = 10.0
+JERK_THRESHOLD_G_PER_S = 0.5
+
+CHANNELS = ('z', 'x')
+
+
+def _empty_moments() -> Dict[str, Any]:
+    return {'n': 0, 'mean': 0.0, 'm2': 0.0}
+
+
+def merge_moments(a: Dict[str, Any], values: np.ndarray) -> Dict[str, Any]:
+    """Welford の途中状態 a に values をまとめて足す（Chan の並列版の式）"""
+    n_b = len(values)
+    if n_b == 0:
+        return a
+    mean_b = float(np.mean(values))
+    m2_b = float(np.sum((values - mean_b) ** 2))
+    n_a = a['n']
+    n = n_a + n_b
+    delta = mean_b - a['mean']
+    return {
+        'n': n,
+        'mean': a['mean'] + delta * n_b / n,
+        'm2': a['m2'] + m2_b + delta * delta * n_a * n_b / n,
+    }
+
+
+def new_score_state(rate_hz: float = SCORE_RATE_HZ, max_gap_ms: float = DEFAULT_MAX_GAP_MS,
+                    threshold_g_per_s: float = JERK_THRESHOLD_G_PER_S) -> Dict[str, Any]:
+    return {
+        'rate_hz': float(rate_hz),
+        'max_gap_ms': float(max_gap_ms),
+        'threshold_g_per_s': float(threshold_g_per_s),
+        'origin_ms': None,
+        'last_ms': None,
+        'last_speed': None,
+        'data_points': 0,
+        'duplicate_samples': 0,
+        'late_samples': 0,
+        'speed': _empty_moments(),
+        'speed_integral_km': 0.0,
+        'gps_distance_km': 0.0,
+        'segments': 0,
+        'gaps': 0,
+        'duration_s': 0.0,
+        'segment': None,
+        'jerk': {
+            channel: dict(_empty_moments(), sum_abs=0.0, max_abs=0.0, events=0, stable=0)
+            for channel in CHANNELS
+        },
+    }
+
+
+# ===== 区間・ビン・格子 =====
+def _new_segment(t0: float) -> Dict[str, Any]:
+    return {
+        't0': t0,           # 区間の先頭（origin_ms からの秒）
+        'samples': 0,
+        'open': None,       # まだ確定していないビン {b, n, t, z, x}（t, z, x は合計）
+        'prev': None,       # 直前に確定したビンの平均点 {t, z, x}
+        'grid_t0': None,    # 格子の始点（最初のビンの平均時刻）
+        'next_k': 0,        # 次に出す格子点の番号
+        'last': None,       # 直前に出した格子値 {z, x}
+    }
+
+
+def _emit(state: Dict[str, Any], knot_t: np.ndarray, knot_v: Dict[str, np.ndarray]) -> None:
+    """確定したビンの平均点を受け取り、出せるところまで格子値を出してジャークを足し込む"""
+    if len(knot_t) == 0:
+        return
+    segment = state['segment']
+    rate = state['rate_hz']
+    prev = segment['prev']
+    if prev is None:
+        segment['grid_t0'] = float(knot_t[0])
+    else:
+        knot_t = np.concatenate(([prev['t']], knot_t))
+        knot_v = {c: np.concatenate(([prev[c]], knot_v[c])) for c in CHANNELS}
+
+    last_k = int(np.floor((knot_t[-1] - segment['grid_t0']) * rate))
+    if last_k >= segment['next_k']:
+        grid = segment['grid_t0'] + np.arange(segment['next_k'], last_k + 1) / rate
+        dt = 1.0 / rate
+        threshold = state['threshold_g_per_s']
+        last = segment['last']
+        emitted = {}
+        for c in CHANNELS:
+            values = np.interp(grid, knot_t, knot_v[c])
+            series = np.concatenate(([last[c]], values)) if last is not None else values
+            jerk = np.diff(series) / dt
+            if len(jerk):
+                moments = state['jerk'][c]
+                abs_jerk = np.abs(jerk)
+                moments.update(merge_moments(moments, jerk))
+                moments['sum_abs'] += float(abs_jerk.sum())
+                moments['max_abs'] = max(moments['max_abs'], float(abs_jerk.max()))
+                moments['events'] += int(np.count_nonzero(abs_jerk > threshold))
+                moments['stable'] += int(np.count_nonzero(abs_jerk < threshold * 0.5))
+            emitted[c] = float(values[-1])
+        segment['last'] = emitted
+        segment['next_k'] = last_k + 1
+
+    segment['prev'] = {'t': float(knot_t[-1]), **{c: float(knot_v[c][-1]) for c in CHANNELS}}
+
+
+def _add_samples(state: Dict[str, Any], t: np.ndarray, values: Dict[str, np.ndarray]) -> None:
+    """走行中の区間に点を足す（同じビンの点をまとめ、最後のビンは open のまま残す）"""
+    segment = state['segment']
+    bins = np.rint((t - segment['t0']) * state['rate_hz']).astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    counts = np.diff(np.concatenate((starts, [len(t)]))).astype(float)
+    sums = {'t': np.add.reduceat(t, starts), **{c: np.add.reduceat(values[c], starts) for c in CHANNELS}}
+    group_bins = bins[starts]
+
+    open_bin = segment['open']
+    finalized = None
+    if open_bin is not None and open_bin['b'] == int(group_bins[0]):
+        # 持ち越したビンに続きの点が来た
+        counts[0] += open_bin['n']
+        for key in sums:
+            sums[key][0] += open_bin[key]
+    elif open_bin is not None:
+        finalized = open_bin
+
+    means = {key: sums[key] / counts for key in sums}
+    knot_t = means['t'][:-1]
+    knot_v = {c: means[c][:-1] for c in CHANNELS}
+    if finalized is not None:
+        knot_t = np.concatenate(([finalized['t'] / finalized['n']], knot_t))
+        knot_v = {c: np.concatenate(([finalized[c] / finalized['n']], knot_v[c])) for c in CHANNELS}
+    _emit(state, knot_t, knot_v)
+
+    segment['open'] = {
+        'b': int(group_bins[-1]),
+        'n': float(counts[-1]),
+        **{key: float(sums[key][-1]) for key in sums},
+    }
+    segment['samples'] += len(t)
+
+
+def _close_segment(state: Dict[str, Any]) -> None:
+    """走行中の区間を閉じる（open ビンを確定させ、区間数・長さに足す）"""
+    segment = state['segment']
+    if segment is None:
+        return
+    open_bin = segment['open']
+    if open_bin is not None:
+        _emit(state, np.array([open_bin['t'] / open_bin['n']]),
+              {c: np.array([open_bin[c] / open_bin['n']]) for c in CHANNELS})
+        segment['open'] = None
+    if segment['samples'] >= 2:
+        state['segments'] += 1
+        last_t = (state['last_ms'] - state['origin_ms']) / 1000.0
+        state['duration_s'] += last_t - segment['t0']
+    state['segment'] = None
+
+
+# ===== 公開関数 =====
+def update_score_state(state: Dict[str, Any], timestamp_ms: np.ndarray, g_z: np.ndarray,
+                       g_x: np.ndarray, speed: np.ndarray) -> Dict[str, Any]:
+    """受信した avg_g_logs のバッチを state に足し込む（state を更新して返す）"""
+    ts = np.asarray(timestamp_ms, dtype=float)
+    if len(ts) == 0:
+        return state
+    order = np.argsort(ts, kind='stable')
+    ts = ts[order]
+    g_z = np.asarray(g_z, dtype=float)[order]
+    g_x = np.asarray(g_x, dtype=float)[order]
+    speed = np.asarray(speed, dtype=float)[order]
+
+    state['data_points'] += len(ts)
+    state['speed'] = merge_moments(state['speed'], speed)
+
+    # 直前の点より時刻が進んでいる点だけを使う
+    last_ms = state['last_ms']
+    if last_ms is None:
+        valid = valid_sample_mask(ts)
+        late = np.zeros(len(ts), dtype=bool)
+    else:
+        valid = valid_sample_mask(np.concatenate(([last_ms], ts)))[1:]
+        # ソート済みなので、前の時刻の点はこのバッチの先頭側に並ぶ
+        late = ts < last_ms
+    state['late_samples'] += int(np.count_nonzero(late))
+    state['duplicate_samples'] += int(np.count_nonzero(~valid & ~late))
+    ts, g_z, g_x, speed = ts[valid], g_z[valid], g_x[valid], speed[valid]
+    if len(ts) == 0:
+        return state
+    if state['origin_ms'] is None:
+        state['origin_ms'] = float(ts[0])
+
+    # 直前の点との時間差で区間の切れ目を判定する
+    prev_ms = np.concatenate(([last_ms if last_ms is not None else np.nan], ts[:-1]))
+    dt_ms = ts - prev_ms
+    continues = dt_ms <= state['max_gap_ms']        # 先頭に直前の点が無い場合は nan → False
+    state['gaps'] += int(np.count_nonzero(~continues)) - (1 if last_ms is None else 0)
+
+    # 速度×時間（台形則。区間をまたがない）
+    prev_speed = np.concatenate(([state['last_speed'] if state['last_speed'] is not None else 0.0], speed[:-1]))
+    mean_speed = np.clip((speed + prev_speed) / 2.0, 0.0, None)
+    state['speed_integral_km'] += float(np.sum(mean_speed[continues] * dt_ms[continues]) / 3_600_000.0)
+
+    t = (ts - state['origin_ms']) / 1000.0
+    values = {'z': g_z, 'x': g_x}
+    bounds = np.concatenate((np.flatnonzero(~continues), [len(ts)]))
+    if bounds[0] != 0:
+        bounds = np.concatenate(([0], bounds))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if not continues[lo]:
+            _close_segment(state)
+            state['segment'] = _new_segment(float(t[lo]))
+        _add_samples(state, t[lo:hi], {c: values[c][lo:hi] for c in CHANNELS})
+        state['last_ms'] = float(ts[hi - 1])
+    state['last_speed'] = float(speed[-1])
+    return state
+
+
+def add_gps_distance(state: Dict[str, Any], distance_km: float) -> Dict[str, Any]:
+    """GPS集計（session_aggregates）の距離の増分を足す"""
+    state['gps_distance_km'] += float(distance_km or 0.0)
+    return state
+
+
+def finalize_score_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """走行中の区間を閉じたコピー（元の state は逐次計算を続けられるよう変更しない）"""
+    final = copy.deepcopy(state)
+    _close_segment(final)
+    return final
+
+
+def moments_std(moments: Dict[str, Any]) -> float:
+    """母標準偏差（np.std と同じ）"""
+    return math.sqrt(moments['m2'] / moments['n']) if moments['n'] > 0 else 0.0
+
+
+def is_usable(state: Optional[Dict[str, Any]]) -> bool:
+    """最終スコアに使える状態か（前の時刻の点が後から届いていれば全件からの計算と一致しないので使わない）"""
+    return bool(state) and state.get('data_points', 0) > 0 and state.get('late_samples', 0) == 0
@@ -0,0 +1,253 @@
+# prompt_compaction.py
+"""
+LLMプロンプトの計測データ圧縮機能モジュール
+重点ポイントの時間範囲の avg-G 列（左右G・前後G・速度）をそのまま1行ずつ並べると、
+センサーのサンプリングレートに比例してプロンプトが長くなる（遅延・コストも比例する）。
+ここでは計測データ部分をトークン予算に収まるまで間引き、間引いても失われない特徴量を別に添える。
+
+- 間引き: 3チャンネル同時の LTTB（Largest-Triangle-Three-Buckets）
+  各チャンネルを標準化し、三角形の面積の合計が最大になる点をバケットごとに残す。
+  さらに各チャンネルの最大・最小の点は必ず残す（ピーク保存）
+- 特徴量: 左右G・前後Gのピークとその位置（前半/中盤/後半）、停止区間、速度の傾向
+- トークン数は文字種からの概算（ASCII は約4文字で1トークン、それ以外は1文字1トークン）
+"""
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+# 予算が小さくてもこれ以上は間引かない点数
+MIN_POINTS = 16
+# これ未満の速度（km/h）が STOP_MIN_S 秒以上続いた区間を停止とみなす
+STOP_SPEED_KMH = 1.0
+STOP_MIN_S = 1.0
+
+
+def estimate_tokens(text: str) -> int:
+    """プロンプトのトークン数の概算"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+
+# ===== 間引き =====
+def lttb_indices(t: np.ndarray, channels: List[np.ndarray], n_out: int) -> np.ndarray:
+    """
+    複数チャンネルの LTTB で残す点のインデックス（先頭・末尾を含む n_out 点、昇順）
+    面積はチャンネルごとに標準化した値で計算して合計する
+    """
+    n = len(t)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1]) if n > 1 else np.arange(n)
+
+    t = np.asarray(t, dtype=float)
+    columns = []
+    for channel in channels:
+        channel = np.asarray(channel, dtype=float)
+        std = channel.std()
+        columns.append((channel - channel.mean()) / std if std > 0 else np.zeros(n))
+    y = np.column_stack(columns)
+
+    # 先頭と末尾を除いた点を n_out - 2 個のバケットに分ける
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_t = t[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean(axis=0)
+        # 前回選んだ点 a・バケット内の候補・次のバケットの平均 で作る三角形の面積（×2）
+        area = np.abs(
+            (t[a] - avg_t) * (y[lo:hi] - y[a]) - (t[a] - t[lo:hi])[:, None] * (avg_y - y[a])
+        ).sum(axis=1)
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def peak_indices(channels: List[np.ndarray]) -> np.ndarray:
+    """各チャンネルの最大・最小の点"""
+    peaks = []
+    for channel in channels:
+        if len(channel):
+            peaks.extend((int(np.argmax(channel)), int(np.argmin(channel))))
+    return np.unique(np.array(peaks, dtype=int))
+
+
+def downsample(t: np.ndarray, channels: List[np.ndarray], n_out: int) -> np.ndarray:
+    """LTTB にピーク点を加えたインデックス（昇順・重複なし。最大 n_out 点）"""
+    peaks = peak_indices(channels)
+    if n_out >= len(t):
+        return np.arange(len(t))
+    base = lttb_indices(t, channels, max(3, n_out - len(peaks)))
+    return np.union1d(base, peaks)
+
+
+# ===== 特徴量 =====
+def _phase(fraction: float) -> str:
+    if fraction < 1 / 3:
+        return "前半"
+    if fraction < 2 / 3:
+        return "中盤"
+    return "後半"
+
+
+def stop_segments(t_s: np.ndarray, speed: np.ndarray) -> List[Dict[str, float]]:
+    """速度が STOP_SPEED_KMH 未満の区間のうち STOP_MIN_S 秒以上続いたもの"""
+    stopped = np.asarray(speed) < STOP_SPEED_KMH
+    if not stopped.any():
+        return []
+    changes = np.diff(np.concatenate(([0], stopped.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(changes == 1), np.flatnonzero(changes == -1) - 1
+    return [
+        {"start_s": float(t_s[s]), "duration_s": float(t_s[e] - t_s[s])}
+        for s, e in zip(starts, ends)
+        if t_s[e] - t_s[s] >= STOP_MIN_S
+    ]
+
+
+def extract_features(t_s: np.ndarray, gx: np.ndarray, gz: np.ndarray, speed: np.ndarray) -> Dict[str, Any]:
+    """全計測点から、間引きで失われやすい特徴（ピークの大きさと位置・停止・速度の傾向）を取り出す"""
+    if len(t_s) == 0:
+        return {}
+    span = float(t_s[-1] - t_s[0]) or 1.0
+
+    def peak(values, pick):
+        i = int(pick(values))
+        return {"value": round(float(values[i]), 3), "phase": _phase(float(t_s[i] - t_s[0]) / span)}
+
+    third = max(1, len(speed) // 3)
+    speed_change = float(np.mean(speed[-third:]) - np.mean(speed[:third]))
+    if speed_change > 5.0:
+        speed_trend = "後半にかけて加速"
+    elif speed_change < -5.0:
+        speed_trend = "後半にかけて減速"
+    else:
+        speed_trend = "ほぼ一定"
+
+    return {
+        "right_g": peak(gx, np.argmax),
+        "left_g": peak(gx, np.argmin),
+        "accel_g": peak(gz, np.argmax),
+        "brake_g": peak(gz, np.argmin),
+        "stops": [
+            {"phase": _phase((s["start_s"] - float(t_s[0])) / span), "duration_s": round(s["duration_s"], 1)}
+            for s in stop_segments(t_s, speed)
+        ],
+        "speed_trend": speed_trend,
+    }
+
+
+# ===== プロンプトの計測データ部分 =====
+def format_raw_data_text(points: List[Dict[str, float]], features: Optional[Dict[str, Any]] = None,
+                         compacted: bool = False) -> str:
+    """計測データ（時系列）と特徴量をプロンプト用のテキストにする"""
+    if not points:
+        return ""
+    text = "\n【この地点の計測データ（時系列）】\n"
+    text += "経過秒, 左右G(gx), 前後G(gz), 速度(km/h)\n"
+    for point in points:
+        text += f"{point['t']:.1f}, {point['gx']:.3f}, {point['gz']:.3f}, {point['speed']:.1f}\n"
+
+    text += "\n※ 左右G(gx): 正=右旋回、負=左旋回\n"
+    text += "※ 前後G(gz): 正=加速、負=減速\n"
+    if compacted:
+        text += "※ 変化の少ない区間は間引いています（ピークの点はすべて残しています）\n"
+
+    if features:
+        text += "\n【全計測データから抽出した特徴】\n"
+        text += (f"- 左右Gのピーク: 右 {features['right_g']['value']:.3f}（{features['right_g']['phase']}）、"
+                 f"左 {features['left_g']['value']:.3f}（{features['left_g']['phase']}）\n")
+        text += (f"- 前後Gのピーク: 加速 {features['accel_g']['value']:.3f}（{features['accel_g']['phase']}）、"
+                 f"減速 {features['brake_g']['value']:.3f}（{features['brake_g']['phase']}）\n")
+        stops = features.get("stops") or []
+        if stops:
+            text += f"- 停止: {len(stops)}回（" + "、".join(
+                f"{s['phase']} 約{s['duration_s']:.0f}秒" for s in stops) + "）\n"
+        else:
+            text += "- 停止: なし\n"
+        text += f"- 速度の傾向: {features['speed_trend']}\n"
+    return text
+
+
+@dataclass
+class CompactedSeries:
+    """トークン予算に合わせて間引いた計測データ"""
+    points: List[Dict[str, float]]
+    features: Dict[str, Any]
+    original_points: int
+    method: str                 # full（間引きなし） / lttb
+    estimated_tokens: int       # 計測データ部分の概算トークン数
+    token_budget: int
+
+    @property
+    def text(self) -> str:
+        return format_raw_data_text(self.points, self.features, compacted=self.method != "full")
+
+    @property
+    def ratio(self) -> float:
+        """残した点の割合（1.0 = 間引きなし）"""
+        return len(self.points) / self.original_points if self.original_points else 1.0
+
+    def to_record(self) -> Dict[str, Any]:
+        """focus_feedbacks に保存する圧縮の記録"""
+        return {
+            "method": self.method,
+            "original_points": self.original_points,
+            "kept_points": len(self.points),
+            "ratio": round(self.ratio, 3),
+            "estimated_tokens": self.estimated_tokens,
+            "token_budget": self.token_budget,
+        }
+
+
+def compact_series(timestamp_ms: np.ndarray, gx: np.ndarray, gz: np.ndarray, speed: np.ndarray,
+                   token_budget: int) -> CompactedSeries:
+    """
+    計測データ部分（format_raw_data_text の結果）が token_budget に収まるまで間引く
+    MIN_POINTS より少なくはしないので、予算が極端に小さい場合は超えることがある
+    """
+    ts = np.asarray(timestamp_ms, dtype=float)
+    gx, gz, speed = (np.asarray(c, dtype=float) for c in (gx, gz, speed))
+    t_s = (ts - ts[0]) / 1000.0 if len(ts) else ts
+    features = extract_features(t_s, gx, gz, speed)
+    channels = [gx, gz, speed]
+
+    def points_at(indices):
+        return [
+            {"t": t, "gx": x, "gz": z, "speed": v}
+            for t, x, z, v in zip(t_s[indices].tolist(), gx[indices].tolist(),
+                                  gz[indices].tolist(), speed[indices].tolist())
+        ]
+
+    n = len(ts)
+    indices = np.arange(n)
+    points = points_at(indices)
+    tokens = estimate_tokens(format_raw_data_text(points, features))
+    method = "full"
+    # 1行あたりのトークン数から点数を見積もり、収まらなければ見積もりを縮めてやり直す
+    for _ in range(4):
+        if tokens <= token_budget or len(indices) <= MIN_POINTS:
+            break
+        overhead = estimate_tokens(format_raw_data_text(points[:1], features, compacted=True))
+        per_point = max(1.0, (tokens - overhead) / max(1, len(indices) - 1))
+        target = int((token_budget - overhead) / per_point)
+        target = max(MIN_POINTS, min(target, len(indices) - 1))
+        indices = downsample(t_s, channels, target)
+        points = points_at(indices)
+        method = "lttb"
+        tokens = estimate_tokens(format_raw_data_text(points, features, compacted=True))
+
+    return CompactedSeries(
+        points=points,
+        features=features,
+        original_points=n,
+        method=method,
+        estimated_tokens=tokens,
+        token_budget=token_budget,
+    )
@@ -0,0 +1,165 @@
+# rate_limit.py
+"""
+受信レート制限機能モジュール
+トークンバケットでユーザー単位・セッション単位の流量を制限し、
+超過時は 429 + Retry-After と推奨フラッシュ間隔を返す。
+
+バケットの状態は RateLimitStore に保存する。既定はプロセス内メモリ、
+複数ワーカープロセスで共有する場合は RATE_LIMIT_REDIS_URL を設定して Redis を使う。
+"""
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+try:
+    import redis
+except ImportError:  # redis未導入の環境ではメモリストアのみ
+    redis = None
+
+
+# ===== ルール =====
+@dataclass(frozen=True)
+class RateLimitRule:
+    """トークンバケットの設定（rate: 毎秒の補充量、burst: バケット容量）"""
+    name: str
+    rate: float
+    burst: float
+
+
+@dataclass
+class RateLimitDecision:
+    """判定結果"""
+    allowed: bool
+    remaining: float
+    retry_after_s: float
+    rule: RateLimitRule
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, int(self.retry_after_s + 0.999)))
+
+
+# ===== ストア =====
+class RateLimitStore(ABC):
+    """バケット状態の保存先"""
+
+    @abstractmethod
+    def consume(self, key: str, rule: RateLimitRule, cost: float, now: float) -> Tuple[bool, float, float]:
+        """
+        cost 分のトークンを消費する
+
+        Returns:
+            (allowed, remaining_tokens, retry_after_s)
+        """
+        pass
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """プロセス内メモリのストア（件数上限付き。長く使われていないキーから捨てる）"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+
+    def consume(self, key, rule, cost, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rule.burst, now))
+            tokens = min(rule.burst, tokens + (now - updated) * rule.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        retry_after = 0.0 if allowed else (cost - tokens) / rule.rate
+        return allowed, tokens, retry_after
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """Redisのストア（Luaスクリプトで読み込み・更新を1往復にまとめる）"""
+
+    _SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, client, prefix: str = 'ratelimit:'):
+        self._client = client
+        self._prefix = prefix
+        self._script = client.register_script(self._SCRIPT)
+
+    def consume(self, key, rule, cost, now):
+        allowed, tokens = self._script(
+            keys=[self._prefix + key],
+            args=[rule.rate, rule.burst, cost, now],
+        )
+        tokens = float(tokens)
+        allowed = bool(int(allowed))
+        retry_after = 0.0 if allowed else (cost - tokens) / rule.rate
+        return allowed, tokens, retry_after
+
+
+# ===== リミッター =====
+class RateLimiter:
+    """ルールとストアを組み合わせて判定する"""
+
+    def __init__(self, store: RateLimitStore):
+        self._store = store
+
+    def check(self, key: str, rule: RateLimitRule, cost: float = 1.0) -> RateLimitDecision:
+        # 容量を超えるコストは絶対に通らないので、容量分として扱う（上限はペイロード上限で別に弾く）
+        cost = min(cost, rule.burst)
+        allowed, remaining, retry_after = self._store.consume(
+            f"{rule.name}:{key}", rule, cost, time.time()
+        )
+        return RateLimitDecision(allowed, remaining, retry_after, rule)
+
+
+def create_rate_limit_store(redis_url: Optional[str] = None) -> RateLimitStore:
+    """RATE_LIMIT_REDIS_URL があれば Redis、無ければメモリのストアを返す"""
+    redis_url = redis_url or os.getenv('RATE_LIMIT_REDIS_URL')
+    if redis_url:
+        if redis is None:
+            print("[WARN] RATE_LIMIT_REDIS_URL is set but redis is not installed; using in-memory rate limits")
+        else:
+            try:
+                return RedisRateLimitStore(redis.Redis.from_url(redis_url))
+            except Exception as e:
+                print(f"[WARN] Redis rate limit store unavailable ({e}); using in-memory rate limits")
+    return MemoryRateLimitStore()
+
+
+def recommended_flush_interval_s(decision: RateLimitDecision, default_s: float) -> float:
+    """
+    端末に勧めるフラッシュ間隔
+    残りトークンが半分を切ったら間隔を広げ、制限中は Retry-After 以上にする。
+    """
+    if not decision.allowed:
+        return max(default_s, decision.retry_after_s * 2)
+    if decision.remaining < decision.rule.burst / 2:
+        return default_s * 2
+    return default_s
+
+
+# 推奨値を返すときに使うレスポンスヘッダ
+FLUSH_INTERVAL_HEADER = 'X-Recommended-Flush-Interval'
@@ -0,0 +1,358 @@
+"""
+保存済みセッションの総合スコアを、現在の設定（score.py の WEIGHT_A / WEIGHT_B・ジャーク閾値）で再計算するスクリプト
+
+- セッションは document ID 順にカーソルでページングして読む（全件を一度にメモリへ載せない）
+- スコア計算（avg_g_logs の読み込み＋ジャーク計算）はプロセスプールで並列に行う
+- 書き込みはページごとに FirestoreBulkWriter でまとめてコミットする
+  （区間ごとのスコア推移 analysis/score_timeline も同じ設定で作り直す）
+- ページを書き終えるたびにチェックポイントを保存するので、中断しても続きから再開できる
+  （スコアの設定が変わっていたらチェックポイントは使わず最初からやり直す）
+
+使い方:
+    python rescore_sessions.py                              # 完了済みの全セッションを再計算
+    python rescore_sessions.py --dry-run --report diff.csv  # 書き込まずに差分レポートだけ作る
+    python rescore_sessions.py --workers 8 --page-size 500  # 並列数・1ページの件数
+    python rescore_sessions.py --user <id>                  # 指定ユーザーのみ
+    python rescore_sessions.py --session <id> --session <id2>
+    python rescore_sessions.py --retry-failed               # 前回失敗したセッションだけやり直す
+    python rescore_sessions.py --reset                      # チェックポイントを捨てて最初から
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from google.cloud import firestore
+from bulk_writer import FirestoreBulkWriter
+from score_timeline import TIMELINE_COLLECTION, TIMELINE_DOC_ID
+from telemetry_store import load_stream_columns
+
+
+DEFAULT_CHECKPOINT = "rescore_checkpoint.json"
+DEFAULT_PAGE_SIZE = 200
+REPORT_FIELDS = [
+    "session_id", "user_id", "status", "old_score", "new_score", "delta",
+    "old_events_per_km", "new_events_per_km", "old_weights", "data_points", "error",
+]
+
+
+# ===== ワーカー（プロセスごとに Firestore クライアントを持つ） =====
+_score = None
+
+
+def _init_worker():
+    # score は import 時に firestore.Client() を作るので、子プロセスごとに読み込む
+    global _score
+    import score
+    _score = score
+
+
+def rescore_session(task):
+    """1セッション分の avg_g_logs を読み込んでスコアを計算する（書き込みはしない）"""
+    session_id, distance_km, sample_rate_hz = task
+    try:
+        session_ref = _score.db.collection("sessions").document(session_id)
+        columns = load_stream_columns(session_ref, "avg_g_logs")
+        return {"session_id": session_id,
+                "score": _score.score_session_columns(columns, distance_km, sample_rate_hz),
+                "timeline": _score.calculate_score_timeline(columns, sample_rate_hz),
+                "error": None}
+    except Exception as e:
+        return {"session_id": session_id, "score": None, "timeline": None, "error": str(e)}
+
+
+# ===== セッションの読み込み =====
+def iter_session_pages(db, page_size, start_after_id=None, user_id=None):
+    """完了済みセッションを document ID 順に page_size 件ずつ返す"""
+    query = db.collection("sessions").where("status", "==", "completed")
+    if user_id:
+        query = query.where("user_id", "==", user_id)
+    query = query.order_by("__name__").limit(page_size)
+
+    cursor = db.collection("sessions").document(start_after_id).get() if start_after_id else None
+    while True:
+        page = list((query.start_after(cursor) if cursor is not None else query).stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+
+def iter_listed_sessions(db, session_ids, page_size):
+    """ID を指定したセッションを page_size 件ずつ返す"""
+    for i in range(0, len(session_ids), page_size):
+        refs = [db.collection("sessions").document(sid) for sid in session_ids[i:i + page_size]]
+        yield [doc for doc in db.get_all(refs) if doc.exists]
+
+
+# ===== 差分 =====
+def old_score_summary(session):
+    """保存済みのスコア（比較用）"""
+    jerk_stats = session.get("jerk_stats") or {}
+    return {
+        "overall_score": session.get("overall_score"),
+        "jerk_events_per_km": jerk_stats.get("jerk_events_per_km"),
+        "weights": session.get("weights"),
+        "scoring_mode": session.get("scoring_mode"),
+    }
+
+
+def is_changed(old, new):
+    """保存済みのスコアと再計算の結果が違うか（重み・イベント密度の変化も含む）"""
+    if old["overall_score"] != new["overall_score"] or old["weights"] != new["weights"]:
+        return True
+    if old["scoring_mode"] != new["scoring_mode"] or old["jerk_events_per_km"] is None:
+        return True
+    return abs(float(old["jerk_events_per_km"]) - new["jerk_stats"]["jerk_events_per_km"]) > 1e-9
+
+
+def report_row(session_id, user_id, status, old, new=None, error=None):
+    new_score = new["overall_score"] if new else None
+    old_score = old["overall_score"] if old else None
+    delta = new_score - old_score if new_score is not None and isinstance(old_score, (int, float)) else None
+    return {
+        "session_id": session_id,
+        "user_id": user_id,
+        "status": status,
+        "old_score": old_score,
+        "new_score": new_score,
+        "delta": delta,
+        "old_events_per_km": old["jerk_events_per_km"] if old else None,
+        "new_events_per_km": round(new["jerk_stats"]["jerk_events_per_km"], 4) if new else None,
+        "old_weights": json.dumps(old["weights"]) if old and old["weights"] else None,
+        "data_points": new["jerk_stats"]["data_points"] if new else None,
+        "error": error,
+    }
+
+
+# ===== チェックポイント =====
+def load_checkpoint(path, params, user_id):
+    """設定・対象が同じ実行のチェックポイントだけを返す"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("params") != params or checkpoint.get("user_id") != user_id:
+        print(f"⚠️ Checkpoint {path} was made with different settings; starting over")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """途中で落ちても壊れないように一時ファイルに書いてから置き換える"""
+    checkpoint["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def new_checkpoint(params, user_id):
+    return {
+        "params": params,
+        "user_id": user_id,
+        "last_session_id": None,
+        "done": False,
+        "processed": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "skipped": 0,
+        "failed": [],
+        "elapsed_s": 0.0,
+    }
+
+
+# ===== 1ページ分の処理 =====
+def commit_updates(writer, single_writer, operations):
+    """
+    まとめてコミットし、失敗した操作のインデックスを返す
+    1件の不正な書き込みでバッチ全体が失敗するので、失敗したバッチは1件ずつ書き直して原因の操作だけを残す
+    """
+    def failed_indices(result, indices):
+        failed = []
+        for chunk in result["chunks"]:
+            if not chunk["ok"]:
+                failed.extend(indices[chunk["offset"]:chunk["offset"] + chunk["size"]])
+        return failed
+
+    failed = failed_indices(writer.commit(operations), list(range(len(operations))))
+    if not failed:
+        return set()
+    print(f"🔁 Retrying {len(failed)} updates one by one")
+    return set(failed_indices(single_writer.commit([operations[i] for i in failed]), failed))
+
+
+def process_page(db, pool, writers, page, args, stats):
+    """再計算→差分→（dry-run でなければ）一括書き込み。レポートの行を返す"""
+    sessions = {doc.id: doc.to_dict() or {} for doc in page}
+    tasks = [(sid, data.get("distance"), args.sample_rate) for sid, data in sessions.items()]
+    chunksize = max(1, len(tasks) // (args.workers * 4))
+    results = list(pool.map(rescore_session, tasks, chunksize=chunksize))
+
+    rows, operations, pending = [], [], []
+    for result in results:
+        sid = result["session_id"]
+        session = sessions[sid]
+        old = old_score_summary(session)
+        new = result["score"]
+        stats["processed"] += 1
+        if result["error"]:
+            stats["failed"].append(sid)
+            rows.append(report_row(sid, session.get("user_id"), "error", old, error=result["error"]))
+            continue
+        if new["jerk_stats"]["data_points"] == 0:
+            # avg_g_logs が無いセッションにはスコアを付けない
+            stats["skipped"] += 1
+            rows.append(report_row(sid, session.get("user_id"), "skipped", old, new))
+            continue
+        if not (args.force or is_changed(old, new)):
+            stats["unchanged"] += 1
+            rows.append(report_row(sid, session.get("user_id"), "unchanged", old, new))
+            continue
+        if args.dry_run:
+            stats["updated"] += 1
+            rows.append(report_row(sid, session.get("user_id"), "dry_run", old, new))
+            continue
+        session_ref = db.collection("sessions").document(sid)
+        first_op = len(operations)
+        operations.append(("update", session_ref, {**new, "score_source": "rescore"}))
+        if result["timeline"] is not None:
+            operations.append(("set", session_ref.collection(TIMELINE_COLLECTION).document(TIMELINE_DOC_ID),
+                               {**result["timeline"], "calculated_at": new["calculated_at"]}))
+        pending.append((sid, session.get("user_id"), old, new, range(first_op, len(operations))))
+
+    if operations:
+        failed = commit_updates(*writers, operations)
+        for sid, user_id, old, new, ops in pending:
+            if failed.intersection(ops):
+                stats["failed"].append(sid)
+                rows.append(report_row(sid, user_id, "error", old, new, error="write failed"))
+            else:
+                stats["updated"] += 1
+                rows.append(report_row(sid, user_id, "updated", old, new))
+    return rows
+
+
+def write_report(path, rows, append):
+    new_file = not (append and os.path.exists(path))
+    with open(path, "w" if new_file else "a", newline="", encoding="utf-8") as f:
+        report = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        if new_file:
+            report.writeheader()
+        report.writerows(rows)
+
+
+def print_summary(rows):
+    """スコアの変化の内訳"""
+    deltas = [r["delta"] for r in rows if r["status"] in ("updated", "dry_run") and r["delta"] is not None]
+    if not deltas:
+        return
+    print(f"📊 Score changes: {len(deltas)} sessions, mean |Δ| = {sum(abs(d) for d in deltas) / len(deltas):.2f}, "
+          f"min Δ = {min(deltas)}, max Δ = {max(deltas)}")
+    buckets = {}
+    for d in deltas:
+        buckets[d] = buckets.get(d, 0) + 1
+    print("   Δ: " + ", ".join(f"{d:+d}={n}" for d, n in sorted(buckets.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済みセッションの総合スコアを再計算")
+    parser.add_argument("--user", help="対象ユーザーID（省略時は全ユーザー）")
+    parser.add_argument("--session", action="append", help="対象セッションID（複数指定可）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="スコア計算のプロセス数")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="1ページに読むセッション数")
+    parser.add_argument("--sample-rate", type=float, default=10.0, help="ジャーク計算の格子（Hz）")
+    parser.add_argument("--dry-run", action="store_true", help="書き込まずに差分だけ出す")
+    parser.add_argument("--force", action="store_true", help="スコアが変わらないセッションも書き込む")
+    parser.add_argument("--report", help="セッションごとの差分を書き出す CSV")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="チェックポイントのファイル")
+    parser.add_argument("--reset", action="store_true", help="チェックポイントを使わず最初から")
+    parser.add_argument("--retry-failed", action="store_true", help="チェックポイントに記録された失敗分だけ再実行")
+    args = parser.parse_args()
+
+    from score import scoring_params
+
+    # Firestore初期化
+    db = firestore.Client()
+    writers = (FirestoreBulkWriter(db), FirestoreBulkWriter(db, batch_size=1, max_retries=1))
+    params = scoring_params(args.sample_rate)
+    print(f"⚙️ Scoring params: {params}")
+
+    # 途中再開はページングで全件を回すときだけ（ID指定・dry-run はチェックポイントを書かない）
+    use_checkpoint = not args.session and not args.dry_run
+    checkpoint = None
+    if (use_checkpoint or args.retry_failed) and not args.reset:
+        checkpoint = load_checkpoint(args.checkpoint, params, args.user)
+    if args.retry_failed:
+        if not checkpoint or not checkpoint["failed"]:
+            print("No failed sessions recorded in the checkpoint")
+            return
+        retry_ids, checkpoint["failed"] = checkpoint["failed"], []
+        checkpoint["processed"] -= len(retry_ids)
+        pages = iter_listed_sessions(db, retry_ids, args.page_size)
+    elif args.session:
+        pages = iter_listed_sessions(db, args.session, args.page_size)
+    else:
+        if checkpoint and checkpoint["done"]:
+            print(f"✅ Checkpoint {args.checkpoint} is already complete (use --reset to run again)")
+            return
+        if checkpoint:
+            print(f"⏩ Resuming after session {checkpoint['last_session_id']} "
+                  f"({checkpoint['processed']} already processed)")
+        pages = iter_session_pages(db, args.page_size,
+                                   checkpoint["last_session_id"] if checkpoint else None, args.user)
+    stats = checkpoint or new_checkpoint(params, args.user)
+    resumed = checkpoint is not None
+    processed_before = stats["processed"]
+
+    started = time.perf_counter()
+    elapsed_before = stats["elapsed_s"]
+    all_rows = []
+    # gRPC は fork 後の子プロセスで使えないので spawn で起動する
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker)
+    try:
+        for page_no, page in enumerate(pages, start=1):
+            page_started = time.perf_counter()
+            rows = process_page(db, pool, writers, page, args, stats)
+            all_rows.extend(rows)
+            if args.report:
+                write_report(args.report, rows, append=resumed or page_no > 1)
+
+            stats["elapsed_s"] = round(elapsed_before + time.perf_counter() - started, 3)
+            if use_checkpoint and not args.retry_failed:
+                stats["last_session_id"] = page[-1].id
+            if use_checkpoint or args.retry_failed:
+                save_checkpoint(args.checkpoint, stats)
+
+            run_elapsed = time.perf_counter() - started
+            print(f"📄 Page {page_no}: {len(page)} sessions in {time.perf_counter() - page_started:.1f}s "
+                  f"（累計 {stats['processed']}件, {(stats['processed'] - processed_before) / run_elapsed:.1f} sessions/s）")
+        if use_checkpoint and not args.retry_failed:
+            stats["done"] = True
+            save_checkpoint(args.checkpoint, stats)
+    except KeyboardInterrupt:
+        print(f"⏸️ Interrupted; rerun to resume from {args.checkpoint}" if use_checkpoint else "⏸️ Interrupted")
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    run_elapsed = time.perf_counter() - started
+    run_processed = stats["processed"] - processed_before
+    print_summary(all_rows)
+    label = "Dry run" if args.dry_run else "完了"
+    print(f"{label}: {run_processed}件を {run_elapsed:.1f}秒で処理 "
+          f"（{run_processed / run_elapsed if run_elapsed > 0 else 0.0:.1f} sessions/s）"
+          f" 更新 {stats['updated']} / 変化なし {stats['unchanged']} / スキップ {stats['skipped']} / "
+          f"失敗 {len(stats['failed'])}")
+    if stats["failed"] and (use_checkpoint or args.retry_failed):
+        print(f"⚠️ Failed sessions are kept in {args.checkpoint}; rerun with --retry-failed")
+
+
+if __name__ == "__main__":
+    main()
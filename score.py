@@ -12,6 +12,17 @@ from google.cloud import firestore
 from pytz import timezone
 import os
 import numpy as np
+from telemetry_store import load_stream_columns
+from jerk import DEFAULT_MAX_GAP_MS, jerk_series, segment_ids, valid_sample_mask
+from online_score import JERK_THRESHOLD_G_PER_S, finalize_score_state, moments_std
+from score_timeline import (
+    TIMELINE_COLLECTION,
+    TIMELINE_DOC_ID,
+    TIMELINE_MODE,
+    TIMELINE_SEGMENT,
+    segment_stats,
+    timeline_document,
+)
 
 # ==========================================================
 #  基本設定
@@ -83,14 +94,22 @@ class ScoringStrategy(ABC):
 
 # ===== ジャーク計算器 =====
 class JerkCalculator(ScoreCalculatorBase):
-    """ジャーク（加加速度）計算クラス"""
+    """
+    ジャーク（加加速度）計算クラス
+    微分は実際の timestamp_ms の間隔で行い、max_gap_ms を超える途切れはまたがない。
+    resample=True（既定）では区間ごとに sample_rate_hz の格子へ揃えてから数えるので、
+    端末のサンプリングレートが違ってもイベント数を同じ基準で比べられる。
+    """
     
     MIN_DATA_POINTS = 2
-    MIN_TIME_DELTA_MS = 0.001
+    MIN_DISTANCE_KM = 0.1
     
-    def __init__(self, threshold_g_per_s: float = 0.5):
+    def __init__(self, threshold_g_per_s: float = 0.5, max_gap_ms: float = DEFAULT_MAX_GAP_MS,
+                 resample: bool = True):
         super().__init__()
         self._threshold_g_per_s = threshold_g_per_s
+        self._max_gap_ms = max_gap_ms
+        self._resample = resample
         self._weight_parameters = {
             'jerk_z_weight': 1.0,
             'jerk_x_weight': 1.0
@@ -103,7 +122,9 @@ class JerkCalculator(ScoreCalculatorBase):
         Args:
             data: {
                 'avg_g_logs': list of dicts,
-                'sample_rate_hz': float
+                'avg_g_columns': dict of np.ndarray（telemetry_storeの列。avg_g_logsより優先）,
+                'sample_rate_hz': float（再サンプリングの格子。timestamp_ms が無いログはこの間隔とみなす）,
+                'distance_km': float（セッションの走行距離。無ければ速度×時間で見積もる）
             }
         
         Returns:
@@ -112,22 +133,21 @@ class JerkCalculator(ScoreCalculatorBase):
         if not self._validate_data(data):
             raise ValueError("Invalid data for jerk calculation")
         
-        avg_g_logs = data.get('avg_g_logs', [])
-        sample_rate_hz = data.get('sample_rate_hz', 10.0)
+        sample_rate_hz = float(data.get('sample_rate_hz') or 10.0)
         
         # Numpy配列化
-        gz_vals = np.array([float(g.get("g_z", 0.0)) for g in avg_g_logs])
-        gx_vals = np.array([float(g.get("g_x", 0.0)) for g in avg_g_logs])
-        speeds = np.array([float(g.get("speed", 0.0)) for g in avg_g_logs])
+        timestamps, gz_vals, gx_vals, speeds = self._extract_arrays(data, sample_rate_hz)
         
         # データ点数が少ない場合の早期リターン
         if len(gz_vals) < self.MIN_DATA_POINTS:
             return self._get_empty_jerk_stats(len(gz_vals))
         
-        # ジャーク計算
-        dt = 1.0 / float(sample_rate_hz)
-        jerk_z = self._calculate_jerk_from_acceleration(gz_vals, dt)
-        jerk_x = self._calculate_jerk_from_acceleration(gx_vals, dt)
+        # ジャーク計算（実際の時刻差で微分し、途切れで区切る）
+        resample_hz = sample_rate_hz if self._resample else None
+        series = jerk_series(timestamps, (gz_vals, gx_vals), self._max_gap_ms, resample_hz)
+        jerk_z, jerk_x = series.jerks
+        if len(jerk_z) == 0:
+            return self._get_empty_jerk_stats(len(gz_vals))
         
         # イベントカウント
         jerk_z_count = int(np.sum(np.abs(jerk_z) > self._threshold_g_per_s))
@@ -137,13 +157,7 @@ class JerkCalculator(ScoreCalculatorBase):
         speed_std = float(np.std(speeds)) if len(speeds) > 1 else 0.0
         
         # 走行距離
-        total_distance_km = avg_g_logs[-1].get("distance_km", 1.0)
-        try:
-            total_distance_km = float(total_distance_km)
-        except Exception:
-            total_distance_km = 1.0
-        if total_distance_km < 0.1:
-            total_distance_km = 0.1
+        total_distance_km, distance_source = self._resolve_distance(data, timestamps, speeds)
         
         # 正規化指標
         total_events = jerk_z_count + jerk_x_count
@@ -166,7 +180,54 @@ class JerkCalculator(ScoreCalculatorBase):
             "stability_score": stability_ratio,
             "speed_std": float(speed_std),
             "total_distance_km": float(total_distance_km),
+            "distance_source": distance_source,
             "data_points": len(gz_vals),
+            "segments": series.segments,
+            "gaps": series.gaps,
+            "duration_s": round(series.duration_s, 3),
+            "resample_hz": resample_hz,
+        }
+    
+    def calculate_from_state(self, state: Dict[str, Any], distance_km: Optional[float] = None) -> Dict[str, Any]:
+        """
+        online_score の score_state から calculate と同じ形のジャーク統計を作る
+        distance_km を省略した場合は GPS 集計の距離（無ければ速度×時間）を使う。
+        閾値・格子は state に記録された値を使う。
+        """
+        final = finalize_score_state(state)
+        jerk_z, jerk_x = final['jerk']['z'], final['jerk']['x']
+        if final['data_points'] < self.MIN_DATA_POINTS or jerk_z['n'] == 0:
+            return self._get_empty_jerk_stats(final['data_points'])
+        
+        if distance_km is not None and distance_km > 0:
+            total_distance_km, distance_source = max(self.MIN_DISTANCE_KM, float(distance_km)), "session"
+        elif final['gps_distance_km'] > 0:
+            total_distance_km, distance_source = max(self.MIN_DISTANCE_KM, final['gps_distance_km']), "gps_aggregate"
+        else:
+            total_distance_km, distance_source = max(self.MIN_DISTANCE_KM, final['speed_integral_km']), "speed_integral"
+        
+        total_events = jerk_z['events'] + jerk_x['events']
+        jerk_count = jerk_z['n'] + jerk_x['n']
+        return {
+            "jerk_z_count": jerk_z['events'],
+            "jerk_z_mean": jerk_z['sum_abs'] / jerk_z['n'],
+            "jerk_z_max": jerk_z['max_abs'],
+            "jerk_z_std": moments_std(jerk_z),
+            "jerk_x_count": jerk_x['events'],
+            "jerk_x_mean": jerk_x['sum_abs'] / jerk_x['n'],
+            "jerk_x_max": jerk_x['max_abs'],
+            "jerk_x_std": moments_std(jerk_x),
+            "total_jerk_events": total_events,
+            "jerk_events_per_km": float(total_events / total_distance_km),
+            "stability_score": float((jerk_z['stable'] + jerk_x['stable']) / jerk_count),
+            "speed_std": moments_std(final['speed']) if final['speed']['n'] > 1 else 0.0,
+            "total_distance_km": float(total_distance_km),
+            "distance_source": distance_source,
+            "data_points": final['data_points'],
+            "segments": final['segments'],
+            "gaps": final['gaps'],
+            "duration_s": round(final['duration_s'], 3),
+            "resample_hz": final['rate_hz'],
         }
     
     def normalize_score(self, raw_score: float) -> float:
@@ -181,11 +242,57 @@ class JerkCalculator(ScoreCalculatorBase):
         """閾値を設定"""
         self._threshold_g_per_s = threshold
     
-    def _calculate_jerk_from_acceleration(self, acc_data: np.ndarray, dt: float) -> np.ndarray:
-        """加速度データからジャークを計算"""
-        if dt < self.MIN_TIME_DELTA_MS:
-            raise ValueError(f"Time delta too small: {dt}")
-        return np.diff(acc_data) / dt
+    def _extract_arrays(self, data: Dict[str, Any], sample_rate_hz: float
+                        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        入力（列 or dictのリスト）から timestamp_ms, g_z, g_x, speed の配列を取り出す
+        timestamp_ms が無いログは sample_rate_hz の等間隔とみなす
+        """
+        columns = data.get('avg_g_columns')
+        if columns is not None:
+            gz_vals = np.asarray(columns['g_z'], dtype=np.float64)
+            timestamps = columns.get('timestamp_ms')
+            return (
+                np.asarray(timestamps, dtype=np.float64) if timestamps is not None
+                else np.arange(len(gz_vals)) * (1000.0 / sample_rate_hz),
+                gz_vals,
+                np.asarray(columns['g_x'], dtype=np.float64),
+                np.asarray(columns['speed'], dtype=np.float64),
+            )
+        avg_g_logs = data.get('avg_g_logs', [])
+        gz_vals = np.array([float(g.get("g_z", 0.0)) for g in avg_g_logs])
+        gx_vals = np.array([float(g.get("g_x", 0.0)) for g in avg_g_logs])
+        speeds = np.array([float(g.get("speed", 0.0)) for g in avg_g_logs])
+        if avg_g_logs and all(g.get("timestamp_ms") is not None for g in avg_g_logs):
+            timestamps = np.array([float(g["timestamp_ms"]) for g in avg_g_logs])
+        else:
+            timestamps = np.arange(len(avg_g_logs)) * (1000.0 / sample_rate_hz)
+        return timestamps, gz_vals, gx_vals, speeds
+    
+    def _resolve_distance(self, data: Dict[str, Any], timestamps: np.ndarray,
+                          speeds: np.ndarray) -> Tuple[float, str]:
+        """
+        イベント密度の分母にする走行距離（km）と、その出どころ
+        session: 呼び出し側が渡したセッションの距離 / speed_integral: 速度×時間（途切れはまたがない）
+        """
+        try:
+            distance_km = float(data.get('distance_km'))
+        except (TypeError, ValueError):
+            distance_km = None
+        if distance_km is not None and math.isfinite(distance_km) and distance_km > 0:
+            return max(self.MIN_DISTANCE_KM, distance_km), "session"
+        
+        mask = valid_sample_mask(timestamps)
+        ts, speeds = timestamps[mask], speeds[mask]
+        if len(ts) < 2:
+            return self.MIN_DISTANCE_KM, "speed_integral"
+        ids = segment_ids(ts, self._max_gap_ms)
+        same_segment = ids[1:] == ids[:-1]
+        # 台形則（km/h × h）
+        mean_speed = (speeds[1:] + speeds[:-1]) / 2.0
+        hours = np.diff(ts) / 3_600_000.0
+        distance_km = float(np.sum(np.clip(mean_speed, 0.0, None)[same_segment] * hours[same_segment]))
+        return max(self.MIN_DISTANCE_KM, distance_km), "speed_integral"
     
     def _calculate_stability_ratio(self, jerk_data: np.ndarray) -> float:
         """安定性比率を計算（低ジャーク区間 / 全区間）"""
@@ -209,8 +316,13 @@ class JerkCalculator(ScoreCalculatorBase):
             "jerk_events_per_km": 0.0,
             "stability_score": 1.0,
             "speed_std": 0.0,
-            "total_distance_km": 0.1,
+            "total_distance_km": self.MIN_DISTANCE_KM,
+            "distance_source": None,
             "data_points": data_points,
+            "segments": 0,
+            "gaps": 0,
+            "duration_s": 0.0,
+            "resample_hz": None,
         }
 
 
@@ -266,6 +378,16 @@ class OverallScoreCalculator(ScoreCalculatorBase):
         
         return int(final_score), comment
     
+    def calculate_arrays(self, jerk_events_per_km: np.ndarray, speed_std: np.ndarray,
+                         stability_score: np.ndarray) -> np.ndarray:
+        """calculate と同じ式を配列でまとめて計算（区間ごとのスコア推移用）"""
+        A = self._weight_parameters['jerk_mean']
+        B = self._weight_parameters['jerk_max']
+        penalty = A * np.log1p(jerk_events_per_km) + B * np.log1p(speed_std)
+        bonus = np.minimum(10.0, stability_score * self._weight_parameters['stability'] * 10)
+        min_score, max_score = self._score_range
+        return np.floor(np.clip(self.BASE_SCORE - penalty + bonus, min_score, max_score)).astype(np.int64)
+    
     def normalize_score(self, raw_score: float) -> float:
         """スコアを0-100に正規化"""
         return self._clamp_score(raw_score)
@@ -365,14 +487,19 @@ WEIGHT_A = 3.0  # jerk（イベント密度）側の重み
 WEIGHT_B = 2.0  # speed_std（速度ばらつき）側の重み
 
 
-def calculate_jerk_and_stability(avg_g_logs: list, sample_rate_hz: float = 10.0) -> dict:
+def calculate_jerk_and_stability(avg_g_logs: list, sample_rate_hz: float = 10.0, avg_g_columns: Optional[dict] = None,
+                                 distance_km: Optional[float] = None) -> dict:
     """
     レガシー互換: ジャークと安定性指標の計算
+    avg_g_columns（列データ）を渡した場合はそちらを使う
+    distance_km（セッションの走行距離）が無い場合は速度×時間で見積もる
     """
-    calculator = JerkCalculator(threshold_g_per_s=0.5)
+    calculator = JerkCalculator(threshold_g_per_s=JERK_THRESHOLD_G_PER_S)
     return calculator.calculate({
         'avg_g_logs': avg_g_logs,
-        'sample_rate_hz': sample_rate_hz
+        'avg_g_columns': avg_g_columns,
+        'sample_rate_hz': sample_rate_hz,
+        'distance_km': distance_km,
     })
 
 
@@ -384,41 +511,65 @@ def calculate_overall_driving_score(jerk_stats: dict, A=WEIGHT_A, B=WEIGHT_B) ->
     return calculator.calculate({'jerk_stats': jerk_stats})
 
 
-def calculate_session_overall_score(session_id: str, user_id: str, sample_rate_hz: float = 10.0) -> dict:
+def calculate_online_score(score_state: dict, distance_km: Optional[float] = None) -> dict:
     """
-    総合スコア解析（Firestore読み込み→計算→保存）
+    受信時に更新した score_state（online_score）から総合スコアを計算する（Firestoreは読まない）
+    走行中は暫定スコア、終了時（distance_km = セッションの距離）は最終スコアになる。
     """
-    sess_ref = db.collection("sessions").document(session_id)
-    
-    # ログの読み込み
-    avg_g_logs = [
-        d.to_dict()
-        for d in sess_ref.collection("avg_g_logs").order_by("timestamp").stream()
-    ]
-    
-    if not avg_g_logs or len(avg_g_logs) < 5:
-        print(f"⚠️ ログデータが非常に少ないです（{len(avg_g_logs)}点）。参考値としてスコアを計算します。")
-        jerk_stats = calculate_jerk_and_stability(avg_g_logs, sample_rate_hz=sample_rate_hz)
-        overall_score, score_comment = calculate_overall_driving_score(jerk_stats)
-        score_comment = "データ点数が少ないため参考値です。" + score_comment
-        score_data = {
-            "overall_score": overall_score,
-            "score_comment": score_comment,
-            "calculated_at": datetime.now(JST),
-            "jerk_stats": jerk_stats,
-            "weights": {"A": WEIGHT_A, "B": WEIGHT_B},
-            "scoring_mode": "improved_log1p",
-        }
-        sess_ref.update(score_data)
-        return score_data
-    
-    # ジャーク＆安定性指標
-    jerk_stats = calculate_jerk_and_stability(avg_g_logs, sample_rate_hz=sample_rate_hz)
-    
-    # スコア計算
+    jerk_stats = JerkCalculator(threshold_g_per_s=score_state['threshold_g_per_s'],
+                                max_gap_ms=score_state['max_gap_ms']).calculate_from_state(score_state, distance_km)
+    overall_score, score_comment = calculate_overall_driving_score(jerk_stats)
+    return {
+        "overall_score": overall_score,
+        "score_comment": score_comment,
+        "jerk_stats": jerk_stats,
+        "weights": {"A": WEIGHT_A, "B": WEIGHT_B},
+        "scoring_mode": "improved_log1p",
+    }
+
+
+def calculate_score_timeline(avg_g_columns: dict, sample_rate_hz: float = 10.0, mode: str = TIMELINE_MODE,
+                             size: float = TIMELINE_SEGMENT) -> Optional[dict]:
+    """
+    区間ごとのスコア推移（詳細画面の地図の色分け用）。データが足りなければ None
+    総合スコアと同じ重み・閾値を区間ごとの指標に適用する。
+    """
+    stats = segment_stats(avg_g_columns["timestamp_ms"], avg_g_columns["g_z"], avg_g_columns["g_x"],
+                          avg_g_columns["speed"], JERK_THRESHOLD_G_PER_S, sample_rate_hz, mode=mode, size=size)
+    if stats is None:
+        return None
+    calculator = OverallScoreCalculator(weight_jerk_mean=WEIGHT_A, weight_jerk_max=WEIGHT_B, weight_stability=1.0)
+    scores = calculator.calculate_arrays(stats["jerk_events_per_km"], stats["speed_std"], stats["stability_score"])
+    return timeline_document(stats, scores, mode, size, JERK_THRESHOLD_G_PER_S)
+
+
+def score_timeline_ref(sess_ref):
+    """スコア推移の保存先（sessions/{id}/analysis/score_timeline）"""
+    return sess_ref.collection(TIMELINE_COLLECTION).document(TIMELINE_DOC_ID)
+
+
+def scoring_params(sample_rate_hz: float = 10.0) -> dict:
+    """現在のスコア計算の設定（重み・閾値を変えたら保存済みのスコアは再計算が必要）"""
+    return {
+        "A": WEIGHT_A,
+        "B": WEIGHT_B,
+        "threshold_g_per_s": JERK_THRESHOLD_G_PER_S,
+        "sample_rate_hz": float(sample_rate_hz),
+        "scoring_mode": "improved_log1p",
+    }
+
+
+def score_session_columns(avg_g_columns: dict, distance_km: Optional[float] = None,
+                          sample_rate_hz: float = 10.0) -> dict:
+    """
+    avg_g_logs の列から保存用の総合スコアを計算する（Firestoreは読み書きしない）
+    calculate_session_overall_score と再計算スクリプト（rescore_sessions.py）で共通
+    """
+    data_points = len(avg_g_columns["timestamp_ms"])
+    jerk_stats = calculate_jerk_and_stability([], sample_rate_hz=sample_rate_hz, avg_g_columns=avg_g_columns,
+                                              distance_km=distance_km)
     overall_score, score_comment = calculate_overall_driving_score(jerk_stats)
     
-    # Firestoreに保存
     score_data = {
         "overall_score": overall_score,
         "score_comment": score_comment,
@@ -427,8 +578,53 @@ def calculate_session_overall_score(session_id: str, user_id: str, sample_rate_h
         "weights": {"A": WEIGHT_A, "B": WEIGHT_B},
         "scoring_mode": "improved_log1p",
         "sample_rate_hz_used": float(sample_rate_hz),
+        "score_source": "batch",
     }
+    if data_points < 5:
+        print(f"⚠️ ログデータが非常に少ないです（{data_points}点）。参考値としてスコアを計算します。")
+        score_data["score_comment"] = "データ点数が少ないため参考値です。" + score_comment
+    return score_data
+
+
+def calculate_session_overall_score(session_id: str, user_id: str, sample_rate_hz: float = 10.0,
+                                    telemetry=None) -> dict:
+    """
+    総合スコア解析（Firestore読み込み→計算→保存）
+    telemetry（SessionTelemetry）を渡すと、読み込み済みのログを使い回す。
+    """
+    sess_ref = db.collection("sessions").document(session_id)
+    
+    # イベント密度の分母（/sessions/end で保存した走行距離）
+    sess_doc = sess_ref.get()
+    sess_data = (sess_doc.to_dict() or {}) if sess_doc.exists else {}
+    distance_km = sess_data.get("distance")
+    
+    # ログの読み込み（チャンク→列）
+    if telemetry is not None:
+        avg_g_columns = telemetry.columns("avg_g_logs")
+    else:
+        avg_g_columns = load_stream_columns(sess_ref, "avg_g_logs")
     
+    # ジャーク＆安定性指標・スコア計算
+    score_data = score_session_columns(avg_g_columns, distance_km, sample_rate_hz)
+    overall_score = score_data["overall_score"]
+    
+    # /sessions/end で確定したオンライン計算のスコアとの差（一致の確認用）
+    if sess_data.get("score_source") == "online":
+        online_score = sess_data.get("overall_score")
+        print(f"🔁 Session {session_id} online={online_score} / batch={overall_score}"
+              f"（差 {overall_score - online_score if online_score is not None else 'N/A'}）")
+    
+    # Firestoreに保存
     sess_ref.update(score_data)
     print(f"✅ Session {session_id} の総合スコア: {overall_score}点（log1p改良版 / A={WEIGHT_A}, B={WEIGHT_B}）で更新")
+    
+    # 区間ごとのスコア推移（失敗しても総合スコアはそのまま）
+    try:
+        timeline = calculate_score_timeline(avg_g_columns, sample_rate_hz)
+        if timeline is not None:
+            score_timeline_ref(sess_ref).set({**timeline, "calculated_at": datetime.now(JST)})
+            print(f"🗺️ Session {session_id} のスコア推移: {timeline['count']}区間（{timeline['mode']} / {timeline['segment_size']}）")
+    except Exception as e:
+        print(f"⚠️ Score timeline error for {session_id}: {e}")
     return score_data
@@ -0,0 +1,484 @@
+"""
+総合スコアの重み・閾値をオフラインで比較する実験スクリプト
+
+1. export: Firestore のセッションを1回だけ読み、スコア計算に必要な値をコンパクトな配列（.npz）に書き出す
+   - セッションごとの |ジャーク| のヒストグラム（bin_width 刻み。閾値はビンの境界で評価するので厳密）
+   - 速度の標準偏差・距離・データ点数・急操作の回数・現在のスコア
+   - user_feedback の評価（運転時間が重なるセッションに対応付け）
+     satisfaction: 満足度（1〜5） / strictness: 判定の厳しさ（厳しすぎた=+1, 甘すぎた=-1, 適切だった=0 の平均）
+2. run: 書き出した .npz だけを読み（Firestore 不要）、重み・閾値の全組み合わせをまとめて NumPy で評価する
+   - スコアの分布（平均・標準偏差・分位点・コメントの帯ごとの割合）
+   - 現在の設定との順位の変化（Spearman の順位相関・パーセンタイル順位の平均移動量）
+   - ユーザー評価との順位相関
+
+使い方:
+    python score_experiments.py export --out corpus.npz
+    python score_experiments.py run corpus.npz --grid A=1:5:0.5 B=0.5,1,2,3 threshold=0.3:0.8:0.1
+    python score_experiments.py run corpus.npz --model strategy --grid A=2,3,4 brake=1,2,3 --out results.csv
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+# ===== 設定 =====
+# 現在の設定（score.py の WEIGHT_A / WEIGHT_B・JERK_THRESHOLD_G_PER_S・各クラスの定数と同じ値）
+MODEL_DEFAULTS = {
+    # OverallScoreCalculator（総合スコア）
+    "overall": {"A": 3.0, "B": 2.0, "stability": 1.0, "threshold": 0.5},
+    # JerkStabilityScoringStrategy（急操作の回数による減点・安定性と距離のボーナス）
+    "strategy": {"A": 3.0, "B": 2.0, "threshold": 0.5,
+                 "accel": 2.0, "brake": 2.0, "turn": 1.5, "speed": 3.0},
+}
+VIOLATION_FIELDS = ["sudden_accels", "sudden_brakes", "sharp_turns", "speed_violations"]
+RATING_FIELDS = ["satisfaction", "strictness"]
+# user_feedback の判定評価（リアルタイムアドバイスが厳しすぎたか）
+STRICTNESS_VALUES = {"厳しすぎた": 1.0, "適切だった": 0.0, "甘すぎた": -1.0}
+# 運転時間の前後この範囲に開始したセッションを対応付ける
+FEEDBACK_MATCH_MARGIN = timedelta(minutes=15)
+# コメントが変わるスコアの帯（OverallScoreCalculator._generate_comment）
+SCORE_BANDS = [90, 80, 70, 50]
+MIN_DISTANCE_KM = 0.1
+DEFAULT_BIN_WIDTH = 0.005
+DEFAULT_MAX_THRESHOLD = 3.0
+CONFIG_BLOCK = 256          # 一度に評価する設定の数（メモリ上限）
+
+
+# ===== コーパス =====
+@dataclass
+class Corpus:
+    """セッションごとのスコア計算用の値（run では Firestore を使わずこれだけで計算する）"""
+    session_ids: np.ndarray
+    user_ids: np.ndarray
+    jerk_hist: np.ndarray       # (N, bins + 1) |ジャーク| のヒストグラム（最後の列は max_threshold 以上）
+    bin_width: float
+    speed_std: np.ndarray
+    distance_km: np.ndarray     # イベント密度の分母（score.py と同じく MIN_DISTANCE_KM 以上）
+    data_points: np.ndarray
+    violations: np.ndarray      # (N, 4) VIOLATION_FIELDS の順
+    stored_score: np.ndarray    # 保存済みの overall_score（無ければ nan）
+    baseline_score: np.ndarray  # export 時に score.py で計算した現在の設定のスコア
+    ratings: Dict[str, np.ndarray]
+
+    def __len__(self):
+        return len(self.session_ids)
+
+    @property
+    def max_threshold(self) -> float:
+        return (self.jerk_hist.shape[1] - 1) * self.bin_width
+
+    def save(self, path: str, meta: Optional[dict] = None) -> None:
+        np.savez_compressed(
+            path,
+            session_ids=self.session_ids, user_ids=self.user_ids,
+            jerk_hist=self.jerk_hist, bin_width=self.bin_width,
+            speed_std=self.speed_std, distance_km=self.distance_km, data_points=self.data_points,
+            violations=self.violations, stored_score=self.stored_score, baseline_score=self.baseline_score,
+            **{f"rating_{name}": values for name, values in self.ratings.items()},
+            meta=json.dumps(meta or {}, ensure_ascii=False),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Corpus":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                session_ids=data["session_ids"], user_ids=data["user_ids"],
+                jerk_hist=data["jerk_hist"], bin_width=float(data["bin_width"]),
+                speed_std=data["speed_std"], distance_km=data["distance_km"], data_points=data["data_points"],
+                violations=data["violations"], stored_score=data["stored_score"],
+                baseline_score=data["baseline_score"],
+                ratings={key[len("rating_"):]: data[key] for key in data.files if key.startswith("rating_")},
+            )
+
+
+def jerk_histogram(abs_jerk: np.ndarray, bin_width: float, bins: int) -> np.ndarray:
+    """|ジャーク| を bin_width 刻みで数える（bins 以上は最後の列にまとめる）"""
+    index = np.minimum(np.floor(abs_jerk / bin_width), bins).astype(np.int64)
+    return np.bincount(index, minlength=bins + 1).astype(np.uint32)
+
+
+# ===== ベクトル化したスコア計算 =====
+class GridEvaluator:
+    """コーパスに対して、設定の組み合わせごとの全セッションのスコアをまとめて計算する"""
+
+    def __init__(self, corpus: Corpus):
+        self.corpus = corpus
+        hist = corpus.jerk_hist.astype(np.float64)
+        # above[:, b] = ビン b 以上の個数 / below[:, b] = ビン b より下の個数
+        self._above = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+        self._below = np.cumsum(hist, axis=1) - hist
+        self._jerk_count = hist.sum(axis=1)
+        self._has_jerk = self._jerk_count > 0
+        self._has_data = corpus.data_points > 0
+
+    def _bin(self, values: np.ndarray) -> np.ndarray:
+        """閾値をビンの境界に対応付ける（境界に乗らない閾値は近い境界に丸めて警告）"""
+        raw = np.asarray(values, dtype=np.float64) / self.corpus.bin_width
+        index = np.rint(raw).astype(np.int64)
+        if np.any(np.abs(raw - index) > 1e-6):
+            print(f"⚠️ Thresholds are rounded to multiples of {self.corpus.bin_width} G/s")
+        if np.any(index >= self.corpus.jerk_hist.shape[1] - 1):
+            raise ValueError(f"threshold must be < {self.corpus.max_threshold} G/s (export with a larger --max-threshold)")
+        return index
+
+    def jerk_terms(self, thresholds: np.ndarray):
+        """閾値ごとの (イベント密度, 安定性比率)。形は (設定数, セッション数)"""
+        events = self._above[:, self._bin(thresholds)].T
+        stable = self._below[:, self._bin(0.5 * np.asarray(thresholds))].T
+        count = np.where(self._has_jerk, self._jerk_count, 1.0)
+        events_per_km = np.where(self._has_jerk, events / self.corpus.distance_km, 0.0)
+        stability = np.where(self._has_jerk, stable / count, 1.0)
+        return events_per_km, stability
+
+    def scores(self, model: str, params: Dict[str, np.ndarray]) -> np.ndarray:
+        """params の各列（長さ = 設定数）に対する全セッションのスコア (設定数, セッション数)"""
+        column = {name: np.asarray(values, dtype=np.float64)[:, None] for name, values in params.items()}
+        # 閾値で決まる項は閾値ごとに1回だけ計算して、各設定に割り当てる
+        thresholds, inverse = np.unique(params["threshold"], return_inverse=True)
+        events_per_km, stability = self.jerk_terms(thresholds)
+        log_events, stability = np.log1p(events_per_km)[inverse], stability[inverse]
+        # ジャークが取れないセッションは score.py と同じく速度のばらつきも 0 とみなす
+        log_speed = np.log1p(np.where(self._has_jerk, self.corpus.speed_std, 0.0))
+        penalty = column["A"] * log_events + column["B"] * log_speed
+
+        if model == "overall":
+            bonus = np.minimum(10.0, stability * column["stability"] * 10)
+            scores = np.floor(np.clip(100.0 - penalty + bonus, 0.0, 100.0))
+        elif model == "strategy":
+            v = self.corpus.violations.astype(np.float64)
+            violation_penalty = (v[:, 0] * column["accel"] + v[:, 1] * column["brake"]
+                                 + v[:, 2] * column["turn"] + v[:, 3] * column["speed"])
+            distance = self.corpus.distance_km
+            distance_bonus = np.where(distance > 50.0, 5.0, np.where(distance > 20.0, 2.0, 0.0))
+            scores = np.minimum(100.0, np.maximum(0.0, 100.0 - penalty - violation_penalty)
+                                + stability * 10.0 + distance_bonus)
+        else:
+            raise ValueError(f"unknown model: {model}")
+        # データが無いセッションは 0 点（OverallScoreCalculator の「データ不足」）
+        return np.where(self._has_data, scores, 0.0)
+
+
+# ===== 統計 =====
+def rank_rows(values: np.ndarray) -> np.ndarray:
+    """各行の順位（1始まり。同順位は平均順位）"""
+    values = np.asarray(values, dtype=np.float64)
+    rows, n = values.shape
+    if values.size and values.min() >= 0 and values.max() <= 1000 and np.all(values == np.floor(values)):
+        # 整数のスコア（overall）は値ごとの個数から求める（ソート不要）
+        k = int(values.max()) + 1
+        index = values.astype(np.int64)
+        counts = np.bincount((index + np.arange(rows)[:, None] * k).ravel(), minlength=rows * k).reshape(rows, k)
+        average = np.cumsum(counts, axis=1) - counts + (counts + 1) / 2.0
+        return np.take_along_axis(average, index, axis=1)
+    order = np.argsort(values, axis=1, kind="stable")
+    ordered = np.take_along_axis(values, order, axis=1)
+    # 同じ値が続く区間の先頭・末尾の位置から平均順位を求める
+    position = np.broadcast_to(np.arange(n), (rows, n))
+    new_group = np.ones((rows, n), dtype=bool)
+    new_group[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    first = np.maximum.accumulate(np.where(new_group, position, 0), axis=1)
+    last_group = np.ones((rows, n), dtype=bool)
+    last_group[:, :-1] = new_group[:, 1:]
+    last = np.minimum.accumulate(np.where(last_group, position, n - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty((rows, n))
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1.0, axis=1)
+    return ranks
+
+
+def corr_rows(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """x の各行と y の相関係数（どちらかが一定なら nan）"""
+    xc = x - x.mean(axis=1, keepdims=True)
+    yc = y - y.mean()
+    denom = np.sqrt((xc ** 2).sum(axis=1) * (yc ** 2).sum())
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denom > 0, (xc @ yc) / denom, np.nan)
+
+
+def summarize_scores(scores: np.ndarray, baseline: np.ndarray, ratings: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """設定ごとの分布・順位の変化・ユーザー評価との順位相関（各値は長さ = 設定数）"""
+    n = scores.shape[1]
+    p10, p50, p90 = np.percentile(scores, [10, 50, 90], axis=1)
+    summary = {
+        "mean": scores.mean(axis=1),
+        "std": scores.std(axis=1),
+        "p10": p10,
+        "p50": p50,
+        "p90": p90,
+    }
+    for band in SCORE_BANDS:
+        summary[f"share_ge{band}"] = (scores >= band).mean(axis=1)
+
+    ranks = rank_rows(scores)
+    base_rank = rank_rows(baseline[None, :])[0]
+    summary["rho_baseline"] = corr_rows(ranks, base_rank)
+    # パーセンタイル順位の移動量（0〜100）
+    shift = np.abs(ranks - base_rank) / max(1, n - 1) * 100.0
+    summary["mean_rank_shift"] = shift.mean(axis=1)
+    summary["share_shift_ge10"] = (shift >= 10.0).mean(axis=1)
+
+    for name, rating in ratings.items():
+        rated = np.isfinite(rating)
+        if rated.sum() < 3:
+            continue
+        summary[f"rho_{name}"] = corr_rows(rank_rows(scores[:, rated]), rank_rows(rating[rated][None, :])[0])
+        summary[f"n_{name}"] = np.full(len(scores), int(rated.sum()))
+    return summary
+
+
+def histogram(scores: np.ndarray, width: int = 10) -> List[int]:
+    """スコアの度数分布（0-9, 10-19, ..., 90-100）"""
+    return np.bincount(np.minimum(scores // width, 100 // width - 1).astype(np.int64),
+                       minlength=100 // width).tolist()
+
+
+# ===== グリッド =====
+def parse_values(spec: str) -> List[float]:
+    """'1,2,3' または 'start:stop:step'（stop を含む）"""
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [round(start + i * step, 10) for i in range(count)]
+    return [float(v) for v in spec.split(",") if v]
+
+
+def build_grid(model: str, specs: List[str]) -> Dict[str, np.ndarray]:
+    """NAME=VALUES の指定から全組み合わせを作る（指定しない値は現在の設定。先頭は必ず現在の設定）"""
+    defaults = MODEL_DEFAULTS[model]
+    axes = {name: [value] for name, value in defaults.items()}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if name not in defaults:
+            raise ValueError(f"unknown parameter for {model}: {name} (choose from {', '.join(defaults)})")
+        axes[name] = parse_values(values)
+
+    names = list(axes)
+    combos = [dict(zip(names, combo)) for combo in itertools.product(*(axes[name] for name in names))]
+    combos = [defaults] + [c for c in combos if c != defaults]
+    return {name: np.array([c[name] for c in combos]) for name in names}
+
+
+def run_grid(corpus: Corpus, model: str, grid: Dict[str, np.ndarray]):
+    """全設定のスコアを CONFIG_BLOCK ずつ計算して集計する。(集計, 先頭=現在の設定のスコア)"""
+    evaluator = GridEvaluator(corpus)
+    total = len(next(iter(grid.values())))
+    baseline = evaluator.scores(model, {name: values[:1] for name, values in grid.items()})[0]
+    summaries = []
+    for start in range(0, total, CONFIG_BLOCK):
+        block = {name: values[start:start + CONFIG_BLOCK] for name, values in grid.items()}
+        summaries.append(summarize_scores(evaluator.scores(model, block), baseline, corpus.ratings))
+    summary = {key: np.concatenate([s[key] for s in summaries]) for key in summaries[0]}
+    return summary, baseline
+
+
+# ===== export（Firestore → .npz） =====
+def _parse_drive_time(value: str):
+    from config import JST
+    return datetime.strptime(value, "%Y-%m-%d %H:%M").replace(tzinfo=JST)
+
+
+def feedback_windows(db) -> Dict[str, List[dict]]:
+    """user_feedback をユーザーごとの (運転時間, 満足度, 厳しさ) に変換する"""
+    windows: Dict[str, List[dict]] = {}
+    for doc in db.collection("user_feedback").stream():
+        fb = doc.to_dict() or {}
+        strictness = [STRICTNESS_VALUES[v] for v in (fb.get("evaluations") or {}).values() if v in STRICTNESS_VALUES]
+        try:
+            satisfaction = float(fb.get("satisfaction"))
+        except (TypeError, ValueError):
+            satisfaction = math.nan
+        for drive in fb.get("drive_times") or []:
+            try:
+                start = _parse_drive_time(drive["start_datetime"])
+                end = _parse_drive_time(drive["end_datetime"])
+            except (KeyError, ValueError):
+                continue
+            if end < start:     # 日付をまたいだ運転
+                end += timedelta(days=1)
+            windows.setdefault(fb.get("user_id"), []).append({
+                "start": start - FEEDBACK_MATCH_MARGIN,
+                "end": end + FEEDBACK_MATCH_MARGIN,
+                "created_at": fb.get("created_at"),
+                "satisfaction": satisfaction,
+                "strictness": float(np.mean(strictness)) if strictness else math.nan,
+            })
+    return windows
+
+
+def match_feedback(windows: List[dict], start_time) -> Optional[dict]:
+    """セッションの開始時刻を含む運転時間の評価（複数あれば最新のもの）"""
+    if start_time is None:
+        return None
+    matches = [w for w in windows if w["start"] <= start_time <= w["end"]]
+    if not matches:
+        return None
+    return max(matches, key=lambda w: w["created_at"] or datetime.min.replace(tzinfo=w["start"].tzinfo))
+
+
+def export_corpus(args) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+    from google.cloud import firestore
+    from jerk import DEFAULT_MAX_GAP_MS, jerk_series
+    from score import calculate_jerk_and_stability, calculate_overall_driving_score
+    from telemetry_store import load_stream_columns
+
+    db = firestore.Client()
+    bins = int(round(args.max_threshold / args.bin_width))
+    windows = feedback_windows(db)
+    print(f"💬 user_feedback: {sum(len(w) for w in windows.values())} drive windows from {len(windows)} users")
+
+    query = db.collection("sessions").where("status", "==", "completed")
+    if args.user:
+        query = query.where("user_id", "==", args.user)
+    sessions = list(query.limit(args.limit).stream() if args.limit else query.stream())
+    print(f"📥 Exporting {len(sessions)} sessions")
+
+    def load(doc):
+        return doc, load_stream_columns(doc.reference, "avg_g_logs")
+
+    started = time.perf_counter()
+    rows = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for doc, columns in pool.map(load, sessions):
+            session = doc.to_dict() or {}
+            stats = calculate_jerk_and_stability([], sample_rate_hz=args.sample_rate, avg_g_columns=columns,
+                                                 distance_km=session.get("distance"))
+            series = jerk_series(columns["timestamp_ms"], (columns["g_z"], columns["g_x"]),
+                                 DEFAULT_MAX_GAP_MS, args.sample_rate)
+            abs_jerk = np.abs(np.concatenate(series.jerks))
+            feedback = match_feedback(windows.get(session.get("user_id"), []), session.get("start_time"))
+            stored = session.get("overall_score")
+            rows.append({
+                "session_id": doc.id,
+                "user_id": session.get("user_id") or "",
+                "jerk_hist": jerk_histogram(abs_jerk, args.bin_width, bins),
+                "speed_std": stats["speed_std"],
+                "distance_km": max(MIN_DISTANCE_KM, stats["total_distance_km"]),
+                "data_points": stats["data_points"],
+                "violations": [int(session.get(f, 0) or 0) for f in VIOLATION_FIELDS],
+                "stored_score": float(stored) if isinstance(stored, (int, float)) else math.nan,
+                "baseline_score": float(calculate_overall_driving_score(stats)[0]),
+                "satisfaction": feedback["satisfaction"] if feedback else math.nan,
+                "strictness": feedback["strictness"] if feedback else math.nan,
+            })
+
+    corpus = Corpus(
+        session_ids=np.array([r["session_id"] for r in rows], dtype=str),
+        user_ids=np.array([r["user_id"] for r in rows], dtype=str),
+        jerk_hist=np.array([r["jerk_hist"] for r in rows], dtype=np.uint32).reshape(len(rows), bins + 1),
+        bin_width=args.bin_width,
+        speed_std=np.array([r["speed_std"] for r in rows]),
+        distance_km=np.array([r["distance_km"] for r in rows]),
+        data_points=np.array([r["data_points"] for r in rows], dtype=np.int64),
+        violations=np.array([r["violations"] for r in rows], dtype=np.int64).reshape(len(rows), len(VIOLATION_FIELDS)),
+        stored_score=np.array([r["stored_score"] for r in rows]),
+        baseline_score=np.array([r["baseline_score"] for r in rows]),
+        ratings={name: np.array([r[name] for r in rows]) for name in RATING_FIELDS},
+    )
+    corpus.save(args.out, meta={
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+        "sample_rate_hz": args.sample_rate,
+        "max_gap_ms": DEFAULT_MAX_GAP_MS,
+    })
+    rated = {name: int(np.isfinite(values).sum()) for name, values in corpus.ratings.items()}
+    print(f"完了: {len(corpus)}件を {args.out} に書き出しました（{time.perf_counter() - started:.1f}秒, 評価あり {rated}）")
+
+
+# ===== run（.npz → 比較） =====
+def print_report(grid: Dict[str, np.ndarray], summary: Dict[str, np.ndarray], order: np.ndarray, top: int) -> None:
+    names = list(grid)
+    metrics = [key for key in ("mean", "std", "p10", "p50", "p90", "share_ge80", "rho_baseline", "mean_rank_shift",
+                               "rho_satisfaction", "rho_strictness") if key in summary]
+    print(" | ".join([f"{n:>9}" for n in names + metrics]))
+    for i in order[:top]:
+        cells = [f"{grid[n][i]:>9.3g}" for n in names] + [f"{summary[m][i]:>9.3f}" for m in metrics]
+        print(" | ".join(cells) + ("  ← current" if i == 0 else ""))
+
+
+def write_results(path: str, grid: Dict[str, np.ndarray], summary: Dict[str, np.ndarray], order: np.ndarray) -> None:
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        out = csv.writer(f)
+        out.writerow(["rank"] + list(grid) + list(summary))
+        for rank, i in enumerate(order, start=1):
+            out.writerow([rank] + [float(grid[n][i]) for n in grid] + [float(summary[k][i]) for k in summary])
+
+
+def run_experiment(args) -> None:
+    started = time.perf_counter()
+    corpus = Corpus.load(args.corpus)
+    loaded = time.perf_counter()
+    grid = build_grid(args.model, args.grid or [])
+    total = len(grid["threshold"])
+    print(f"📦 {len(corpus)} sessions, {total} configurations ({args.model})"
+          f" / ratings: {', '.join(f'{k}={int(np.isfinite(v).sum())}' for k, v in corpus.ratings.items())}")
+
+    summary, baseline = run_grid(corpus, args.model, grid)
+    elapsed = time.perf_counter() - loaded
+
+    if args.model == "overall":
+        # ベクトル化した計算が score.py（export 時）と一致するかの確認
+        mismatched = int(np.sum(baseline != corpus.baseline_score))
+        print(f"🔎 Current settings reproduce score.py for {len(corpus) - mismatched}/{len(corpus)} sessions")
+
+    # 並べ替え（nan は常に最後。指定が無く評価も無ければグリッドの順）
+    sort_key = args.sort or ("rho_satisfaction" if "rho_satisfaction" in summary else None)
+    if sort_key is None:
+        order = np.arange(total)
+    elif sort_key not in summary:
+        raise ValueError(f"unknown metric: {sort_key} (choose from {', '.join(summary)})")
+    else:
+        values = summary[sort_key] if args.ascending else -summary[sort_key]
+        order = np.argsort(np.nan_to_num(values, nan=np.inf), kind="stable")
+    print(f"⏱️ Loaded in {loaded - started:.2f}s, evaluated in {elapsed:.2f}s "
+          f"（{total * len(corpus) / max(elapsed, 1e-9):,.0f} session-configs/s） / sorted by {sort_key or 'grid order'}")
+    print_report(grid, summary, order, args.top)
+
+    evaluator = GridEvaluator(corpus)
+    for i in [0] + [int(i) for i in order[:1] if i != 0]:
+        scores = evaluator.scores(args.model, {n: v[i:i + 1] for n, v in grid.items()})[0]
+        label = "current" if i == 0 else "best"
+        print(f"📊 Histogram ({label}, 10点刻み): {histogram(scores)}")
+
+    if args.out:
+        write_results(args.out, grid, summary, order)
+        print(f"完了: {total}件の設定の結果を {args.out} に書き出しました")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="総合スコアの重み・閾値のオフライン比較")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="Firestore のセッションを .npz に書き出す")
+    export.add_argument("--out", required=True, help="書き出す .npz")
+    export.add_argument("--user", help="対象ユーザーID（省略時は全ユーザー）")
+    export.add_argument("--limit", type=int, help="書き出すセッション数の上限")
+    export.add_argument("--sample-rate", type=float, default=10.0, help="ジャーク計算の格子（Hz）")
+    export.add_argument("--bin-width", type=float, default=DEFAULT_BIN_WIDTH, help="|ジャーク| のヒストグラムの刻み（G/s）")
+    export.add_argument("--max-threshold", type=float, default=DEFAULT_MAX_THRESHOLD, help="評価できる閾値の上限（G/s）")
+    export.add_argument("--workers", type=int, default=8, help="読み込みの並列数")
+
+    run = sub.add_parser("run", help="書き出した .npz で設定の組み合わせを比較する（Firestore 不要）")
+    run.add_argument("corpus", help="export で作った .npz")
+    run.add_argument("--model", choices=sorted(MODEL_DEFAULTS), default="overall", help="スコアの計算方法")
+    run.add_argument("--grid", nargs="*", help="NAME=1,2,3 または NAME=start:stop:step（例: A=1:5:0.5 threshold=0.3,0.5）")
+    run.add_argument("--sort", help="並べ替える指標（既定: rho_satisfaction。評価が無ければグリッドの順）")
+    run.add_argument("--ascending", action="store_true", help="小さい順に並べる（mean_rank_shift など）")
+    run.add_argument("--top", type=int, default=15, help="表示する設定の数")
+    run.add_argument("--out", help="全設定の結果を書き出す CSV")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_corpus(args)
+    else:
+        run_experiment(args)
+
+
+if __name__ == "__main__":
+    main()
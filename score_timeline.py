@@ -0,0 +1,153 @@
+# score_timeline.py
+"""
+区間ごとのスコア推移（地図の色分け用）の集計機能モジュール（NumPyでベクトル化）
+走行全体の総合スコアと同じ指標（ジャークのイベント密度・速度のばらつき・安定性）を、
+一定時間（例: 30秒）または一定距離（例: 200m）ごとの区間で集計する。
+
+- cumulative_distance_km 各サンプルまでの走行距離（速度×時間）
+- segment_keys           各時刻がどの区間に入るか（時間 / 累積距離で区切る）
+- segment_stats          区間ごとのイベント数・ジャークの平均/最大・速度・距離（bincount で一括集計）
+- timeline_document      Firestore に保存する列形式のドキュメント
+- assign_segments        GPSログの各点が入る区間（詳細画面で地図の線を区間ごとに塗り分ける）
+
+スコアへの換算（重み）は score.py の OverallScoreCalculator が行う。
+保存先: sessions/{session_id}/analysis/score_timeline
+"""
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from jerk import DEFAULT_MAX_GAP_MS, jerk_series, segment_ids, valid_sample_mask
+
+
+# time: SCORE_TIMELINE_SEGMENT 秒ごと / distance: SCORE_TIMELINE_SEGMENT メートルごと
+TIMELINE_MODE = os.environ.get("SCORE_TIMELINE_MODE", "time")
+TIMELINE_SEGMENT = float(os.environ.get("SCORE_TIMELINE_SEGMENT", "200" if TIMELINE_MODE == "distance" else "30"))
+# 停車中の区間でイベント密度が極端にならないように、区間の距離はこれ以上とみなす
+SEGMENT_MIN_DISTANCE_KM = 0.05
+TIMELINE_COLLECTION = "analysis"
+TIMELINE_DOC_ID = "score_timeline"
+
+
+def cumulative_distance_km(timestamp_ms: np.ndarray, speed_kmh: np.ndarray,
+                           max_gap_ms: float = DEFAULT_MAX_GAP_MS) -> np.ndarray:
+    """各サンプルまでの走行距離（速度の台形積分。途切れはまたがない）"""
+    ts = np.asarray(timestamp_ms, dtype=float)
+    speed = np.clip(np.asarray(speed_kmh, dtype=float), 0.0, None)
+    if len(ts) < 2:
+        return np.zeros(len(ts))
+    ids = segment_ids(ts, max_gap_ms)
+    step = (speed[1:] + speed[:-1]) / 2.0 * np.diff(ts) / 3_600_000.0
+    step[ids[1:] != ids[:-1]] = 0.0
+    return np.concatenate(([0.0], np.cumsum(step)))
+
+
+def segment_keys(timestamp_ms: np.ndarray, distance_km: np.ndarray, t0_ms: float,
+                 mode: str = TIMELINE_MODE, size: float = TIMELINE_SEGMENT) -> np.ndarray:
+    """区間番号（time: 開始からの経過秒 / size、distance: 累積距離[m] / size）"""
+    if mode == "distance":
+        return np.floor(np.asarray(distance_km) * 1000.0 / size).astype(np.int64)
+    if mode == "time":
+        return np.floor((np.asarray(timestamp_ms, dtype=float) - t0_ms) / (size * 1000.0)).astype(np.int64)
+    raise ValueError(f"unknown timeline mode: {mode}")
+
+
+def segment_stats(timestamp_ms: np.ndarray, g_z: np.ndarray, g_x: np.ndarray, speed: np.ndarray,
+                  threshold_g_per_s: float, sample_rate_hz: float = 10.0,
+                  max_gap_ms: float = DEFAULT_MAX_GAP_MS, mode: str = TIMELINE_MODE,
+                  size: float = TIMELINE_SEGMENT) -> Optional[Dict[str, np.ndarray]]:
+    """
+    区間ごとの集計（データのある区間だけ。各値は区間数の長さの配列）
+    ジャークは score.py と同じく途切れで区切って sample_rate_hz の格子で求め、
+    その時刻（distance の場合は時刻から補間した累積距離）で区間に振り分ける。
+    """
+    mask = valid_sample_mask(timestamp_ms)
+    ts = np.asarray(timestamp_ms, dtype=float)[mask]
+    speed = np.asarray(speed, dtype=float)[mask]
+    if len(ts) < 2:
+        return None
+    series = jerk_series(ts, (np.asarray(g_z, dtype=float)[mask], np.asarray(g_x, dtype=float)[mask]),
+                         max_gap_ms, sample_rate_hz)
+    jerk_t = series.timestamps_ms
+    if len(jerk_t) == 0:
+        return None
+
+    distance_km = cumulative_distance_km(ts, speed, max_gap_ms)
+    sample_key = segment_keys(ts, distance_km, ts[0], mode, size)
+    jerk_key = segment_keys(jerk_t, np.interp(jerk_t, ts, distance_km), ts[0], mode, size)
+    n = int(max(sample_key[-1], jerk_key[-1])) + 1
+
+    # ジャーク（2チャンネルを同じ区間に数える）
+    abs_jerk = np.abs(np.concatenate(series.jerks))
+    keys = np.concatenate([jerk_key] * len(series.jerks))
+    jerk_count = np.bincount(keys, minlength=n)
+    events = np.bincount(keys, weights=abs_jerk > threshold_g_per_s, minlength=n)
+    stable = np.bincount(keys, weights=abs_jerk < threshold_g_per_s * 0.5, minlength=n)
+    jerk_sum = np.bincount(keys, weights=abs_jerk, minlength=n)
+    jerk_max = np.zeros(n)
+    np.maximum.at(jerk_max, keys, abs_jerk)
+
+    # 速度・距離・時刻（サンプルは時刻順なので区間番号も昇順）
+    sample_count = np.bincount(sample_key, minlength=n)
+    speed_sum = np.bincount(sample_key, weights=speed, minlength=n)
+    speed_sq = np.bincount(sample_key, weights=speed * speed, minlength=n)
+    step_km = np.bincount(sample_key[1:], weights=np.diff(distance_km), minlength=n)
+    first = np.searchsorted(sample_key, np.arange(n), side="left")
+    last = np.searchsorted(sample_key, np.arange(n), side="right") - 1
+
+    present = (sample_count > 0) & (jerk_count > 0)
+    samples = np.maximum(sample_count, 1)
+    speed_mean = speed_sum / samples
+    speed_std = np.sqrt(np.maximum(speed_sq / samples - speed_mean ** 2, 0.0))
+    distance_seg = np.maximum(step_km, SEGMENT_MIN_DISTANCE_KM)
+    count = np.maximum(jerk_count, 1)
+    return {
+        "start_ms": ts[first[present]],
+        "end_ms": ts[last[present]],
+        "distance_km": step_km[present],
+        "jerk_events": events[present].astype(np.int64),
+        "jerk_events_per_km": (events / distance_seg)[present],
+        "jerk_mean": (jerk_sum / count)[present],
+        "jerk_max": jerk_max[present],
+        "stability_score": (stable / count)[present],
+        "speed_mean": speed_mean[present],
+        "speed_std": speed_std[present],
+    }
+
+
+def timeline_document(stats: Dict[str, np.ndarray], scores: np.ndarray, mode: str = TIMELINE_MODE,
+                      size: float = TIMELINE_SEGMENT, threshold_g_per_s: Optional[float] = None) -> Dict[str, Any]:
+    """区間ごとの値を列（配列）で持つドキュメント（区間数に比例する小さなドキュメント）"""
+    return {
+        "mode": mode,
+        "segment_size": size,
+        "threshold_g_per_s": threshold_g_per_s,
+        "count": len(scores),
+        "columns": {
+            "start_ms": stats["start_ms"].astype(np.int64).tolist(),
+            "end_ms": stats["end_ms"].astype(np.int64).tolist(),
+            "score": np.asarray(scores, dtype=np.int64).tolist(),
+            "jerk_events": stats["jerk_events"].tolist(),
+            "jerk_events_per_km": np.round(stats["jerk_events_per_km"], 2).tolist(),
+            "jerk_mean": np.round(stats["jerk_mean"], 3).tolist(),
+            "jerk_max": np.round(stats["jerk_max"], 3).tolist(),
+            "speed_mean": np.round(stats["speed_mean"], 1).tolist(),
+            "distance_m": np.round(stats["distance_km"] * 1000.0, 1).tolist(),
+        },
+    }
+
+
+def assign_segments(timestamp_ms: np.ndarray, start_ms: np.ndarray, end_ms: np.ndarray,
+                    slack_ms: float = DEFAULT_MAX_GAP_MS) -> np.ndarray:
+    """各時刻（GPSログなど）が入る区間の番号（どの区間にも入らなければ -1）"""
+    ts = np.asarray(timestamp_ms, dtype=float)
+    start_ms = np.asarray(start_ms, dtype=float)
+    end_ms = np.asarray(end_ms, dtype=float)
+    if len(start_ms) == 0:
+        return np.full(len(ts), -1, dtype=np.int64)
+    # 区間の前後 slack_ms までは同じ区間とみなす（GPS と avg_g の時刻のずれ・区間の境目）
+    index = np.searchsorted(start_ms - slack_ms, ts, side="right") - 1
+    clipped = np.clip(index, 0, len(start_ms) - 1)
+    inside = (index >= 0) & (ts <= end_ms[clipped] + slack_ms)
+    return np.where(inside, clipped, -1).astype(np.int64)
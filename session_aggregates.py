@@ -0,0 +1,368 @@
+# session_aggregates.py
+"""
+セッション集計のインクリメンタル更新機能モジュール
+テレメトリを保存するたびに、距離・速度・件数・時刻範囲・イベント数を
+sessions/{id}.aggregates に加算していく。セッション終了・一覧表示はセッションドキュメント1件の読み込みで済む。
+
+sessions/{id}.aggregates:
+    distance_km               GPS点間のハバースイン距離の合計（飛び・停車中のふらつきは geodesy.filter_track で除く）
+    max_speed                 GPS速度の最大値（km/h）
+    speed_sum, speed_count    平均速度 = speed_sum / speed_count
+    first_ms, last_ms         全ストリームを通した最初・最後の timestamp_ms
+    counts.{stream}           ストリームごとのサンプル数
+    events.{event}            avg_g_logs の event 値ごとの件数（normal 以外）
+    seq.{stream}              集計済みの最大連番（再送分を二重に数えないため）
+    last_gps                  直前バッチの最後に採用したGPS点（次のバッチとの距離をつなぐため）
+    dirty                     一部の書き込みが失敗した。終了時に全件から再計算する
+
+sessions/{id}.ingest_cursor.{stream}:
+    先頭から抜けなく保存できた最大の連番。失敗したバッチの後に別のバッチが保存できても、
+    抜けを埋める再送が届くまでは進めない（集計と同じ前提条件つきの update で書く）
+
+sessions/{id}.score_state, provisional_score:
+    avg_g_logs のバッチごとに online_score の途中状態を更新し、暫定の総合スコアも書いておく
+
+last_gps・score_state は加算ではなく上書きなので、セッションの update は
+直前に読んだ・書いたときの update_time を前提条件にする。別のプロセス（複数ワーカー）が
+先に書き込んでいた場合はドキュメントから状態を読み直し、その状態にこのバッチを足してやり直す。
+"""
+import copy
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore import Client, Increment, Maximum, Minimum
+
+from geodesy import filter_track, segment_distances_km
+from online_score import add_gps_distance, new_score_state, update_score_state
+from ttl_cache import TTLCache
+from telemetry_store import SEQ_MISSING, STREAM_SCHEMAS, TEXT_DEFAULTS, advance_cursor, load_stream_columns
+
+
+# イベントは3ストリームすべてに入るため、音声通知と同時に必ず記録される avg_g_logs で数える
+EVENT_STREAM = 'avg_g_logs'
+
+# 他のプロセスの書き込みと競合したときに読み直してやり直す回数
+AGGREGATE_UPDATE_ATTEMPTS = 3
+
+_FIELD_NAME = re.compile(r'[^0-9A-Za-z_]')
+
+
+def _event_field(event: str) -> str:
+    """Firestoreのフィールドパスに使える名前にする"""
+    return _FIELD_NAME.sub('_', str(event)) or 'unknown'
+
+
+# ===== 全件からの集計 =====
+def compute_aggregates(columns_by_stream: Dict[str, Dict[str, np.ndarray]],
+                       prev_gps: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    列データから集計値を計算する（バッチ単位の差分・全件の再計算の両方で使う）
+    prev_gps を渡すと、その点からこのバッチの最初の点までの距離も distance_km に含める。
+    """
+    counts = {stream: 0 for stream in STREAM_SCHEMAS}
+    first_ms: Optional[int] = None
+    last_ms: Optional[int] = None
+    for stream, columns in columns_by_stream.items():
+        ts = columns['timestamp_ms']
+        counts[stream] = int(len(ts))
+        if len(ts):
+            first_ms = int(ts.min()) if first_ms is None else min(first_ms, int(ts.min()))
+            last_ms = int(ts.max()) if last_ms is None else max(last_ms, int(ts.max()))
+
+    aggregates: Dict[str, Any] = {
+        'distance_km': 0.0,
+        'max_speed': 0.0,
+        'speed_sum': 0.0,
+        'speed_count': 0,
+        'first_ms': first_ms,
+        'last_ms': last_ms,
+        'counts': counts,
+        'events': {},
+        'seq': {},
+        'last_gps': None,
+    }
+
+    gps = columns_by_stream.get('gps_logs')
+    if gps is not None and len(gps['timestamp_ms']):
+        order = np.argsort(gps['timestamp_ms'], kind='stable')
+        ts, speed = gps['timestamp_ms'][order], gps['speed'][order]
+        lat, lng, quality = gps['latitude'][order], gps['longitude'][order], gps['quality'][order]
+        aggregates['max_speed'] = float(speed.max())
+        aggregates['speed_sum'] = float(speed.sum())
+        aggregates['speed_count'] = int(len(speed))
+
+        # 直前バッチの最後の点を先頭に足して、バッチ間の距離も同じ基準でつなぐ
+        linked = prev_gps is not None and int(ts[0]) >= prev_gps['timestamp_ms']
+        if linked:
+            ts = np.concatenate([[prev_gps['timestamp_ms']], ts])
+            lat = np.concatenate([[prev_gps['latitude']], lat])
+            lng = np.concatenate([[prev_gps['longitude']], lng])
+            speed = np.concatenate([[np.inf], speed])
+            quality = np.concatenate([[TEXT_DEFAULTS['quality']], quality.astype(str)])
+        keep = filter_track(lat, lng, ts, speed, quality)
+        if linked:
+            keep[0] = True
+        aggregates['distance_km'] = float(segment_distances_km(lat[keep], lng[keep]).sum())
+
+        kept = np.flatnonzero(keep[1:] if linked else keep)
+        if len(kept):
+            last = kept[-1] + (1 if linked else 0)
+            aggregates['last_gps'] = {
+                'latitude': float(lat[last]),
+                'longitude': float(lng[last]),
+                'timestamp_ms': int(ts[last]),
+            }
+
+    events = columns_by_stream.get(EVENT_STREAM)
+    if events is not None and len(events['event']):
+        values, event_counts = np.unique(events['event'].astype(str), return_counts=True)
+        aggregates['events'] = {
+            _event_field(v): int(c) for v, c in zip(values.tolist(), event_counts.tolist()) if v != 'normal'
+        }
+
+    for stream, columns in columns_by_stream.items():
+        if len(columns['seq']):
+            aggregates['seq'][stream] = int(columns['seq'].max())
+    return aggregates
+
+
+def backfill_aggregates(session_ref, telemetry=None) -> Dict[str, Any]:
+    """
+    保存済みテレメトリを全件読み込んで aggregates を作り直す
+    集計の無い旧セッション、dirty なセッションの終了時に使う。
+    telemetry（SessionTelemetry）を渡すと、読み込み済みのストリームを使い回す。
+    """
+    if telemetry is not None:
+        columns_by_stream = telemetry.columns_by_stream()
+    else:
+        columns_by_stream = {stream: load_stream_columns(session_ref, stream) for stream in STREAM_SCHEMAS}
+    aggregates = compute_aggregates(columns_by_stream)
+    aggregates['dirty'] = False
+    session_ref.update({'aggregates': aggregates})
+    return aggregates
+
+
+def summarize(aggregates: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """画面表示・終了処理向けに整形（平均速度を計算し、欠けている値を埋める）"""
+    aggregates = aggregates or {}
+    speed_count = int(aggregates.get('speed_count', 0) or 0)
+    counts = aggregates.get('counts', {}) or {}
+    return {
+        'distance_km': round(float(aggregates.get('distance_km', 0.0) or 0.0), 3),
+        'max_speed': float(aggregates.get('max_speed', 0.0) or 0.0),
+        'avg_speed': (float(aggregates.get('speed_sum', 0.0)) / speed_count) if speed_count else 0.0,
+        'counts': {stream: int(counts.get(stream, 0) or 0) for stream in STREAM_SCHEMAS},
+        'first_ms': aggregates.get('first_ms'),
+        'last_ms': aggregates.get('last_ms'),
+        'events': dict(aggregates.get('events', {}) or {}),
+        'dirty': bool(aggregates.get('dirty', False)),
+    }
+
+
+# ===== 受信時のインクリメンタル更新 =====
+class SessionAggregator:
+    """
+    書き込みに成功したチャンクから aggregates の更新内容（Firestoreの transform）を作って加算する
+
+    セッションごとに「集計済みの最大連番」と「最後のGPS点」をメモリに持ち、
+    キャッシュに無い場合はセッションドキュメントから読み直す。
+    メモリ上の状態はコピーに対して進め、セッションの update が成功してから置き換える
+    （失敗したバッチを集計済みとして扱い、端末の再送を捨ててしまわないように）。
+    同じセッションの加算はセッションごとのロックで順番に行う。
+    別のプロセスとの競合は update_time の前提条件で検出し、読み直した状態に足してやり直す。
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl_s: float = 3600.0):
+        self._state = TTLCache(max_entries=max_sessions, ttl_s=ttl_s)
+        self._locks = TTLCache(max_entries=max_sessions, ttl_s=ttl_s)
+        self._lock = threading.Lock()
+
+    def apply(self, session_ref, chunks: List[Dict[str, Any]], any_failed: bool = False,
+              extra_fields: Optional[Dict[str, Any]] = None) -> None:
+        """
+        保存済みチャンクの集計をセッションに加算する（extra_fields も同じ update で書く）
+        update に失敗した場合はこのセッションの状態を破棄し、aggregates.dirty を立てて
+        終了時の backfill_aggregates（全件からの再計算）に任せる。この書き込みも失敗した場合は例外を送出する。
+        """
+        extra_fields = extra_fields or {}
+        with self._session_lock(session_ref.id):
+            error: Optional[Exception] = None
+            for attempt in range(AGGREGATE_UPDATE_ATTEMPTS):
+                fields, state = self.fields_for_chunks(session_ref, chunks, any_failed, reloaded=attempt > 0)
+                fields = {**extra_fields, **fields}
+                if not fields:
+                    return
+                option = None
+                if state['update_time'] is not None:
+                    option = Client.write_option(last_update_time=state['update_time'])
+                try:
+                    result = session_ref.update(fields, option=option)
+                except FailedPrecondition as e:
+                    # 別のプロセスが先に書き込んだ → 次の試行でドキュメントから状態を読み直す
+                    self._state.invalidate(session_ref.id)
+                    error = e
+                    continue
+                except Exception as e:
+                    error = e
+                    break
+                state['update_time'] = getattr(result, 'update_time', None)
+                self._state.set(session_ref.id, state)
+                return
+
+            self._state.invalidate(session_ref.id)
+            print(f"⚠️ Aggregate update failed for session {session_ref.id}: {error}")
+            session_ref.update({**extra_fields, 'aggregates.dirty': True, 'score_state': None})
+
+    def fields_for_chunks(self, session_ref, chunks: List[Dict[str, Any]], any_failed: bool = False,
+                          reloaded: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        保存済みチャンク（TelemetryChunkWriter のチャンクdict）から update 用のフィールドと加算後の状態を返す
+        再送で既に集計済みの連番は除外する。メモリ上の状態は変更しない。
+        reloaded（競合して読み直した状態）で連番が先に進んでいた場合は、別のプロセスが後のバッチを
+        先に集計している（除外した点が本当に集計済みとは限らない）ので、dirty にしてスコアの途中状態も使わない。
+        連番の無い点（旧クライアント）が集計済みのストリームに届いた場合も、再送を除けないので dirty にする。
+        """
+        cached = self._state.get(session_ref.id)
+        state = copy.deepcopy(cached) if cached is not None else self._load_state(session_ref)
+
+        columns_by_stream: Dict[str, Dict[str, np.ndarray]] = {}
+        cursor_fields: Dict[str, Any] = {}
+        skipped = unsequenced = False
+        for stream in STREAM_SCHEMAS:
+            parts = [c['columns'] for c in chunks if c['stream'] == stream]
+            if not parts:
+                continue
+            columns = {
+                name: np.concatenate([np.asarray(p[name]) for p in parts]) for name in parts[0]
+            }
+            seq = columns['seq'].astype(np.int64)
+            # 連番の無い点は再送かどうか区別できない。既に集計のあるストリームに届いたら
+            # 二重に加算しているかもしれないので、終了時に全件から計算し直す
+            if stream in state['counted'] and (seq == SEQ_MISSING).any():
+                unsequenced = True
+            # 保存済み連番は集計済みかどうかに関係なく、抜けが埋まった分だけ進める
+            cursor = state['cursor'].get(stream, SEQ_MISSING)
+            advanced = advance_cursor(cursor, seq)
+            if advanced > cursor:
+                state['cursor'][stream] = advanced
+                cursor_fields[f'ingest_cursor.{stream}'] = advanced
+            fresh = (seq == SEQ_MISSING) | (seq > state['seq'].get(stream, SEQ_MISSING))
+            if not fresh.all():
+                skipped = True
+                columns = {name: values[fresh] for name, values in columns.items()}
+            if len(columns['timestamp_ms']):
+                columns_by_stream[stream] = columns
+                state['counted'].add(stream)
+
+        conflicted = reloaded and skipped
+        if conflicted:
+            state['score'] = None
+        if not columns_by_stream:
+            if conflicted:
+                return {**cursor_fields, 'aggregates.dirty': True, 'score_state': None}, state
+            return ({**cursor_fields, 'aggregates.dirty': True} if any_failed else cursor_fields), state
+
+        # 直前バッチの最後の点から、このバッチの最初の点までの距離も足す
+        last_gps = state['last_gps']
+        delta = compute_aggregates(columns_by_stream, prev_gps=last_gps)
+        gps = columns_by_stream.get('gps_logs')
+        # 別のプロセスが後の時刻のバッチを先に集計していた（順番が入れ替わった）場合は距離がつながらない
+        out_of_order = (gps is not None and last_gps is not None
+                        and int(gps['timestamp_ms'].min()) < last_gps['timestamp_ms'])
+        if delta['last_gps'] is not None and (
+                last_gps is None or delta['last_gps']['timestamp_ms'] >= last_gps['timestamp_ms']):
+            state['last_gps'] = delta['last_gps']
+        for stream, seq in delta['seq'].items():
+            state['seq'][stream] = max(state['seq'].get(stream, SEQ_MISSING), seq)
+        score_fields = self._update_score(state, columns_by_stream, delta['distance_km'])
+
+        fields: Dict[str, Any] = {
+            **cursor_fields,
+            'aggregates.distance_km': Increment(delta['distance_km']),
+            'aggregates.speed_sum': Increment(delta['speed_sum']),
+            'aggregates.speed_count': Increment(delta['speed_count']),
+            'aggregates.max_speed': Maximum(delta['max_speed']),
+            'aggregates.first_ms': Minimum(delta['first_ms']),
+            'aggregates.last_ms': Maximum(delta['last_ms']),
+        }
+        for stream, count in delta['counts'].items():
+            if count:
+                fields[f'aggregates.counts.{stream}'] = Increment(count)
+        for event, count in delta['events'].items():
+            fields[f'aggregates.events.{event}'] = Increment(count)
+        for stream, seq in delta['seq'].items():
+            fields[f'aggregates.seq.{stream}'] = Maximum(seq)
+        if state['last_gps'] is not None:
+            fields['aggregates.last_gps'] = state['last_gps']
+        if any_failed or out_of_order or conflicted or unsequenced:
+            fields['aggregates.dirty'] = True
+        fields.update(score_fields)
+        if conflicted:
+            fields['score_state'] = None
+        return fields, state
+
+    @staticmethod
+    def _update_score(state: Dict[str, Any], columns_by_stream: Dict[str, Dict[str, np.ndarray]],
+                      distance_km: float) -> Dict[str, Any]:
+        """総合スコアの途中状態に avg_g_logs の点と距離の増分を足し、保存するフィールドを返す"""
+        score_state = state['score']
+        if score_state is None:
+            return {}
+        avg_g = columns_by_stream.get(EVENT_STREAM)
+        try:
+            if avg_g is not None:
+                update_score_state(score_state, avg_g['timestamp_ms'], avg_g['g_z'], avg_g['g_x'], avg_g['speed'])
+            add_gps_distance(score_state, distance_km)
+            # state はメモリ上の状態のコピーなので、そのまま書き込みに渡してよい
+            fields: Dict[str, Any] = {'score_state': score_state}
+            if avg_g is not None:
+                from score import calculate_online_score
+                result = calculate_online_score(score_state)
+                fields['provisional_score'] = {
+                    'overall_score': result['overall_score'],
+                    'score_comment': result['score_comment'],
+                    'jerk_events_per_km': result['jerk_stats']['jerk_events_per_km'],
+                    'data_points': result['jerk_stats']['data_points'],
+                }
+            return fields
+        except Exception as e:
+            # 途中状態が壊れたセッションは終了時に全件から計算する
+            print(f"⚠️ Online score update failed: {e}")
+            state['score'] = None
+            return {'score_state': None}
+
+    def forget(self, session_id: str) -> None:
+        """セッション終了時にメモリ上の状態を破棄する"""
+        self._state.invalidate(session_id)
+        self._locks.invalidate(session_id)
+
+    def _session_lock(self, session_id: str) -> threading.Lock:
+        with self._lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks.set(session_id, lock)
+            return lock
+
+    @staticmethod
+    def _load_state(session_ref) -> Dict[str, Any]:
+        session_doc = session_ref.get()
+        session_data = (session_doc.to_dict() or {}) if session_doc.exists else {}
+        aggregates = session_data.get('aggregates') or {}
+        score_state = session_data.get('score_state')
+        if score_state is None and not (aggregates.get('counts') or {}).get(EVENT_STREAM):
+            # avg_g_logs をまだ受信していないセッションは最初から逐次計算できる
+            score_state = new_score_state()
+        return {
+            'seq': {stream: int(v) for stream, v in (aggregates.get('seq') or {}).items()},
+            'cursor': {stream: int(v) for stream, v in (session_data.get('ingest_cursor') or {}).items()},
+            # 既に集計済みの点があるストリーム
+            'counted': {stream for stream, n in (aggregates.get('counts') or {}).items() if n},
+            'last_gps': aggregates.get('last_gps'),
+            'score': score_state,
+            # 次の update の前提条件（この時点から他のプロセスが書き込んでいないこと）
+            'update_time': getattr(session_doc, 'update_time', None) if session_doc.exists else None,
+        }
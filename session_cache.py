@@ -0,0 +1,49 @@
+# session_cache.py
+"""
+セッション所有者・ステータスのキャッシュ機能モジュール
+ログ受信など頻繁に呼ばれるエンドポイントで、毎回 sessions/{id} を読まずに権限確認する。
+"""
+from typing import Any, Dict, Optional, Tuple
+
+from models import db
+from ttl_cache import TTLCache
+
+
+# ===== セッション権限キャッシュ =====
+class SessionAuthCache:
+    """session_id → (user_id, status) のキャッシュ。ミス時は Firestore から読む"""
+
+    def __init__(self, db_client, max_entries: int = 4096, ttl_s: float = 300.0):
+        self._db = db_client
+        self._cache = TTLCache(max_entries=max_entries, ttl_s=ttl_s)
+
+    def lookup(self, session_id: str) -> Optional[Tuple[str, str]]:
+        """
+        (user_id, status) を返す。セッションが存在しない場合は None
+        （存在しない結果はキャッシュしない）
+        """
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            return cached
+
+        session_doc = self._db.collection('sessions').document(session_id).get()
+        if not session_doc.exists:
+            return None
+        data = session_doc.to_dict()
+        value = (data.get('user_id'), data.get('status'))
+        self._cache.set(session_id, value)
+        return value
+
+    def is_owner(self, session_id: str, user_id: str) -> bool:
+        meta = self.lookup(session_id)
+        return meta is not None and meta[0] == user_id
+
+    def invalidate(self, session_id: str) -> None:
+        """セッション終了・削除時に呼ぶ"""
+        self._cache.invalidate(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+
+session_auth_cache = SessionAuthCache(db)
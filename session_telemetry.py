@@ -0,0 +1,93 @@
+# session_telemetry.py
+"""
+セッションのテレメトリ読み込み機能モジュール
+走行終了後の処理（距離計算・集計の作り直し・注目ポイント評価・総合スコア）で
+同じストリームを何度も読み直さないよう、ストリームごとに1回だけ読み込んで共有する。
+
+    telemetry = SessionTelemetry(session_ref)
+    telemetry.prefetch(('gps_logs', 'avg_g_logs'))   # 並列に読み込む
+    gps = telemetry.columns('gps_logs')               # 読み込み済みならキャッシュを返す
+    telemetry.read_stats()                            # ストリームごとのクエリ数・ドキュメント数
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from telemetry_store import STREAM_SCHEMAS, columns_to_records, load_stream_columns
+
+
+class SessionTelemetry:
+    """1セッション分のテレメトリ列（ストリームごとに初回アクセス時だけ Firestore から読む）"""
+
+    def __init__(self, session_ref):
+        self._session_ref = session_ref
+        self._columns: Dict[str, Dict[str, np.ndarray]] = {}
+        self._records: Dict[str, List[Dict[str, Any]]] = {}
+        self._read_stats: Dict[str, Dict[str, int]] = {}
+        self._load_ms: Dict[str, float] = {}
+        self._locks = {stream: threading.Lock() for stream in STREAM_SCHEMAS}
+
+    @property
+    def session_id(self) -> str:
+        return self._session_ref.id
+
+    @property
+    def session_ref(self):
+        return self._session_ref
+
+    @classmethod
+    def load(cls, session_ref, streams: Optional[Iterable[str]] = None) -> 'SessionTelemetry':
+        """指定ストリーム（省略時は全ストリーム）を並列に読み込んだインスタンスを返す"""
+        telemetry = cls(session_ref)
+        telemetry.prefetch(streams)
+        return telemetry
+
+    def prefetch(self, streams: Optional[Iterable[str]] = None) -> None:
+        """未読み込みのストリームを並列に読み込む"""
+        pending = [s for s in (STREAM_SCHEMAS if streams is None else streams) if s not in self._columns]
+        if len(pending) <= 1:
+            for stream in pending:
+                self.columns(stream)
+            return
+        with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix='telemetry-load') as pool:
+            # 例外は呼び出し側へそのまま伝える
+            list(pool.map(self.columns, pending))
+
+    def columns(self, stream: str) -> Dict[str, np.ndarray]:
+        """時刻順のNumPy列（読み込みはストリームごとに1回だけ）"""
+        if stream in self._columns:
+            return self._columns[stream]
+        with self._locks[stream]:
+            if stream not in self._columns:
+                stats: Dict[str, int] = {}
+                started = time.perf_counter()
+                columns = load_stream_columns(self._session_ref, stream, read_stats=stats)
+                self._load_ms[stream] = (time.perf_counter() - started) * 1000.0
+                self._read_stats[stream] = stats
+                self._columns[stream] = columns
+        return self._columns[stream]
+
+    def records(self, stream: str) -> List[Dict[str, Any]]:
+        """従来のdict形式（columns_to_records の結果をキャッシュする）"""
+        if stream not in self._records:
+            self._records[stream] = columns_to_records(self.columns(stream))
+        return self._records[stream]
+
+    def columns_by_stream(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """全ストリームの列（未読み込み分は並列に読み込む）"""
+        self.prefetch()
+        return {stream: self._columns[stream] for stream in STREAM_SCHEMAS}
+
+    def read_stats(self) -> Dict[str, Any]:
+        """ストリームごとの Firestore クエリ数・読み込みドキュメント数・所要時間"""
+        return {
+            'streams': {
+                stream: {**stats, 'load_ms': round(self._load_ms.get(stream, 0.0), 1)}
+                for stream, stats in self._read_stats.items()
+            },
+            'queries': sum(s.get('queries', 0) for s in self._read_stats.values()),
+            'documents': sum(s.get('documents', 0) for s in self._read_stats.values()),
+        }
@@ -1,15 +1,177 @@
 # sessions.py
-from flask import Blueprint, request, jsonify, render_template
+import os
+from flask import Blueprint, request, jsonify, render_template, g
 from flask_login import login_required, current_user
 from firebase_admin import firestore
 from datetime import datetime
 from config import JST
 from models import db
-from ai_evaluation import analyze_focus_points_for_session
+from ai_evaluation import analyze_focus_points_for_session, llm_cache
+from analysis_jobs import analysis_runner
+from bulk_writer import FirestoreBulkWriter
+from geodesy import track_distance_km
+from online_score import is_usable
+from ingest_queue import WriteBehindQueue
+from session_cache import session_auth_cache
+from session_telemetry import SessionTelemetry
+from session_aggregates import SessionAggregator, summarize
+from score_timeline import TIMELINE_COLLECTION, TIMELINE_DOC_ID, assign_segments
+from rate_limit import (
+    RateLimiter,
+    RateLimitRule,
+    create_rate_limit_store,
+    recommended_flush_interval_s,
+    FLUSH_INTERVAL_HEADER,
+)
+from telemetry_codec import decode_frame, decode_stream_columns, FrameDecodeError
+from telemetry_store import (
+    TelemetryChunkWriter,
+    samples_to_columns,
+    SampleValidationError,
+    load_stream_columns,
+    columns_to_records,
+    count_stream_samples,
+    load_ingest_cursor,
+)
 
 # Blueprintの作成
 sessions_bp = Blueprint('sessions', __name__)
 
+# テレメトリはチャンク単位（列指向）で保存する
+# 大きなペイロードは500操作以下のバッチに分割し、最大4並列でコミットする
+# 保存と同時に距離・速度・件数などを sessions/{id}.aggregates に加算する
+bulk_writer = FirestoreBulkWriter(db, max_workers=4, max_retries=3)
+session_aggregator = SessionAggregator()
+chunk_writer = TelemetryChunkWriter(db, bulk_writer=bulk_writer, aggregator=session_aggregator)
+
+# Write-Behind キュー（INGEST_WRITE_BEHIND=0 で同期書き込みに戻せる）
+ingest_queue = None
+if os.getenv('INGEST_WRITE_BEHIND', '1') != '0':
+    ingest_queue = WriteBehindQueue(
+        chunk_writer,
+        num_workers=int(os.getenv('INGEST_WRITERS', '2')),
+        flush_interval_s=float(os.getenv('INGEST_FLUSH_INTERVAL_S', '2.0')),
+    )
+    ingest_queue.start()
+
+INGEST_RETRY_AFTER_S = 5
+
+# ===== 受信レート制限 =====
+# ユーザー単位はリクエスト数、セッション単位はサンプル数でトークンバケットを消費する
+# RATE_LIMIT_REDIS_URL を設定すると複数ワーカープロセスで状態を共有する
+rate_limiter = RateLimiter(create_rate_limit_store())
+USER_REQUEST_RULE = RateLimitRule(
+    'user_requests',
+    rate=float(os.getenv('RATE_LIMIT_USER_REQ_PER_S', '2')),
+    burst=float(os.getenv('RATE_LIMIT_USER_REQ_BURST', '30')),
+)
+SESSION_SAMPLE_RULE = RateLimitRule(
+    'session_samples',
+    rate=float(os.getenv('RATE_LIMIT_SESSION_SAMPLES_PER_S', '300')),
+    burst=float(os.getenv('RATE_LIMIT_SESSION_SAMPLES_BURST', '30000')),
+)
+MAX_INGEST_BODY_BYTES = int(os.getenv('MAX_INGEST_BODY_BYTES', str(4 * 1024 * 1024)))
+MAX_SAMPLES_PER_REQUEST = int(os.getenv('MAX_SAMPLES_PER_REQUEST', '20000'))
+DEFAULT_FLUSH_INTERVAL_S = 60
+
+INGEST_ENDPOINTS = {
+    'sessions.log_gps',
+    'sessions.log_gps_bulk',
+    'sessions.log_g_only',
+    'sessions.log_avg_g_bulk',
+    'sessions.ingest_v2',
+}
+
+
+def _rate_limited_response(decision, message):
+    """429 応答（Retry-After と推奨フラッシュ間隔つき）"""
+    interval = recommended_flush_interval_s(decision, DEFAULT_FLUSH_INTERVAL_S)
+    return {
+        'status': 'error',
+        'message': message,
+        'retry_after': decision.retry_after_s,
+        'recommended_flush_interval_s': interval,
+    }, 429, {'Retry-After': decision.retry_after_header, FLUSH_INTERVAL_HEADER: str(int(interval))}
+
+
+@sessions_bp.before_request
+def limit_ingest_requests():
+    """受信エンドポイントのサイズ上限とユーザー単位のレート制限"""
+    if request.endpoint not in INGEST_ENDPOINTS:
+        return None
+    if request.content_length is not None and request.content_length > MAX_INGEST_BODY_BYTES:
+        return jsonify({'status': 'error', 'message': 'Payload too large'}), 413
+    if not current_user.is_authenticated:
+        return None  # login_required で弾く
+
+    decision = rate_limiter.check(current_user.id, USER_REQUEST_RULE)
+    g.rate_limit_decisions = [decision]
+    if not decision.allowed:
+        print(f"⚠️ Rate limited user {current_user.id} on {request.endpoint}")
+        body, status_code, headers = _rate_limited_response(decision, 'Too many requests')
+        return jsonify(body), status_code, headers
+    return None
+
+
+@sessions_bp.after_request
+def add_flush_interval_header(response):
+    """受信エンドポイントの応答に推奨フラッシュ間隔を付ける"""
+    decisions = g.get('rate_limit_decisions')
+    if decisions and FLUSH_INTERVAL_HEADER not in response.headers:
+        interval = max(recommended_flush_interval_s(d, DEFAULT_FLUSH_INTERVAL_S) for d in decisions)
+        response.headers[FLUSH_INTERVAL_HEADER] = str(int(interval))
+    return response
+
+
+def _ingest(session_id, session_ref, columns_by_stream):
+    """
+    列データを保存する。(レスポンス用dict, HTTPステータス, ヘッダ) を返す
+    Write-Behind 有効時はキューに積んで 202、キュー満杯なら 503 + Retry-After。
+    セッション単位のサンプル数制限を超えた場合は 429、1リクエストのサンプル数上限を超えた場合は 413。
+    """
+    received = {stream: len(columns['timestamp_ms']) for stream, columns in columns_by_stream.items()}
+    total = sum(received.values())
+
+    if total > MAX_SAMPLES_PER_REQUEST:
+        return {
+            'status': 'error',
+            'message': f'Too many samples in one request ({total} > {MAX_SAMPLES_PER_REQUEST})',
+        }, 413, {}
+
+    decision = rate_limiter.check(session_id, SESSION_SAMPLE_RULE, cost=total)
+    g.setdefault('rate_limit_decisions', []).append(decision)
+    if not decision.allowed:
+        print(f"⚠️ Rate limited session {session_id}: {total} samples")
+        return _rate_limited_response(decision, 'Too many samples for this session')
+
+    if ingest_queue is not None:
+        if ingest_queue.enqueue(session_id, session_ref, columns_by_stream):
+            return {
+                'status': 'accepted',
+                'saved_count': total,
+                'queued_counts': received,
+            }, 202, {}
+        print(f"⚠️ Ingest queue full, rejecting batch for session {session_id}")
+        return {
+            'status': 'error',
+            'message': 'Ingest queue is full',
+            'retry_after': INGEST_RETRY_AFTER_S,
+            'recommended_flush_interval_s': DEFAULT_FLUSH_INTERVAL_S * 2,
+        }, 503, {'Retry-After': str(INGEST_RETRY_AFTER_S)}
+
+    result = chunk_writer.write_many(session_ref, columns_by_stream)
+    body = {
+        'status': 'ok' if result['ok'] else 'partial',
+        'saved_count': sum(result['saved_counts'].values()),
+        'saved_counts': result['saved_counts'],
+        'failed_counts': {s: received[s] - result['saved_counts'][s] for s in received},
+        'chunks': result['chunks'],
+    }
+    if result['ok']:
+        return body, 200, {}
+    # 一部でも保存できていれば 207、全滅なら 500
+    return body, (207 if body['saved_count'] > 0 else 500), {}
+
 # セッション開始
 @sessions_bp.route('/start', methods=['POST'])
 @login_required
@@ -97,45 +259,15 @@ def check_active():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
-from math import radians, sin, cos, sqrt, atan2
-
-# --- 距離計算用：ハバースイン ---
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371.0  # 地球の半径(km)
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat / 2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c
-
-
-# --- FirestoreからGPSログを取得して距離計算 ---
-def calculate_distance_from_firestore(session_id):
-    gps_ref = db.collection('sessions').document(session_id).collection('gps_logs')
-    docs = gps_ref.order_by('timestamp').stream()
-
-    coords = []
-    for d in docs:
-        data = d.to_dict()
-        lat = data.get("latitude")
-        lng = data.get("longitude")
-
-        # 無効値排除
-        if lat is None or lng is None:
-            continue
-        if abs(lat) < 0.0001 and abs(lng) < 0.0001:
-            continue
-
-        coords.append((lat, lng))
-
-    if len(coords) < 2:
-        return 0.0
-
-    total_km = 0.0
-    for i in range(1, len(coords)):
-        total_km += haversine(coords[i-1][0], coords[i-1][1], coords[i][0], coords[i][1])
-
-    return round(total_km, 3)
+# --- FirestoreからGPSログを取得して距離計算（飛び・停車中のふらつきは除く） ---
+def calculate_distance_from_firestore(session_id, telemetry=None):
+    if telemetry is None:
+        telemetry = SessionTelemetry(db.collection('sessions').document(session_id))
+    gps = telemetry.columns('gps_logs')
+    distance_km = track_distance_km(
+        gps['latitude'], gps['longitude'], gps['timestamp_ms'], gps['speed'], gps['quality']
+    )
+    return round(distance_km, 3)
 
 # セッション終了
 @sessions_bp.route('/end', methods=['POST'])
@@ -148,10 +280,47 @@ def end():
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     try:
+        # Write-Behind キューに残っているこのセッションのログを先に書き込む
+        if ingest_queue is not None and not ingest_queue.flush_session(session_id):
+            print(f"⚠️ Pending logs for session {session_id} were not flushed (timeout or write failure)")
+
+        session_ref = db.collection('sessions').document(session_id)
+        # 距離計算で読み込んだログは、そのまま解析ジョブに引き継ぐ（ストリームごとに1回だけ読む）
+        telemetry = SessionTelemetry(session_ref)
+
+        # ① トランザクションの外で距離などの派生値を求める
+        #    （トランザクションが再試行されても全件読み込みを繰り返さず、ロックも短く済む）
+        session_doc = session_ref.get()
+        if not session_doc.exists:
+            return jsonify({'status': 'error', 'message': 'Session not found'}), 404
+        session_data = session_doc.to_dict()
+        if session_data.get('user_id') != current_user.id:
+            return jsonify({'status': 'error', 'message': 'Permission denied'}), 403
 
+        distance_km = None
+        online_score = None
+        if session_data.get('status') == 'active':
+            # 🔥 受信時に加算した集計から距離を取得（集計が無い・不完全な場合のみ全件から計算）
+            aggregates = session_data.get('aggregates')
+            if aggregates and not aggregates.get('dirty'):
+                distance_km = summarize(aggregates)['distance_km']
+                print(f"🚗 Aggregated distance = {distance_km} km")
+                # 受信時に更新したスコアの途中状態から総合スコアを確定する（全件の読み込み不要）
+                # 途中状態が無い・後から届いた点がある場合は解析ジョブの全件計算に任せる
+                if is_usable(session_data.get('score_state')):
+                    try:
+                        from score import calculate_online_score
+                        online_score = calculate_online_score(session_data['score_state'], distance_km)
+                        print(f"🏁 Online overall score = {online_score['overall_score']}")
+                    except Exception as e:
+                        print(f"⚠️ Online score error: {e}")
+            else:
+                distance_km = calculate_distance_from_firestore(session_id, telemetry)
+                print(f"🚗 Firestore-based distance = {distance_km} km")
+
+        # ② 短いトランザクションで所有者・状態だけを確認して終了状態に切り替える
         @firestore.transactional
         def end_session(transaction):
-            session_ref = db.collection('sessions').document(session_id)
             session_doc = session_ref.get(transaction=transaction)
 
             if not session_doc.exists:
@@ -161,18 +330,14 @@ def end():
             if session_data.get('user_id') != current_user.id:
                 return {'status': 'error', 'message': 'Permission denied'}
 
-            # すでに終了しているならそのまま返す
-            if session_data.get('status') != 'active':
+            # すでに終了しているならそのまま返す（①の後に別リクエストで終了された場合も含む）
+            if session_data.get('status') != 'active' or distance_km is None:
                 print(f"Session {session_id} already ended: {session_data.get('status')}")
                 return {'status': 'ok', 'already': True}
 
-            # 🔥 Firestoreログから距離計算
-            distance_km = calculate_distance_from_firestore(session_id)
-            print(f"🚗 Firestore-based distance = {distance_km} km")
-
             # Firestore 更新
             print(f"Ending session {session_id} for user {current_user.id}")
-            transaction.update(session_ref, {
+            updates = {
                 'end_time': firestore.SERVER_TIMESTAMP,
                 'status': 'completed',
                 'distance': distance_km,
@@ -181,8 +346,14 @@ def end():
                 'sharp_turns': int(data.get('sharp_turns', 0)),
                 'stability': float(data.get('stability', 0.0)),
                 'speed_violations': int(data.get('speed_violations', 0)),
-                'focus_point': data.get('focus_point', '')
-            })
+                'focus_point': data.get('focus_point', ''),
+            }
+            if online_score:
+                # 解析ジョブの全件計算で上書きされるまでの総合スコア
+                updates.update(online_score)
+                updates['calculated_at'] = datetime.now(JST)
+                updates['score_source'] = 'online'
+            transaction.update(session_ref, updates)
 
             print(f"Session {session_id} ended successfully")
             return {'status': 'ok', 'already': False}
@@ -190,25 +361,26 @@ def end():
         # トランザクション実行
         transaction = db.transaction()
         result = end_session(transaction)
-
-        # ★ AI フィードバック生成（失敗してもセッション完了は続行）
-        try:
-            analyze_focus_points_for_session(session_id, current_user.id)
-        except Exception as e:
-            print("AI evaluation error:", e)
-
-        # ★ 総合運転スコア計算（失敗してもセッション完了は続行）
-        try:
-            from score import calculate_session_overall_score
-            calculate_session_overall_score(session_id, current_user.id)
-        except Exception as e:
-            print("Score calculation error:", e)
+        # status が completed に変わったのでキャッシュを破棄
+        session_auth_cache.invalidate(session_id)
+        session_aggregator.forget(session_id)
+
+        # ★ 集計の作り直し・AI フィードバック・総合スコアはバックグラウンドで実行する
+        #   （失敗してもセッション完了は続行。進捗は /sessions/analysis_status で確認）
+        analysis_status = None
+        if result.get('status') == 'ok':
+            try:
+                analysis_status = analysis_runner.submit(session_id, current_user.id, telemetry=telemetry)
+            except Exception as e:
+                print("Analysis job submit error:", e)
 
         # ★★★ 最重要：必ず session_id を返す ★★★
         return jsonify({
             'status': result.get('status', 'ok'),
             'session_id': session_id,
-            'already': result.get('already', False)
+            'already': result.get('already', False),
+            'analysis_status': analysis_status,
+            'overall_score': online_score['overall_score'] if online_score and not result.get('already') else None
         })
 
     except Exception as e:
@@ -225,22 +397,15 @@ def log_gps():
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists or session_doc.to_dict().get('user_id') != current_user.id:
+    if not session_auth_cache.is_owner(session_id, current_user.id):
         return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
 
     try:
-        session_ref.collection('gps_logs').add({
-            'latitude': data.get('latitude', 0.0),
-            'longitude': data.get('longitude', 0.0),
-            'speed': data.get('speed', 0.0),
-            'g_x': data.get('g_x', 0.0),
-            'g_y': data.get('g_y', 0.0),
-            'g_z': data.get('g_z', 0.0),
-            'event': data.get('event', 'normal'),
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-        return jsonify({'status': 'ok'})
+        columns, _ = samples_to_columns('gps_logs', [data])
+        body, status_code, headers = _ingest(session_id, session_ref, {'gps_logs': columns})
+        return jsonify(body), status_code, headers
+    except SampleValidationError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -251,86 +416,32 @@ def log_gps_bulk():
     data = request.get_json()
     session_id = data.get('session_id')
     gps_logs = data.get('gps_logs', [])
-    
-    print(f"=== GPS BULK SAVE REQUEST ===")
-    print(f"User ID: {current_user.id}")
-    print(f"Session ID: {session_id}")
-    print(f"GPS logs count: {len(gps_logs)}")
-    print(f"Raw request data: {data}")
-    
-    if gps_logs:
-        print(f"First GPS log sample: {gps_logs[0]}")
 
     if not session_id:
         print("ERROR: Missing session_id")
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists:
+    session_meta = session_auth_cache.lookup(session_id)
+    if session_meta is None:
         print(f"ERROR: Session {session_id} not found")
         return jsonify({'status': 'error', 'message': 'Session not found'}), 403
         
-    session_data = session_doc.to_dict()
-    if session_data.get('user_id') != current_user.id:
-        print(f"ERROR: Permission denied. Session user: {session_data.get('user_id')}, Current user: {current_user.id}")
+    owner_id, _ = session_meta
+    if owner_id != current_user.id:
+        print(f"ERROR: Permission denied. Session user: {owner_id}, Current user: {current_user.id}")
         return jsonify({'status': 'error', 'message': 'Permission denied'}), 403
 
-    print(f"Session validation passed. Processing {len(gps_logs)} GPS logs...")
-
     try:
-        batch = db.batch()
-        gps_collection = session_ref.collection('gps_logs')
-        saved_count = 0
-        skipped_zero_count = 0
-        
-        for log in gps_logs:
-            print(f"Processing GPS log: {log}")  # 各ログを詳細に出力
-            
-            # 緯度経度が有効かチェック
-            latitude = log.get('latitude')
-            longitude = log.get('longitude')
-            
-            print(f"GPS coordinates: lat={latitude}, lng={longitude}")
-            
-            if latitude is None or longitude is None:
-                print(f"Skipping GPS log due to None values: lat={latitude}, lng={longitude}")
-                continue
-                
-            # 緯度経度が0,0の場合は保存しない（描画ワープ防止）
-            if float(latitude) == 0.0 and float(longitude) == 0.0:
-                print(f"Skip: GPS log has zero coordinates: lat={latitude}, lng={longitude}")
-                skipped_zero_count += 1
-                continue
-            
-            ts_ms = log.get('timestamp')  # 端末から送られてきたUNIX時間（ミリ秒）
-            if ts_ms:
-                ts_dt = datetime.fromtimestamp(ts_ms / 1000.0, JST)
-            else:
-                ts_dt = datetime.now(JST)
-
-            doc_ref = gps_collection.document()
-            batch.set(doc_ref, {
-                'latitude': float(latitude),
-                'longitude': float(longitude),
-                'speed': float(log.get('speed', 0.0)),
-                'event': log.get('event', 'normal'),
-                'quality': log.get('quality', 'unknown'),  # データ品質レベルを保存
-                'timestamp': ts_dt,       # Firestore標準のTimestamp型
-                'timestamp_ms': ts_ms     # スマホ内部のミリ秒値をそのまま保存
-            })
-            saved_count += 1
-            print(f"Added GPS log {saved_count} to batch: lat={latitude}, lng={longitude}")
-        
-        if saved_count > 0:
-            print(f"Committing batch with {saved_count} GPS logs...")
-            batch.commit()
-            print(f"Successfully saved {saved_count} GPS logs to session {session_id}")
-        else:
-            print(f"No valid GPS logs to save for session {session_id}")
-            
-        print(f"=== GPS BULK SAVE COMPLETED: {saved_count} saved, {skipped_zero_count} skipped (0,0) ===")
-        return jsonify({'status': 'ok', 'saved_count': saved_count, 'skipped_zero_count': skipped_zero_count})
+        # 緯度経度の欠損・範囲外・(0,0)は列変換時に除外される（描画ワープ防止）
+        columns, skipped_zero_count = samples_to_columns('gps_logs', gps_logs)
+        body, status_code, headers = _ingest(session_id, session_ref, {'gps_logs': columns})
+        body['skipped_zero_count'] = skipped_zero_count
+        print(f"GPS logs for session {session_id}: {len(gps_logs)} received, "
+              f"{body.get('saved_count', 0)} {body['status']}, {skipped_zero_count} skipped (0,0)")
+        return jsonify(body), status_code, headers
+    except SampleValidationError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         print(f"Error saving GPS logs: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -342,48 +453,21 @@ def log_g_only():
     data = request.get_json()
     session_id = data.get('session_id')
     g_logs = data.get('g_logs', [])
-    
-    print(f"Received G bulk save request for session {session_id}")
-    print(f"G logs count: {len(g_logs)}")
-    if g_logs:
-        print(f"First G log sample: {g_logs[0]}")
 
     if not session_id:
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists or session_doc.to_dict().get('user_id') != current_user.id:
+    if not session_auth_cache.is_owner(session_id, current_user.id):
         return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
 
     try:
-        batch = db.batch()
-        g_collection = session_ref.collection('g_logs')
-        saved_count = 0
-        
-        for log in g_logs:
-            ts_ms = log.get('timestamp')
-            if ts_ms:
-                ts_dt = datetime.fromtimestamp(ts_ms / 1000.0, JST)
-            else:
-                ts_dt = datetime.now(JST)
-
-            doc_ref = g_collection.document()
-            batch.set(doc_ref, {
-                'g_x': float(log.get('g_x', 0.0)),
-                'g_y': float(log.get('g_y', 0.0)),
-                'g_z': float(log.get('g_z', 0.0)),
-                'speed': float(log.get('speed', 0.0)),
-                'event': log.get('event', 'normal'),
-                'quality': log.get('quality', 'unknown'),  # データ品質レベルを保存
-                'timestamp': ts_dt,       # Firestore標準のTimestamp型
-                'timestamp_ms': ts_ms     # スマホ内部のミリ秒値をそのまま保存
-            })
-            saved_count += 1
-            
-        batch.commit()
-        print(f"Successfully saved {saved_count} G logs to session {session_id}")
-        return jsonify({'status': 'ok', 'saved_count': saved_count})
+        columns, _ = samples_to_columns('g_logs', g_logs)
+        body, status_code, headers = _ingest(session_id, session_ref, {'g_logs': columns})
+        print(f"G logs for session {session_id}: {len(g_logs)} received, {body.get('saved_count', 0)} {body['status']}")
+        return jsonify(body), status_code, headers
+    except SampleValidationError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         print(f"Error saving G logs: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -395,55 +479,146 @@ def log_avg_g_bulk():
     data = request.get_json()
     session_id = data.get('session_id')
     avg_g_logs = data.get('avg_g_logs', [])
-    
-    print(f"Received AVG-G bulk save request for session {session_id}")
-    print(f"Avg G logs count: {len(avg_g_logs)}")
-    if avg_g_logs:
-        print(f"First avg G log sample: {avg_g_logs[0]}")
 
     if not session_id:
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     # セッション確認
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists or session_doc.to_dict().get('user_id') != current_user.id:
+    if not session_auth_cache.is_owner(session_id, current_user.id):
         return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
 
     try:
-        batch = db.batch()
-        avg_collection = session_ref.collection('avg_g_logs')
-        saved_count = 0
-        
-        for log in avg_g_logs:
-            ts_ms = log.get('timestamp')
-            if ts_ms:
-                ts_dt = datetime.fromtimestamp(ts_ms / 1000.0, JST)
-            else:
-                ts_dt = datetime.now(JST)
-
-            doc_ref = avg_collection.document()
-            batch.set(doc_ref, {
-                'g_x': float(log.get('g_x', 0.0)),
-                'g_y': float(log.get('g_y', 0.0)),
-                'g_z': float(log.get('g_z', 0.0)),
-                'rot_z': float(log.get('rot_z', 0.0)),
-                'speed': float(log.get('speed', 0.0)),
-                'delta_speed': float(log.get('delta_speed', 0.0)),
-                'event': log.get('event', 'normal'),
-                'quality': log.get('quality', 'unknown'),  # データ品質レベルを保存
-                'timestamp': ts_dt,
-                'timestamp_ms': ts_ms
-            })
-            saved_count += 1
-        
-        batch.commit()
-        print(f"✅ Successfully saved {saved_count} avg G logs to session {session_id}")
-        return jsonify({'status': 'ok', 'saved_count': saved_count})
+        columns, _ = samples_to_columns('avg_g_logs', avg_g_logs)
+        body, status_code, headers = _ingest(session_id, session_ref, {'avg_g_logs': columns})
+        print(f"✅ avg G logs for session {session_id}: {len(avg_g_logs)} received, {body.get('saved_count', 0)} {body['status']}")
+        return jsonify(body), status_code, headers
+    except SampleValidationError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         print(f"Error saving avg G logs: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# テレメトリ一括受信（v2: 3ストリームを1フレームで受信）
+@sessions_bp.route('/v2/ingest', methods=['POST'])
+@login_required
+def ingest_v2():
+    """
+    gzip/msgpack で圧縮された1フレーム（g_logs / avg_g_logs / gps_logs）を受け取り、
+    1回の権限確認・1回の一括書き込みで保存する。フレーム形式は telemetry_codec.py を参照。
+    """
+    raw = request.get_data(cache=False)
+    if len(raw) > MAX_INGEST_BODY_BYTES:
+        return jsonify({'status': 'error', 'message': 'Payload too large'}), 413
+
+    # クエリに session_id があれば、展開・復号の前に権限を確認する（旧クライアントはフレーム内のみ）
+    query_session_id = request.args.get('session_id')
+    if query_session_id and not session_auth_cache.is_owner(query_session_id, current_user.id):
+        return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
+
+    try:
+        frame = decode_frame(
+            raw,
+            request.content_type or '',
+            request.headers.get('Content-Encoding', '')
+        )
+    except FrameDecodeError as e:
+        print(f"❌ v2 ingest decode error: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    session_id = frame.get('session_id') or query_session_id
+    if not session_id:
+        return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
+    if query_session_id and session_id != query_session_id:
+        return jsonify({'status': 'error', 'message': 'session_id mismatch'}), 400
+
+    session_ref = db.collection('sessions').document(session_id)
+    if not query_session_id and not session_auth_cache.is_owner(session_id, current_user.id):
+        return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
+
+    # 列の復号（サンプル数に比例する処理）は権限の確認が済んでから行う
+    try:
+        decoded = {
+            stream: decode_stream_columns(stream, payload)
+            for stream, payload in frame.get('streams', {}).items()
+        }
+    except FrameDecodeError as e:
+        print(f"❌ v2 ingest decode error: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    try:
+        columns_by_stream = {stream: columns for stream, (columns, _) in decoded.items()}
+        body, status_code, headers = _ingest(session_id, session_ref, columns_by_stream)
+        body['skipped_zero_count'] = sum(skipped for _, skipped in decoded.values())
+        print(f"✅ v2 ingest for session {session_id}: {body['status']} ({len(raw)} bytes)")
+        return jsonify(body), status_code, headers
+    except Exception as e:
+        print(f"Error in v2 ingest: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# ストリームごとの保存済み連番（端末の再送・再開用）
+@sessions_bp.route('/ingest_cursor/<session_id>', methods=['GET'])
+@login_required
+def ingest_cursor(session_id):
+    """
+    端末はこの連番以下のサンプルを送り直さなくてよい。
+    Write-Behind キューに積まれただけでまだ書き込まれていない分は含まない。
+    """
+    if not session_auth_cache.is_owner(session_id, current_user.id):
+        return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
+
+    try:
+        cursor = load_ingest_cursor(db.collection('sessions').document(session_id))
+        return jsonify({'status': 'ok', 'session_id': session_id, 'cursor': cursor})
+    except Exception as e:
+        print(f"Error loading ingest cursor: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# 走行中の暫定スコア（avg_g_logs の受信ごとに更新される）
+@sessions_bp.route('/provisional_score/<session_id>', methods=['GET'])
+@login_required
+def provisional_score(session_id):
+    if not session_auth_cache.is_owner(session_id, current_user.id):
+        return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
+
+    try:
+        session_doc = db.collection('sessions').document(session_id).get()
+        session_data = session_doc.to_dict() or {}
+        return jsonify({
+            'status': 'ok',
+            'session_id': session_id,
+            'provisional_score': session_data.get('provisional_score'),
+        })
+    except Exception as e:
+        print(f"Error loading provisional score: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# 走行後解析ジョブの状態（recording_completed 画面がポーリングする）
+@sessions_bp.route('/analysis_status/<session_id>', methods=['GET'])
+@login_required
+def analysis_status(session_id):
+    if not session_auth_cache.is_owner(session_id, current_user.id):
+        return jsonify({'status': 'error', 'message': 'Permission denied or session not found'}), 403
+
+    try:
+        return jsonify({'status': 'ok', 'session_id': session_id, **analysis_runner.status(session_id)})
+    except Exception as e:
+        print(f"Error loading analysis status: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# Write-Behind キューの状態（運用監視用）
+@sessions_bp.route('/ingest_stats', methods=['GET'])
+@login_required
+def ingest_stats():
+    common = {
+        'session_cache': session_auth_cache.stats(),
+        'analysis_jobs': analysis_runner.stats(),
+        'llm_cache': llm_cache.stats() if llm_cache is not None else None,
+    }
+    if ingest_queue is None:
+        return jsonify({'write_behind': False, **common})
+    return jsonify({'write_behind': True, **common, **ingest_queue.stats()})
+
 # 反省文保存
 @sessions_bp.route('/save_reflection', methods=['POST'])
 @login_required
@@ -456,8 +631,7 @@ def save_reflection():
         return jsonify({'status': 'error', 'message': 'Missing session_id'}), 400
 
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists or session_doc.to_dict().get('user_id') != current_user.id:
+    if not session_auth_cache.is_owner(session_id, current_user.id):
         return jsonify({'status': 'error', 'message': 'Permission denied'}), 403
 
     try:
@@ -483,20 +657,18 @@ def debug_session(session_id):
             return jsonify({'error': 'Permission denied'}), 403
         
         # GPS ログを取得
-        gps_logs_ref = session_ref.collection('gps_logs')
-        gps_logs = list(gps_logs_ref.stream())
+        gps_logs = columns_to_records(load_stream_columns(session_ref, 'gps_logs'))
         
         # G ログを取得
-        g_logs_ref = session_ref.collection('g_logs')
-        g_logs = list(g_logs_ref.stream())
+        g_logs = columns_to_records(load_stream_columns(session_ref, 'g_logs'))
         
         debug_info = {
             'session_id': session_id,
             'session_data': session_data,
             'gps_logs_count': len(gps_logs),
             'g_logs_count': len(g_logs),
-            'gps_logs_sample': [doc.to_dict() for doc in gps_logs[:3]] if gps_logs else [],
-            'g_logs_sample': [doc.to_dict() for doc in g_logs[:3]] if g_logs else []
+            'gps_logs_sample': gps_logs[:3],
+            'g_logs_sample': g_logs[:3]
         }
         
         return jsonify(debug_info)
@@ -521,29 +693,25 @@ def test_gps_save(session_id):
             return jsonify({'error': 'Permission denied'}), 403
         
         # テスト用GPSデータを追加
-        gps_collection = session_ref.collection('gps_logs')
         test_gps_data = {
             'latitude': 35.681236,
             'longitude': 139.767125,
             'speed': 10.0,
-            'g_x': 0.1,
-            'g_y': 0.2,
-            'g_z': 9.8,
             'event': 'test',
-            'timestamp': datetime.now(JST),
-            'timestamp_ms': int(datetime.now().timestamp() * 1000)
+            'timestamp': int(datetime.now().timestamp() * 1000)
         }
         
-        doc_ref = gps_collection.add(test_gps_data)
-        print(f"Test GPS data added to session {session_id}: {doc_ref[1].id}")
+        columns, _ = samples_to_columns('gps_logs', [test_gps_data])
+        chunk_writer.write(session_ref, 'gps_logs', columns)
+        print(f"Test GPS data added to session {session_id}")
         
         # 現在のGPSログ数を確認
-        gps_logs = list(gps_collection.stream())
+        gps_logs_count = count_stream_samples(session_ref, 'gps_logs')
         
         return jsonify({
             'status': 'ok',
             'message': f'Test GPS data added to session {session_id}',
-            'gps_logs_count': len(gps_logs),
+            'gps_logs_count': gps_logs_count,
             'test_data': test_gps_data
         })
         
@@ -642,21 +810,22 @@ def detail_result_page(session_id):
     # GPSログ
     gps_logs = []
     event_types_found = {}
-    for gdoc in session_ref.collection('gps_logs').order_by('timestamp').stream():
-        gd = gdoc.to_dict()
-        event_value = gd.get("event", "normal")
-        
+    gps = load_stream_columns(session_ref, 'gps_logs')
+    for lat, lng, speed, event_value, ts_ms in zip(
+        gps['latitude'].tolist(), gps['longitude'].tolist(), gps['speed'].tolist(),
+        gps['event'].tolist(), gps['timestamp_ms'].tolist()
+    ):
         # イベント種類をカウント（デバッグ用）
         event_types_found[event_value] = event_types_found.get(event_value, 0) + 1
         
         gps_logs.append({
-            "latitude": float(gd.get("latitude", 0.0)),
-            "longitude": float(gd.get("longitude", 0.0)),
-            "speed": float(gd.get("speed", 0.0)),
+            "latitude": lat,
+            "longitude": lng,
+            "speed": speed,
             "event": event_value,
-            # Firestore Timestamp と 端末msを両方運ぶ（描画側は timestamp_ms を優先）
-            "timestamp": int(gd.get("timestamp").timestamp()*1000) if gd.get("timestamp") else None,
-            "timestamp_ms": gd.get("timestamp_ms"),
+            # 描画側は timestamp_ms を優先
+            "timestamp": ts_ms,
+            "timestamp_ms": ts_ms,
         })
     
     # デバッグ：イベント種類の集計結果を出力
@@ -665,18 +834,33 @@ def detail_result_page(session_id):
     print(f"📍 normal以外のイベント数: {non_normal_count}/{len(gps_logs)}")
 
     # 平滑化Gログ（avg_g_logs）
-    avg_g_logs = []
-    for adoc in session_ref.collection('avg_g_logs').order_by('timestamp').stream():
-        ad = adoc.to_dict()
-        avg_g_logs.append({
-            "g_x": float(ad.get("g_x", 0.0)),
-            "g_y": float(ad.get("g_y", 0.0)),
-            "g_z": float(ad.get("g_z", 0.0)),
-            "speed": float(ad.get("speed", 0.0)),
-            "event": ad.get("event", "normal"),
-            "timestamp": int(ad.get("timestamp").timestamp()*1000) if ad.get("timestamp") else None,
-            "timestamp_ms": ad.get("timestamp_ms"),
-        })
+    avg = load_stream_columns(session_ref, 'avg_g_logs')
+    avg_g_logs = columns_to_records({
+        name: avg[name] for name in ('g_x', 'g_y', 'g_z', 'speed', 'event', 'timestamp_ms')
+    })
+
+    # 区間ごとのスコア推移（地図の線の色分け）。解析ジョブが保存したものを使い、無ければここで計算する
+    score_timeline = None
+    try:
+        timeline_doc = session_ref.collection(TIMELINE_COLLECTION).document(TIMELINE_DOC_ID).get()
+        if timeline_doc.exists:
+            score_timeline = timeline_doc.to_dict()
+        elif len(avg['timestamp_ms']) > 0:
+            from score import calculate_score_timeline
+            score_timeline = calculate_score_timeline(avg)
+    except Exception as e:
+        print(f"⚠️ Score timeline error: {e}")
+    if score_timeline:
+        # 各GPS点が入る区間の番号（ブラウザは番号が変わるところで線を分けて色を付けるだけ）
+        columns = score_timeline['columns']
+        gps_segments = assign_segments(gps['timestamp_ms'], columns['start_ms'], columns['end_ms'])
+        for log, segment in zip(gps_logs, gps_segments.tolist()):
+            log['segment'] = segment
+        score_timeline = {
+            'mode': score_timeline.get('mode'),
+            'segment_size': score_timeline.get('segment_size'),
+            'segments': [dict(zip(columns, row)) for row in zip(*columns.values())],
+        }
 
     # 画面ヘッダ表示用（未保存値はN/Aに）
     session_view = {
@@ -701,6 +885,7 @@ def detail_result_page(session_id):
                            session=session_view,
                            gps_logs=gps_logs,
                            avg_g_logs=avg_g_logs,
+                           score_timeline=score_timeline,
                            audio_records=audio_records,
                            route_id=route_id,
                            display_error=None)
@@ -803,18 +988,10 @@ db = firestore.client()
 
 def get_avg_g_logs_for_session(session_id):
     """
-    Firestoreから指定セッションのavg_g_logsを取得する
+    Firestoreから指定セッションのavg_g_logsを取得する（timestamp_ms昇順）
     """
-    collection_ref = db.collection("sessions").document(session_id).collection("avg_g_logs")
-    docs = collection_ref.stream()
-
-    logs = []
-    for doc in docs:
-        data = doc.to_dict()
-        data["id"] = doc.id
-        logs.append(data)
-    logs.sort(key=lambda x: x.get("timestamp_ms", 0))
-    return logs
+    session_ref = db.collection("sessions").document(session_id)
+    return columns_to_records(load_stream_columns(session_ref, "avg_g_logs"))
 
 # --- セッションに route_id を保存 ---
 @sessions_bp.route('/api/set_route_to_session/<session_id>', methods=['POST'])
@@ -827,13 +1004,12 @@ def set_route_to_session(session_id):
         return jsonify({'status': 'error', 'message': 'Missing route_id'}), 400
 
     session_ref = db.collection('sessions').document(session_id)
-    session_doc = session_ref.get()
+    session_meta = session_auth_cache.lookup(session_id)
 
-    if not session_doc.exists:
+    if session_meta is None:
         return jsonify({'status': 'error', 'message': 'Session not found'}), 404
 
-    session_data = session_doc.to_dict()
-    if session_data.get('user_id') != current_user.id:
+    if session_meta[0] != current_user.id:
         return jsonify({'status': 'error', 'message': 'Permission denied'}), 403
 
     try:
@@ -6,13 +6,14 @@ Strategy/Stateパターンによる拡張可能な設計
 from abc import ABC, abstractmethod
 from typing import Optional, Dict, List, Any
 from datetime import datetime
-from math import radians, sin, cos, sqrt, atan2
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
 from firebase_admin import firestore
 from config import JST
 from models import db
 from ai_evaluation import analyze_focus_points_for_session
+from geodesy import EARTH_RADIUS_KM, haversine_km, track_distance_km
+from telemetry_store import load_stream_columns
 
 # Blueprintの作成
 sessions_bp = Blueprint('sessions', __name__)
@@ -320,50 +321,23 @@ class CompletedState(SessionState):
 
 # ===== 距離計算ヘルパー =====
 class DistanceCalculator:
-    """ハバーサイン公式による距離計算"""
+    """ハバーサイン公式による距離計算（geodesy モジュールへの委譲）"""
     
-    EARTH_RADIUS_KM = 6371.0
+    EARTH_RADIUS_KM = EARTH_RADIUS_KM
     
     @staticmethod
     def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
         """2点間の距離を計算（km）"""
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat / 2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        return DistanceCalculator.EARTH_RADIUS_KM * c
+        return float(haversine_km(lat1, lon1, lat2, lon2))
     
     @staticmethod
     def calculate_distance_from_firestore(session_id: str, db_client: firestore.Client) -> float:
-        """FirestoreからGPSログを取得して距離計算"""
-        gps_ref = db_client.collection('sessions').document(session_id).collection('gps_logs')
-        docs = gps_ref.order_by('timestamp').stream()
-        
-        coords = []
-        for d in docs:
-            data = d.to_dict()
-            lat = data.get("latitude")
-            lng = data.get("longitude")
-            
-            # 無効値排除
-            if lat is None or lng is None:
-                continue
-            if abs(lat) < 0.0001 and abs(lng) < 0.0001:
-                continue
-            
-            coords.append((lat, lng))
-        
-        if len(coords) < 2:
-            return 0.0
-        
-        total_km = 0.0
-        for i in range(1, len(coords)):
-            total_km += DistanceCalculator.haversine(
-                coords[i-1][0], coords[i-1][1],
-                coords[i][0], coords[i][1]
-            )
-        
-        return round(total_km, 3)
+        """FirestoreからGPSログを取得して距離計算（飛び・停車中のふらつきは除く）"""
+        gps = load_stream_columns(db_client.collection('sessions').document(session_id), 'gps_logs')
+        distance_km = track_distance_km(
+            gps['latitude'], gps['longitude'], gps['timestamp_ms'], gps['speed'], gps['quality']
+        )
+        return round(distance_km, 3)
 
 
 # ===== セッションマネージャー =====
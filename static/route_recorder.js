@@ -14,8 +14,20 @@ window.priorityRoute = {
   buffer: [],
   bufferFlushMs: 5000,
   lastFlush: 0,
+  pointSeq: 0,     // 記録中の点の通し番号（点IDの一部）
 };
 
+// 点のドキュメントID（時刻 + 通し番号）。バッファに入れるときに一度だけ決め、再送でも同じIDを使う
+// 同じミリ秒に2点記録しても上書きにならず、時刻順に並ぶよう時刻は桁を揃える
+function assignPointId(p) {
+  if (!p.timestamp_ms) p.timestamp_ms = Date.now();
+  if (!p.id) {
+    const seq = window.priorityRoute.pointSeq++;
+    p.id = `${String(p.timestamp_ms).padStart(13, "0")}_${String(seq).padStart(6, "0")}`;
+  }
+  return p;
+}
+
 function ensureFirebaseInitialized() {
   // recording_start.html 側で初期化済みの想定
   // ただし home.html などでも動くように保険をかける
@@ -84,11 +96,13 @@ async function savePointsBatch(routeId, points) {
   const batch = db.batch();
   const col = db.collection("priority_routes").doc(routeId).collection("points");
   points.forEach((p) => {
-    const ref = col.doc();
+    // 点に付けたIDで保存するので、失敗後の再送（unshift）でも同じ点が重複しない
+    assignPointId(p);
+    const ref = col.doc(p.id);
     batch.set(ref, {
       lat: p.lat,
       lng: p.lng,
-      timestamp_ms: p.timestamp_ms || Date.now(),
+      timestamp_ms: p.timestamp_ms,
       created_at: new Date(),
     });
   });
@@ -146,6 +160,7 @@ function startWatch(routeId) {
   }
   window.priorityRoute.buffer = [];
   window.priorityRoute.lastFlush = Date.now();
+  window.priorityRoute.pointSeq = 0;
 
   window.priorityRoute.watchId = navigator.geolocation.watchPosition(async (pos) => {
     const lat = pos.coords.latitude;
@@ -153,7 +168,7 @@ function startWatch(routeId) {
     const ts = Date.now();
 
     // バッファに溜める
-    window.priorityRoute.buffer.push({ lat, lng, timestamp_ms: ts });
+    window.priorityRoute.buffer.push(assignPointId({ lat, lng, timestamp_ms: ts }));
 
     // 一定間隔で一括保存
     const now = ts;
@@ -240,90 +240,325 @@ export async function endSession() {
 
     localStorage.removeItem('activeSessionId');
     localStorage.removeItem('sessionStartTime');
+    localStorage.removeItem(`logSeq:${sessionId}`);
 
     window.isEndingSession = false;
 }
 
-// === 定期ログフラッシュ ===
-export function startLogFlush() {
-    if (window.logFlushInterval) clearInterval(window.logFlushInterval);
-    window.logFlushInterval = setInterval(() => {
-        console.log(`Interval flush check: sessionId=${window.sessionId}, G buffer=${window.gLogBuffer.length}, AVG buffer=${window.avgGLogBuffer?.length || 0}, GPS buffer=${window.gpsLogBuffer.length}`);
+// === v2 一括送信フレーム（telemetry_codec.py と同じ形式） ===
+const V2_SCALES = {
+    latitude: 1e6, longitude: 1e6, speed: 10,
+    g_x: 1000, g_y: 1000, g_z: 1000, rot_z: 100, delta_speed: 100
+};
+const V2_STREAM_FIELDS = {
+    g_logs: ['g_x', 'g_y', 'g_z', 'speed'],
+    avg_g_logs: ['g_x', 'g_y', 'g_z', 'rot_z', 'speed', 'delta_speed'],
+    gps_logs: ['latitude', 'longitude', 'speed']
+};
 
-        if (!window.sessionId) {
-            console.log('No session ID available for log flush');
-            return;
-        }
+// ストリームごとの連番を振る（ページ遷移をまたいで続くよう localStorage に保持）
+// 再送しても同じ連番のままなので、サーバ側で上書き・重複除去される
+// イベントログは同じオブジェクトが3バッファに入るため、書き換えずにコピーに連番を付ける
+function assignSeq(stream, logs) {
+    if (!logs.some(log => log.seq === undefined)) return;
+    const key = `logSeq:${window.sessionId}`;
+    const seqs = JSON.parse(localStorage.getItem(key) || '{}');
+    let seq = seqs[stream] || 0;
+    logs.forEach((log, i) => {
+        if (log.seq === undefined) logs[i] = { ...log, seq: seq++ };
+    });
+    seqs[stream] = seq;
+    localStorage.setItem(key, JSON.stringify(seqs));
+}
 
-        // Gログ
-        if (window.gLogBuffer.length > 0) {
-            const logsToSend = window.gLogBuffer.splice(0, window.gLogBuffer.length);
-            fetch('/sessions/log_g_only', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ session_id: window.sessionId, g_logs: logsToSend })
-            });
-        }
+// 1ストリーム分を「時刻差分 + 連番差分 + 量子化整数 + 文字列辞書」に符号化
+function encodeStreamV2(stream, logs) {
+    const t0 = logs[0].timestamp || Date.now();
+    let prev = t0;
+    const dt = logs.map(log => {
+        const ts = log.timestamp || prev;
+        const d = ts - prev;
+        prev = ts;
+        return d;
+    });
 
-        // AVG-G
-        if (window.avgGLogBuffer && window.avgGLogBuffer.length > 0) {
-            const avgToSend = window.avgGLogBuffer.splice(0, window.avgGLogBuffer.length);
-            fetch('/sessions/log_avg_g_bulk', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ session_id: window.sessionId, avg_g_logs: avgToSend })
-            });
-        }
+    const s0 = logs[0].seq;
+    let prevSeq = s0;
+    const ds = logs.map(log => {
+        const d = log.seq - prevSeq;
+        prevSeq = log.seq;
+        return d;
+    });
 
-        // GPSログ
-        if (window.gpsLogBuffer.length > 0) {
-            const logsToSend = window.gpsLogBuffer.splice(0, window.gpsLogBuffer.length);
-            fetch('/sessions/log_gps_bulk', {
+    const cols = {};
+    V2_STREAM_FIELDS[stream].forEach(name => {
+        cols[name] = logs.map(log => Math.round((Number(log[name]) || 0) * V2_SCALES[name]));
+    });
+
+    const dict = {};
+    const codes = {};
+    ['event', 'quality'].forEach(name => {
+        const table = [];
+        const index = new Map();
+        codes[name] = logs.map(log => {
+            const value = log[name] || (name === 'event' ? 'normal' : 'unknown');
+            if (!index.has(value)) {
+                index.set(value, table.length);
+                table.push(value);
+            }
+            return index.get(value);
+        });
+        dict[name] = table;
+    });
+
+    return { t0, dt, s0, ds, q: V2_SCALES, cols, dict, codes };
+}
+
+async function gzipBody(text) {
+    if (typeof CompressionStream === 'undefined') return null;
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+    return await new Response(stream).arrayBuffer();
+}
+
+// === 受信側のレート制限への追従 ===
+const DEFAULT_LOG_FLUSH_MS = 60000;
+// 1リクエストの上限（サーバの MAX_SAMPLES_PER_REQUEST = 20000 / MAX_INGEST_BODY_BYTES = 4MiB より小さく）
+const MAX_SAMPLES_PER_UPLOAD = 5000;
+const MAX_UPLOAD_BYTES = 2 * 1024 * 1024;
+const UPLOAD_TOO_LARGE = 'too_large';
+
+// 推奨フラッシュ間隔（X-Recommended-Flush-Interval）を反映し、429/503 なら Retry-After まで送信を止める
+// 送信を止めるべき応答なら true を返す
+function applyBackpressure(res) {
+    const interval = Number(res.headers.get('X-Recommended-Flush-Interval'));
+    if (interval > 0) window.logFlushIntervalMs = interval * 1000;
+    if (res.status !== 429 && res.status !== 503) return false;
+    const retryAfter = Number(res.headers.get('Retry-After')) || 5;
+    window.logFlushBackoffUntil = Date.now() + retryAfter * 1000;
+    console.warn(`Log upload throttled (${res.status}), retry after ${retryAfter}s`);
+    return true;
+}
+
+// 3ストリームを1リクエストで送信
+// 再送が必要なストリーム名の配列を返す（リクエスト自体が失敗した場合は null、大きすぎる場合は UPLOAD_TOO_LARGE）
+async function sendLogsV2(buffers) {
+    const streams = {};
+    Object.entries(buffers).forEach(([stream, logs]) => {
+        if (logs.length > 0) streams[stream] = encodeStreamV2(stream, logs);
+    });
+    if (Object.keys(streams).length === 0) return [];
+
+    const json = JSON.stringify({ v: 2, session_id: window.sessionId, streams });
+    // 展開後のサイズでも上限を超えるなら送らずに分割させる
+    if (json.length > MAX_UPLOAD_BYTES) return UPLOAD_TOO_LARGE;
+    const gz = await gzipBody(json).catch(() => null);
+    const headers = { 'Content-Type': 'application/json' };
+    if (gz) headers['Content-Encoding'] = 'gzip';
+
+    try {
+        // session_id をクエリにも付け、サーバーがフレームを展開する前に権限を確認できるようにする
+        const url = `/sessions/v2/ingest?session_id=${encodeURIComponent(window.sessionId)}`;
+        const res = await fetch(url, { method: 'POST', headers, body: gz || json });
+        // 制限中は旧エンドポイントにも送らず、全ストリームを後で再送する
+        if (applyBackpressure(res)) return Object.keys(streams);
+        if (res.status === 413) return UPLOAD_TOO_LARGE;
+        if (!res.ok) return null;
+        if (res.status !== 207) return [];
+        // 一部のみ保存された場合は失敗したストリームだけ再送する
+        const body = await res.json();
+        return Object.keys(streams).filter(stream => (body.failed_counts?.[stream] || 0) > 0);
+    } catch (err) {
+        console.warn('v2 ingest failed:', err);
+        return null;
+    }
+}
+
+// 旧エンドポイント（ストリームごとのJSON POST）での送信
+// 再送が必要なストリーム名の配列を返す（大きすぎる場合は UPLOAD_TOO_LARGE）
+async function sendLogsV1(buffers) {
+    const endpoints = {
+        g_logs: '/sessions/log_g_only',
+        avg_g_logs: '/sessions/log_avg_g_bulk',
+        gps_logs: '/sessions/log_gps_bulk'
+    };
+    const failed = [];
+    let throttled = false;
+    for (const [stream, logs] of Object.entries(buffers)) {
+        if (logs.length === 0) continue;
+        if (throttled) {
+            failed.push(stream);
+            continue;
+        }
+        const body = JSON.stringify({ session_id: window.sessionId, [stream]: logs });
+        if (body.length > MAX_UPLOAD_BYTES) return UPLOAD_TOO_LARGE;
+        try {
+            const res = await fetch(endpoints[stream], {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ session_id: window.sessionId, gps_logs: logsToSend })
+                body
             });
+            throttled = applyBackpressure(res);
+            // 保存済みのストリームは分割後に再送されるが、連番で重複除去される
+            if (res.status === 413) return UPLOAD_TOO_LARGE;
+            if (!res.ok || res.status === 207) failed.push(stream);
+        } catch (err) {
+            console.warn(`v1 ${stream} upload failed:`, err);
+            failed.push(stream);
         }
-
-    }, 60000);
+    }
+    return failed;
 }
 
-// === 即時ログフラッシュ（終了時） ===
-export async function flushLogsNow() {
-    console.log("=== flushLogsNow CALLED ===");
+const LOG_BUFFER_NAMES = {
+    g_logs: 'gLogBuffer',
+    avg_g_logs: 'avgGLogBuffer',
+    gps_logs: 'gpsLogBuffer'
+};
 
-    if (!window.sessionId) {
-        console.warn("No sessionId, skip flush");
-        return;
+// 前回の送信が失敗していた場合、サーバの保存済み連番以下のサンプルを捨てる
+async function dropPersistedLogs() {
+    try {
+        const res = await fetch(`/sessions/ingest_cursor/${window.sessionId}`);
+        if (!res.ok) return;
+        const { cursor } = await res.json();
+        Object.entries(LOG_BUFFER_NAMES).forEach(([stream, name]) => {
+            if (!window[name]) return;
+            const last = cursor?.[stream] ?? -1;
+            window[name] = window[name].filter(log => log.seq === undefined || log.seq > last);
+        });
+    } catch (err) {
+        console.warn('ingest cursor check failed:', err);
     }
+}
 
-    if (window.gLogBuffer.length > 0) {
-        const logs = window.gLogBuffer.splice(0, window.gLogBuffer.length);
-        await fetch('/sessions/log_g_only', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ session_id: window.sessionId, g_logs: logs })
+// バッファを上限以下の送信単位に分ける（ストリームの順に、1単位の合計サンプル数が limit 以下）
+function sliceBuffers(buffers, limit) {
+    const slices = [];
+    const offsets = Object.fromEntries(Object.keys(buffers).map(stream => [stream, 0]));
+    const remaining = () => Object.keys(buffers).some(stream => offsets[stream] < buffers[stream].length);
+    while (remaining()) {
+        const slice = {};
+        let room = limit;
+        Object.entries(buffers).forEach(([stream, logs]) => {
+            const take = Math.min(room, logs.length - offsets[stream]);
+            slice[stream] = logs.slice(offsets[stream], offsets[stream] + take);
+            offsets[stream] += take;
+            room -= take;
         });
+        slices.push(slice);
+    }
+    return slices;
+}
+
+function sliceSize(slice) {
+    return Object.values(slice).reduce((n, logs) => n + logs.length, 0);
+}
+
+// 1単位を送信（v2 → 失敗時は旧エンドポイント）。再送が必要なストリーム名の配列か UPLOAD_TOO_LARGE を返す
+async function sendSlice(slice) {
+    let failed = await sendLogsV2(slice);
+    if (failed === null) {
+        console.warn('Falling back to v1 log endpoints');
+        failed = await sendLogsV1(slice);
+    }
+    return failed;
+}
+
+// バッファを取り出して上限以下の単位で送信し、失敗した単位だけバッファに戻す
+// 413（大きすぎる）なら同じ内容を再送せず、半分に分けて送り直す
+async function flushBuffers() {
+    const waitMs = (window.logFlushBackoffUntil || 0) - Date.now();
+    if (waitMs > 0) {
+        // 終了時の送信などで呼ばれた場合も、Retry-After までは待つ
+        await new Promise(resolve => setTimeout(resolve, waitMs));
     }
 
-    if (window.avgGLogBuffer?.length > 0) {
-        const logs = window.avgGLogBuffer.splice(0, window.avgGLogBuffer.length);
-        await fetch('/sessions/log_avg_g_bulk', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ session_id: window.sessionId, avg_g_logs: logs })
+    if (window.logResendPending) {
+        await dropPersistedLogs();
+        window.logResendPending = false;
+    }
+
+    const buffers = {};
+    Object.entries(LOG_BUFFER_NAMES).forEach(([stream, name]) => {
+        buffers[stream] = window[name] ? window[name].splice(0, window[name].length) : [];
+        assignSeq(stream, buffers[stream]);
+    });
+
+    const limit = window.logUploadSliceSize || MAX_SAMPLES_PER_UPLOAD;
+    const pending = sliceBuffers(buffers, limit);
+    const unsent = Object.fromEntries(Object.keys(buffers).map(stream => [stream, []]));
+    let stopped = false;
+    while (pending.length > 0) {
+        const slice = pending.shift();
+        let failed = stopped ? Object.keys(slice) : await sendSlice(slice);
+        if (failed === UPLOAD_TOO_LARGE) {
+            const size = sliceSize(slice);
+            if (size > 1) {
+                // 以降のフラッシュも小さい単位で送る
+                window.logUploadSliceSize = Math.max(1, Math.floor(size / 2));
+                pending.unshift(...sliceBuffers(slice, window.logUploadSliceSize));
+                continue;
+            }
+            console.warn('Log sample too large to upload, will resend:', slice);
+            failed = Object.keys(slice);
+        }
+        failed.forEach(stream => {
+            unsent[stream] = unsent[stream].concat(slice[stream] || []);
         });
+        // 制限中は残りの単位を送らずに次回へ回す
+        if (failed.length > 0 && (window.logFlushBackoffUntil || 0) > Date.now()) stopped = true;
     }
 
-    if (window.gpsLogBuffer.length > 0) {
-        const logs = window.gpsLogBuffer.splice(0, window.gpsLogBuffer.length);
-        await fetch('/sessions/log_gps_bulk', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ session_id: window.sessionId, gps_logs: logs })
+    const failedStreams = Object.keys(unsent).filter(stream => unsent[stream].length > 0);
+    if (failedStreams.length > 0) {
+        console.warn('Log upload failed, will resend:', failedStreams);
+        failedStreams.forEach(stream => {
+            const name = LOG_BUFFER_NAMES[stream];
+            // 送信中に追加されたログの前に戻す（巨大な配列を展開しないよう concat を使う）
+            window[name] = unsent[stream].concat(window[name] || []);
         });
+        window.logResendPending = true;
+    }
+}
+
+// === 定期ログフラッシュ ===
+// 間隔はサーバの推奨値（X-Recommended-Flush-Interval）に合わせて変わる
+export function startLogFlush() {
+    if (window.logFlushInterval) clearTimeout(window.logFlushInterval);
+    window.logFlushIntervalMs = window.logFlushIntervalMs || DEFAULT_LOG_FLUSH_MS;
+
+    const scheduleNext = () => {
+        window.logFlushInterval = setTimeout(tick, window.logFlushIntervalMs);
+    };
+    const tick = async () => {
+        console.log(`Interval flush check: sessionId=${window.sessionId}, G buffer=${window.gLogBuffer.length}, AVG buffer=${window.avgGLogBuffer?.length || 0}, GPS buffer=${window.gpsLogBuffer.length}`);
+
+        try {
+            if (!window.sessionId) {
+                console.log('No session ID available for log flush');
+            } else {
+                await flushBuffers();
+            }
+        } catch (err) {
+            console.error('Log flush error:', err);
+        } finally {
+            scheduleNext();
+        }
+    };
+    scheduleNext();
+}
+
+// === 即時ログフラッシュ（終了時） ===
+export async function flushLogsNow() {
+    console.log("=== flushLogsNow CALLED ===");
+
+    if (!window.sessionId) {
+        console.warn("No sessionId, skip flush");
+        return;
     }
 
+    await flushBuffers();
+
     console.log("=== flushLogsNow COMPLETED ===");
 }
 
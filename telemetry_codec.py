@@ -0,0 +1,198 @@
+# telemetry_codec.py
+"""
+テレメトリ受信フレーム（v2）のデコード機能モジュール
+1回のフラッシュで送られる3ストリーム（g_logs / avg_g_logs / gps_logs）を1フレームにまとめ、
+gzip または msgpack で圧縮・符号化したものを受け取る。
+
+フレーム形式:
+    {
+      "v": 2,
+      "session_id": "...",
+      "streams": {
+        "avg_g_logs": {
+          "t0": 1700000000000,            # 先頭サンプルの timestamp_ms
+          "dt": [0, 100, 101, ...],       # 直前サンプルとの差分（ms）
+          "s0": 120, "ds": [0, 1, 1, ...],  # 端末の連番（先頭値 + 差分、省略可）
+          "q": {"g_x": 1000, ...},        # 量子化スケール（実値 = 整数 / スケール）。省略時は既定値
+          "cols": {"g_x": [12, -3, ...], ...},
+          "dict": {"event": ["normal", "sudden_brake"]},   # 文字列列の辞書
+          "codes": {"event": [0, 0, 1, ...]}               # 辞書インデックス
+        },
+        ...
+      }
+    }
+"""
+import gzip
+import io
+import json
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from telemetry_store import SEQ_MISSING, STREAM_SCHEMAS, TEXT_DEFAULTS, normalize_columns
+
+try:
+    import msgpack
+except ImportError:  # msgpack未導入の環境では gzip + JSON のみ受け付ける
+    msgpack = None
+
+
+FRAME_VERSION = 2
+MAX_DECOMPRESSED_BYTES = 16 * 1024 * 1024   # 圧縮爆弾対策
+
+# 量子化スケールの既定値（クライアントと揃える）
+DEFAULT_SCALES: Dict[str, float] = {
+    'latitude': 1e6,      # 1e-6度 ≒ 0.1m
+    'longitude': 1e6,
+    'speed': 10.0,        # 0.1 km/h
+    'g_x': 1000.0,        # 1 mG
+    'g_y': 1000.0,
+    'g_z': 1000.0,
+    'rot_z': 100.0,
+    'delta_speed': 100.0,
+}
+
+
+class FrameDecodeError(ValueError):
+    """受信フレームが不正"""
+    pass
+
+
+# ===== 型の検証（不正な入力は FrameDecodeError にして 400 で返す） =====
+def _as_int(value: Any, label: str) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise FrameDecodeError(f"{label}: must be an integer")
+    try:
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError(value)
+        number = int(value)
+    except (ValueError, OverflowError):
+        raise FrameDecodeError(f"{label}: must be an integer")
+    if not -2 ** 63 <= number < 2 ** 63:
+        raise FrameDecodeError(f"{label}: out of range")
+    return number
+
+
+def _as_array(value: Any, dtype, label: str) -> np.ndarray:
+    if not isinstance(value, (list, tuple)):
+        raise FrameDecodeError(f"{label}: must be an array")
+    try:
+        array = np.asarray(value, dtype=dtype)
+    except (ValueError, TypeError, OverflowError):
+        raise FrameDecodeError(f"{label}: must be an array of numbers")
+    if array.ndim != 1:
+        raise FrameDecodeError(f"{label}: must be a flat array")
+    return array
+
+
+def _as_object(value: Any, label: str) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise FrameDecodeError(f"{label}: must be an object")
+    return value
+
+
+def _decompress(raw: bytes, content_encoding: str) -> bytes:
+    if (content_encoding or '').lower() == 'gzip' or raw[:2] == b'\x1f\x8b':
+        try:
+            with gzip.GzipFile(fileobj=io.BytesIO(raw)) as f:
+                data = f.read(MAX_DECOMPRESSED_BYTES + 1)
+        except (OSError, EOFError) as e:
+            raise FrameDecodeError(f"gzip decode failed: {e}")
+        if len(data) > MAX_DECOMPRESSED_BYTES:
+            raise FrameDecodeError("Decompressed frame too large")
+        return data
+    return raw
+
+
+def decode_frame(raw: bytes, content_type: str = '', content_encoding: str = '') -> Dict[str, Any]:
+    """生のリクエストボディをフレーム（dict）に復号する"""
+    if not raw:
+        raise FrameDecodeError("Empty frame")
+    body = _decompress(raw, content_encoding)
+
+    if 'msgpack' in (content_type or '').lower():
+        if msgpack is None:
+            raise FrameDecodeError("msgpack frames are not supported on this server")
+        try:
+            frame = msgpack.unpackb(body, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise FrameDecodeError(f"msgpack decode failed: {e}")
+    else:
+        try:
+            frame = json.loads(body)
+        except ValueError as e:
+            raise FrameDecodeError(f"JSON decode failed: {e}")
+
+    if not isinstance(frame, dict):
+        raise FrameDecodeError("Frame must be an object")
+    if _as_int(frame.get('v', 0), 'v') != FRAME_VERSION:
+        raise FrameDecodeError(f"Unsupported frame version: {frame.get('v')}")
+    if not isinstance(frame.get('streams', {}), dict):
+        raise FrameDecodeError("'streams' must be an object")
+    if not isinstance(frame.get('session_id', ''), str):
+        raise FrameDecodeError("'session_id' must be a string")
+    return frame
+
+
+def decode_stream_columns(stream: str, payload: Dict[str, Any]) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    1ストリーム分のペイロードを telemetry_store と同じ列形式に復号する
+
+    Returns:
+        (columns, skipped_zero_count)  検証・除外は samples_to_columns と同じ normalize_columns で行う
+    """
+    if stream not in STREAM_SCHEMAS:
+        raise FrameDecodeError(f"Unknown stream: {stream}")
+    if not isinstance(payload, dict):
+        raise FrameDecodeError(f"{stream}: must be an object")
+    schema = STREAM_SCHEMAS[stream]
+
+    dt = _as_array(payload.get('dt', []), np.int64, f"{stream}.dt")
+    n = len(dt)
+    timestamps = _as_int(payload.get('t0', 0), f"{stream}.t0") + np.cumsum(dt)
+
+    scales = dict(DEFAULT_SCALES)
+    for name, scale in _as_object(payload.get('q'), f"{stream}.q").items():
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or not np.isfinite(scale) or scale == 0:
+            raise FrameDecodeError(f"{stream}.q.{name}: must be a non-zero number")
+        scales[name] = scale
+    cols = _as_object(payload.get('cols'), f"{stream}.cols")
+
+    if 'ds' in payload:
+        seq = _as_int(payload.get('s0', 0), f"{stream}.s0") + np.cumsum(_as_array(payload['ds'], np.int64, f"{stream}.ds"))
+        if len(seq) != n:
+            raise FrameDecodeError(f"{stream}.seq: length {len(seq)} != {n}")
+    else:
+        seq = np.full(n, SEQ_MISSING, dtype=np.int64)
+
+    columns: Dict[str, np.ndarray] = {'timestamp_ms': timestamps, 'seq': seq}
+    for name in schema['numeric']:
+        values = cols.get(name)
+        if values is None:
+            columns[name] = np.zeros(n, dtype=np.float64)
+            continue
+        values = _as_array(values, np.float64, f"{stream}.{name}")
+        if len(values) != n:
+            raise FrameDecodeError(f"{stream}.{name}: length {len(values)} != {n}")
+        columns[name] = values / float(scales.get(name, 1.0))
+
+    dictionaries = _as_object(payload.get('dict'), f"{stream}.dict")
+    codes = _as_object(payload.get('codes'), f"{stream}.codes")
+    for name in schema['text']:
+        if name not in codes:
+            columns[name] = np.full(n, TEXT_DEFAULTS[name], dtype=object)
+            continue
+        words = dictionaries.get(name) or []
+        if not isinstance(words, list) or not all(isinstance(w, str) for w in words):
+            raise FrameDecodeError(f"{stream}.dict.{name}: must be an array of strings")
+        table = np.asarray(words or [TEXT_DEFAULTS[name]], dtype=object)
+        idx = _as_array(codes[name], np.int64, f"{stream}.codes.{name}")
+        if len(idx) != n:
+            raise FrameDecodeError(f"{stream}.{name}: length {len(idx)} != {n}")
+        if n and (idx.min() < 0 or idx.max() >= len(table)):
+            raise FrameDecodeError(f"{stream}.{name}: code out of range")
+        columns[name] = table[idx]
+
+    return normalize_columns(stream, columns)
@@ -0,0 +1,483 @@
+# telemetry_store.py
+"""
+走行テレメトリ保存機能モジュール
+1サンプル1ドキュメントではなく、時間区間ごとのチャンクに列指向（並列配列）で保存する。
+
+Firestore構造:
+    sessions/{id}/gps_chunks/{chunk_id}
+    sessions/{id}/g_chunks/{chunk_id}
+    sessions/{id}/avg_g_chunks/{chunk_id}
+
+各チャンクは {'stream', 'start_ms', 'end_ms', 'count', 'columns': {列名: [値, ...]}} を持つ。
+チャンクIDは内容から決まる（再送された同じバッチは上書きになる）。
+バッチの組み合わせが変わった再送による重複は、読み込み時に (timestamp_ms, seq) で取り除く。
+
+sessions/{id}.ingest_cursor.{stream} は先頭から抜けなく保存できた最大の連番（advance_cursor）。
+端末はこの連番以下のサンプルを捨ててよい。
+旧形式（sessions/{id}/gps_logs 等の1サンプル1ドキュメント）は読み込み時にフォールバックし、
+migrate_telemetry_chunks.py で一括変換できる。
+"""
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bulk_writer import FirestoreBulkWriter
+from config import JST
+
+
+# ===== ストリーム定義 =====
+# ストリーム名は旧サブコレクション名と同じにしておく（互換性のため）
+STREAM_SCHEMAS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    'gps_logs': {
+        'numeric': ('latitude', 'longitude', 'speed'),
+        'text': ('event', 'quality'),
+    },
+    'g_logs': {
+        'numeric': ('g_x', 'g_y', 'g_z', 'speed'),
+        'text': ('event', 'quality'),
+    },
+    'avg_g_logs': {
+        'numeric': ('g_x', 'g_y', 'g_z', 'rot_z', 'speed', 'delta_speed'),
+        'text': ('event', 'quality'),
+    },
+}
+
+CHUNK_COLLECTIONS: Dict[str, str] = {
+    'gps_logs': 'gps_chunks',
+    'g_logs': 'g_chunks',
+    'avg_g_logs': 'avg_g_chunks',
+}
+
+TEXT_DEFAULTS: Dict[str, str] = {
+    'event': 'normal',
+    'quality': 'unknown',
+}
+
+SCHEMA_VERSION = 1
+
+# 端末が付けるストリームごとの連番（旧クライアント・旧データは -1）
+SEQ_MISSING = -1
+
+
+def advance_cursor(cursor: int, seqs: np.ndarray) -> int:
+    """
+    保存済み連番 cursor（この連番まで途切れずに保存済み）に、新しく保存できた連番 seqs を足した値
+    cursor の次から抜けなく続く分だけ進める（抜けがあればその手前で止まる）。
+    """
+    seqs = np.unique(np.asarray(seqs, dtype=np.int64))
+    seqs = seqs[seqs > cursor]
+    contiguous = seqs == cursor + 1 + np.arange(len(seqs))
+    return int(cursor + (len(seqs) if contiguous.all() else np.argmin(contiguous)))
+
+
+def _validate_stream(stream: str) -> None:
+    if stream not in STREAM_SCHEMAS:
+        raise ValueError(f"Unknown telemetry stream: {stream}")
+
+
+def empty_columns(stream: str) -> Dict[str, np.ndarray]:
+    """空の列セットを返す"""
+    _validate_stream(stream)
+    schema = STREAM_SCHEMAS[stream]
+    columns: Dict[str, np.ndarray] = {
+        'timestamp_ms': np.empty(0, dtype=np.int64),
+        'seq': np.empty(0, dtype=np.int64),
+    }
+    for name in schema['numeric']:
+        columns[name] = np.empty(0, dtype=np.float64)
+    for name in schema['text']:
+        columns[name] = np.empty(0, dtype=object)
+    return columns
+
+
+# ===== 受信ペイロード → 列 =====
+class SampleValidationError(ValueError):
+    """受信サンプルの形式が不正"""
+    pass
+
+
+# これより小さい時刻は秒単位とみなす（ミリ秒なら1973年以前になる値）
+_SECONDS_THRESHOLD = 100_000_000_000
+
+
+def _numeric_column(samples: List[dict], name: str) -> np.ndarray:
+    """サンプル列から1フィールドを取り出して float64 配列にする（欠損は NaN）"""
+    try:
+        values = [log.get(name, np.nan) for log in samples]
+    except AttributeError:
+        raise SampleValidationError("samples must be a list of objects")
+    try:
+        # 大半のペイロードは数値のみなので、そのまま変換できる
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    # None・数値文字列が混ざる場合
+    values = np.array(values, dtype=object)
+    values[values == None] = np.nan  # noqa: E711  (要素ごとの比較)
+    try:
+        return values.astype(np.float64)
+    except (TypeError, ValueError) as e:
+        raise SampleValidationError(f"{name}: {e}")
+
+
+def samples_to_columns(stream: str, samples: List[dict]) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    端末から送られたサンプル（dictのリスト）を列に変換する
+
+    Returns:
+        (columns, skipped_zero_count)
+        検証・除外は normalize_columns と同じ規則で行う。
+    """
+    _validate_stream(stream)
+    if not isinstance(samples, list):
+        raise SampleValidationError("samples must be a list of objects")
+    schema = STREAM_SCHEMAS[stream]
+
+    # 端末から送られてきたUNIX時間。timestamp を優先し、無ければ timestamp_ms
+    ts = _numeric_column(samples, 'timestamp')
+    missing = np.isnan(ts) | (ts == 0)
+    if missing.any():
+        ts = np.where(missing, _numeric_column(samples, 'timestamp_ms'), ts)
+
+    columns: Dict[str, np.ndarray] = {'timestamp_ms': ts, 'seq': _numeric_column(samples, 'seq')}
+    for name in schema['numeric']:
+        columns[name] = _numeric_column(samples, name)
+    for name in schema['text']:
+        default = TEXT_DEFAULTS[name]
+        columns[name] = np.array([log.get(name) or default for log in samples], dtype=object)
+    return normalize_columns(stream, columns)
+
+
+def normalize_columns(stream: str, columns: Dict[str, np.ndarray]) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    受信経路（v1 JSON / v2 フレーム）共通の正規化
+
+    - timestamp_ms: 欠損・0 はサーバ時刻、秒単位の値はミリ秒に揃えて int64 にする
+    - seq: 欠損は -1
+    - 数値列: 欠損（NaN）は 0.0。ただし ±inf を含むサンプルは除外
+    - GPS: 緯度経度の欠損・範囲外は除外、(0,0) は除外して件数を返す（描画ワープ防止）
+
+    Returns:
+        (columns, skipped_zero_count)
+    """
+    schema = STREAM_SCHEMAS[stream]
+    now_ms = int(datetime.now(JST).timestamp() * 1000)
+
+    ts = np.asarray(columns['timestamp_ms'], dtype=np.float64)
+    ts = np.where(np.isfinite(ts) & (ts != 0), ts, now_ms)
+    ts = np.where(ts < _SECONDS_THRESHOLD, ts * 1000.0, ts)
+    columns['timestamp_ms'] = ts.astype(np.int64)
+
+    seq = np.asarray(columns['seq'], dtype=np.float64)
+    columns['seq'] = np.where(np.isfinite(seq), seq, SEQ_MISSING).astype(np.int64)
+
+    keep = np.ones(len(ts), dtype=bool)
+    skipped_zero_count = 0
+    if stream == 'gps_logs':
+        lat, lng = columns['latitude'], columns['longitude']
+        keep &= np.isfinite(lat) & np.isfinite(lng)
+        keep &= (np.abs(lat) <= 90.0) & (np.abs(lng) <= 180.0)
+        zero = keep & (lat == 0.0) & (lng == 0.0)
+        skipped_zero_count = int(zero.sum())
+        keep &= ~zero
+
+    for name in schema['numeric']:
+        values = columns[name]
+        keep &= ~np.isinf(values)
+        columns[name] = np.where(np.isnan(values), 0.0, values)
+
+    if not keep.all():
+        columns = {name: values[keep] for name, values in columns.items()}
+    return columns, skipped_zero_count
+
+
+# ===== チャンク書き込み =====
+class TelemetryChunkWriter:
+    """列データを時間区間ごとのチャンクドキュメントに分割して保存する"""
+
+    CHUNK_SPAN_MS = 60_000          # 1チャンクがカバーする時間幅
+    MAX_SAMPLES_PER_CHUNK = 1200    # 1MiBのドキュメント上限に対する安全側の上限
+
+    def __init__(self, db_client, bulk_writer: FirestoreBulkWriter = None,
+                 chunk_span_ms: int = CHUNK_SPAN_MS, max_samples: int = MAX_SAMPLES_PER_CHUNK,
+                 aggregator=None):
+        self._db = db_client
+        self._bulk_writer = bulk_writer or FirestoreBulkWriter(db_client)
+        self._aggregator = aggregator   # session_aggregates.SessionAggregator（省略時は集計しない）
+        self._chunk_span_ms = chunk_span_ms
+        self._max_samples = max_samples
+
+    def build_chunks(self, stream: str, columns: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+        """列データをチャンクドキュメント（dict）のリストに変換"""
+        _validate_stream(stream)
+        ts = columns['timestamp_ms']
+        if len(ts) == 0:
+            return []
+
+        # 時刻・連番順に並べ替え（端末側で順序が乱れても区間分割できるように）
+        order = np.lexsort((columns['seq'], ts))
+        sorted_columns = {name: values[order] for name, values in columns.items()}
+        ts = sorted_columns['timestamp_ms']
+
+        # 時間区間の境界 + 件数上限で分割位置を決める
+        segment = ts // self._chunk_span_ms
+        boundaries = (np.flatnonzero(np.diff(segment)) + 1).tolist()
+        starts = [0] + boundaries
+        ends = boundaries + [len(ts)]
+
+        chunks = []
+        for seg_start, seg_end in zip(starts, ends):
+            for lo in range(seg_start, seg_end, self._max_samples):
+                hi = min(lo + self._max_samples, seg_end)
+                chunks.append(self._build_chunk(stream, sorted_columns, lo, hi))
+        return chunks
+
+    def operations(self, session_ref, stream: str, columns: Dict[str, np.ndarray]) -> List[tuple]:
+        """チャンクを FirestoreBulkWriter の set 操作列に変換"""
+        collection = session_ref.collection(CHUNK_COLLECTIONS[stream])
+        return [
+            ('set', collection.document(self.chunk_id(chunk)), chunk)
+            for chunk in self.build_chunks(stream, columns)
+        ]
+
+    def write(self, session_ref, stream: str, columns: Dict[str, np.ndarray]) -> Dict[str, Any]:
+        """
+        チャンクを保存して FirestoreBulkWriter の結果を返す
+        'saved_count' には成功したバッチに含まれるサンプル数が入る。
+        """
+        result = self.write_many(session_ref, {stream: columns})
+        result['saved_count'] = result['saved_counts'][stream]
+        return result
+
+    def write_many(self, session_ref, columns_by_stream: Dict[str, Dict[str, np.ndarray]]) -> Dict[str, Any]:
+        """
+        複数ストリームのチャンクをまとめて1回の一括書き込みで保存する
+        'saved_counts' にストリームごとの保存サンプル数が入る。
+        aggregator がある場合は、保存できたチャンクの集計と保存済み連番（ingest_cursor）を
+        同じ update でセッションに書く。
+        """
+        ops = []
+        for stream, columns in columns_by_stream.items():
+            ops.extend(self.operations(session_ref, stream, columns))
+        result = self._bulk_writer.commit(ops)
+
+        op_ok = [False] * len(ops)
+        for chunk in result['chunks']:
+            for i in range(chunk['offset'], chunk['offset'] + chunk['size']):
+                op_ok[i] = chunk['ok']
+
+        saved_counts = {stream: 0 for stream in columns_by_stream}
+        for (_, _, data), ok in zip(ops, op_ok):
+            if ok:
+                saved_counts[data['stream']] += data['count']
+        result['saved_counts'] = saved_counts
+
+        if self._aggregator is not None and ops:
+            written = [data for (_, _, data), ok in zip(ops, op_ok) if ok]
+            self._aggregator.apply(session_ref, written, any_failed=not result['ok'])
+        return result
+
+    @staticmethod
+    def chunk_id(chunk: Dict[str, Any]) -> str:
+        """
+        チャンクのドキュメントID（先頭時刻で辞書順ソート可能）
+        先頭時刻・先頭連番・(timestamp_ms, seq) 列のハッシュから決めるので、同じバッチの再送は上書きになる。
+        """
+        cols = chunk['columns']
+        digest = hashlib.blake2b(digest_size=6)
+        digest.update(np.asarray(cols['timestamp_ms'], dtype=np.int64).tobytes())
+        digest.update(np.asarray(cols['seq'], dtype=np.int64).tobytes())
+        first_seq = cols['seq'][0]
+        seq_part = str(first_seq) if first_seq != SEQ_MISSING else 'n'
+        return f"{chunk['start_ms']:013d}_{seq_part}_{digest.hexdigest()}"
+
+    def _build_chunk(self, stream: str, columns: Dict[str, np.ndarray], lo: int, hi: int) -> Dict[str, Any]:
+        ts = columns['timestamp_ms'][lo:hi]
+        start_ms, end_ms = int(ts[0]), int(ts[-1])
+        return {
+            'stream': stream,
+            'schema_version': SCHEMA_VERSION,
+            'start_ms': start_ms,
+            'end_ms': end_ms,
+            'start_time': datetime.fromtimestamp(start_ms / 1000.0, JST),
+            'end_time': datetime.fromtimestamp(end_ms / 1000.0, JST),
+            'count': hi - lo,
+            'max_seq': int(columns['seq'][lo:hi].max()),
+            'columns': {name: values[lo:hi].tolist() for name, values in columns.items()},
+        }
+
+
+# ===== 読み込み =====
+def load_stream_columns(session_ref, stream: str, read_stats: Optional[Dict[str, int]] = None) -> Dict[str, np.ndarray]:
+    """
+    セッションの1ストリームを時刻順のNumPy列として読み込む
+    チャンクが存在しない場合は旧形式（1サンプル1ドキュメント）から読み込む。
+    read_stats を渡すと 'queries' と 'documents' に読み込み回数を加算する。
+    """
+    _validate_stream(stream)
+    chunk_docs = [d.to_dict() for d in session_ref.collection(CHUNK_COLLECTIONS[stream]).stream()]
+    if read_stats is not None:
+        read_stats['queries'] = read_stats.get('queries', 0) + 1
+        read_stats['documents'] = read_stats.get('documents', 0) + len(chunk_docs)
+    if chunk_docs:
+        return _columns_from_chunks(stream, chunk_docs)
+    return load_legacy_columns(session_ref, stream, read_stats)
+
+
+def load_legacy_columns(session_ref, stream: str, read_stats: Optional[Dict[str, int]] = None) -> Dict[str, np.ndarray]:
+    """旧形式のサブコレクションを列に変換して読み込む"""
+    _validate_stream(stream)
+    records = [d.to_dict() for d in session_ref.collection(stream).order_by('timestamp').stream()]
+    if read_stats is not None:
+        read_stats['queries'] = read_stats.get('queries', 0) + 1
+        read_stats['documents'] = read_stats.get('documents', 0) + len(records)
+    return _columns_from_records(stream, records)
+
+
+def count_stream_samples(session_ref, stream: str) -> int:
+    """サンプル数を数える（チャンクは count フィールドの合計）"""
+    _validate_stream(stream)
+    chunk_docs = list(session_ref.collection(CHUNK_COLLECTIONS[stream]).stream())
+    if chunk_docs:
+        return sum(int(d.to_dict().get('count', 0)) for d in chunk_docs)
+    return len(list(session_ref.collection(stream).stream()))
+
+
+def load_ingest_cursor(session_ref) -> Dict[str, int]:
+    """ストリームごとの保存済み連番（未保存は -1）"""
+    session_doc = session_ref.get()
+    cursor = (session_doc.to_dict() or {}).get('ingest_cursor', {}) if session_doc.exists else {}
+    return {stream: int(cursor.get(stream, SEQ_MISSING)) for stream in STREAM_SCHEMAS}
+
+
+def first_timestamp_ms(session_ref, stream: str) -> int:
+    """ストリームの最初のtimestamp_msを取得（チャンク1件の読み込みで済ませる）"""
+    _validate_stream(stream)
+    docs = list(
+        session_ref.collection(CHUNK_COLLECTIONS[stream]).order_by('start_ms').limit(1).stream()
+    )
+    if docs:
+        return int(docs[0].to_dict().get('start_ms', 0))
+    docs = list(session_ref.collection(stream).order_by('timestamp_ms').limit(1).stream())
+    if docs:
+        return int(docs[0].to_dict().get('timestamp_ms') or 0)
+    return 0
+
+
+def columns_to_records(columns: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    """
+    列データを従来のログ形式（dictのリスト）に戻す
+    テンプレート・JSON応答向けに 'timestamp' にもミリ秒値を入れる。
+    """
+    names = list(columns.keys())
+    lists = [columns[name].tolist() for name in names]
+    records = []
+    for row in zip(*lists):
+        record = dict(zip(names, row))
+        record['timestamp'] = record['timestamp_ms']
+        records.append(record)
+    return records
+
+
+def nearest_columns(timestamp_ms: np.ndarray, source: Dict[str, np.ndarray], names: Tuple[str, ...],
+                    tolerance_ms: float = 1000.0, default: float = 0.0) -> Dict[str, np.ndarray]:
+    """
+    各時刻に最も近い source のサンプルの列を返す（別ストリームの値を時刻で結合する）
+    source は時刻順であること。tolerance_ms 以内にサンプルが無い時刻は default。
+    """
+    ts = np.asarray(timestamp_ms, dtype=np.int64)
+    src_ts = np.asarray(source['timestamp_ms'], dtype=np.int64)
+    if len(src_ts) == 0:
+        return {name: np.full(len(ts), default, dtype=np.float64) for name in names}
+    right = np.clip(np.searchsorted(src_ts, ts), 0, len(src_ts) - 1)
+    left = np.clip(right - 1, 0, len(src_ts) - 1)
+    nearest = np.where(np.abs(src_ts[left] - ts) <= np.abs(src_ts[right] - ts), left, right)
+    found = np.abs(src_ts[nearest] - ts) <= tolerance_ms
+    return {
+        name: np.where(found, np.asarray(source[name], dtype=np.float64)[nearest], default) for name in names
+    }
+
+
+def _columns_from_chunks(stream: str, chunk_docs: List[dict]) -> Dict[str, np.ndarray]:
+    """チャンク群を連結して時刻順に並べた列を返す"""
+    schema = STREAM_SCHEMAS[stream]
+    chunk_docs = sorted(chunk_docs, key=lambda c: c.get('start_ms', 0))
+
+    columns: Dict[str, np.ndarray] = {}
+    cols_list = [c.get('columns', {}) for c in chunk_docs]
+    counts = [int(c.get('count', len(cols.get('timestamp_ms', [])))) for c, cols in zip(chunk_docs, cols_list)]
+
+    columns['timestamp_ms'] = np.concatenate(
+        [np.asarray(cols.get('timestamp_ms', []), dtype=np.int64) for cols in cols_list]
+    )
+    columns['seq'] = np.concatenate([
+        np.asarray(cols['seq'], dtype=np.int64) if 'seq' in cols else np.full(n, SEQ_MISSING, dtype=np.int64)
+        for cols, n in zip(cols_list, counts)
+    ])
+    for name in schema['numeric']:
+        columns[name] = np.concatenate([
+            np.asarray(cols[name], dtype=np.float64) if name in cols else np.zeros(n, dtype=np.float64)
+            for cols, n in zip(cols_list, counts)
+        ])
+    for name in schema['text']:
+        columns[name] = np.concatenate([
+            np.asarray(cols[name], dtype=object) if name in cols else np.full(n, TEXT_DEFAULTS[name], dtype=object)
+            for cols, n in zip(cols_list, counts)
+        ])
+
+    return _sort_and_dedupe(columns)
+
+
+def _columns_from_records(stream: str, records: List[dict]) -> Dict[str, np.ndarray]:
+    """旧形式ドキュメント（dict）のリストを列に変換"""
+    schema = STREAM_SCHEMAS[stream]
+    if not records:
+        return empty_columns(stream)
+
+    timestamps = []
+    for r in records:
+        # timestamp_msを優先して使用
+        ts_ms = r.get('timestamp_ms')
+        if not ts_ms and r.get('timestamp'):
+            ts_ms = r['timestamp'].timestamp() * 1000
+        timestamps.append(int(ts_ms or 0))
+
+    columns: Dict[str, np.ndarray] = {
+        'timestamp_ms': np.array(timestamps, dtype=np.int64),
+        'seq': np.full(len(records), SEQ_MISSING, dtype=np.int64),
+    }
+    for name in schema['numeric']:
+        columns[name] = np.array([float(r.get(name, 0.0) or 0.0) for r in records], dtype=np.float64)
+    for name in schema['text']:
+        columns[name] = np.array([r.get(name, TEXT_DEFAULTS[name]) for r in records], dtype=object)
+
+    return _sort_and_dedupe(columns)
+
+
+def _sort_and_dedupe(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    時刻・連番順に並べ、(timestamp_ms, seq) が同じ行を1つにする
+    再送で同じサンプルが複数のチャンクに入った場合の重複を取り除く
+    連番の無い行（旧クライアント・旧データ）は同じミリ秒でも別のサンプルなので、すべて残す
+    """
+    ts, seq = columns['timestamp_ms'], columns['seq']
+    order = np.lexsort((np.arange(len(ts)), seq, ts))
+    ts, seq = ts[order], seq[order]
+    keep = np.ones(len(ts), dtype=bool)
+    keep[:-1] = (ts[1:] != ts[:-1]) | (seq[1:] != seq[:-1]) | (seq[:-1] == SEQ_MISSING)
+    order = order[keep]
+    return {name: values[order] for name, values in columns.items()}
+
+
+def delete_session_telemetry(session_ref, db_client) -> int:
+    """セッションのテレメトリ（チャンク・旧形式の両方）を削除して件数を返す"""
+    ops = [
+        ('delete', doc.reference, None)
+        for stream, chunk_collection in CHUNK_COLLECTIONS.items()
+        for collection_name in (chunk_collection, stream)
+        for doc in session_ref.collection(collection_name).stream()
+    ]
+    result = FirestoreBulkWriter(db_client).commit(ops)
+    return result['written']
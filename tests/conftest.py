@@ -0,0 +1,45 @@
+# tests/conftest.py
+"""
+リポジトリ直下のモジュール（フラット構成）をテストから import できるようにする
+app_modules はアプリのモジュールを偽の Firestore クライアント（tests/fake_firestore.py）で読み込む
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="module")
+def app_modules():
+    """(偽の Firestore クライアント, {モジュール名: モジュール}) を返す"""
+    for name in ("flask", "flask_login", "firebase_admin", "google.cloud.firestore", "google.generativeai", "pytz"):
+        pytest.importorskip(name)
+    import config
+    import firebase_admin.firestore
+    import google.cloud.firestore
+    from tests.fake_firestore import FakeClient
+
+    db = FakeClient()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("INGEST_WRITE_BEHIND", "0")
+        mp.setenv("LLM_CACHE_DISABLED", "1")
+        mp.setattr(config, "init_firebase", lambda: db)
+        mp.setattr(firebase_admin.firestore, "client", lambda *a, **k: db)
+        mp.setattr(google.cloud.firestore, "Client", lambda *a, **k: db)
+        mp.setattr(firebase_admin.firestore, "transactional", lambda f: f)
+
+        modules = {}
+        for name in ("models", "session_cache", "analysis_jobs", "ai_evaluation", "score", "sessions"):
+            modules[name] = importlib.import_module(name)
+        # 既に読み込まれていた場合でも偽のクライアントを使う
+        for name in ("models", "ai_evaluation", "score", "sessions"):
+            mp.setattr(modules[name], "db", db)
+        mp.setattr(modules["session_cache"].session_auth_cache, "_db", db)
+        # ジョブはワーカースレッドを起動せず、テストから _run で実行する
+        for runner in (modules["analysis_jobs"].analysis_runner, modules["analysis_jobs"].aggregate_backfill_runner):
+            mp.setattr(runner, "_db", db)
+            mp.setattr(runner, "start", lambda: None)
+        yield db, modules
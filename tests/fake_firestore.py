@@ -0,0 +1,284 @@
+# tests/fake_firestore.py
+"""
+テスト用のメモリ上の Firestore クライアント
+アプリが使う範囲（ドキュメントの get/set/update/delete、コレクションの where/order_by/limit/stream、
+トランザクション・バッチ、Increment などの transform、update_time の前提条件）だけを実装する。
+
+queries にはコレクションID（gps_chunks など）ごとのクエリ回数を数える。
+"""
+import itertools
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1._helpers import LastUpdateOption
+
+
+_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeClient:
+    def __init__(self):
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.update_times: Dict[str, datetime] = {}
+        self.queries: Counter = Counter()
+        self._clock = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # ----- クライアントAPI -----
+    def collection(self, name: str) -> 'FakeQuery':
+        return FakeQuery(self, name)
+
+    def document(self, path: str) -> 'FakeDocumentReference':
+        return FakeDocumentReference(self, path)
+
+    def transaction(self, **_) -> 'FakeTransaction':
+        return FakeTransaction(self)
+
+    def batch(self) -> 'FakeWriteBatch':
+        return FakeWriteBatch(self)
+
+    def get_all(self, refs, **_):
+        return [ref.get() for ref in refs]
+
+    @staticmethod
+    def write_option(**kwargs):
+        return LastUpdateOption(kwargs['last_update_time'])
+
+    # ----- 内部 -----
+    def _touch(self, path: str) -> datetime:
+        self.update_times[path] = _EPOCH + timedelta(microseconds=next(self._clock))
+        return self.update_times[path]
+
+
+class FakeSnapshot:
+    def __init__(self, reference: 'FakeDocumentReference', data: Optional[Dict[str, Any]],
+                 update_time: Optional[datetime]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return _copy(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        return _get_path(self._data or {}, field)
+
+
+class FakeWriteResult:
+    def __init__(self, update_time: datetime):
+        self.update_time = update_time
+
+
+class FakeDocumentReference:
+    def __init__(self, client: FakeClient, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self) -> 'FakeQuery':
+        return FakeQuery(self._client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name: str) -> 'FakeQuery':
+        return FakeQuery(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None, **_) -> FakeSnapshot:
+        with self._client._lock:
+            return FakeSnapshot(self, self._client.docs.get(self.path), self._client.update_times.get(self.path))
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> FakeWriteResult:
+        with self._client._lock:
+            current = self._client.docs.get(self.path) if merge else None
+            document = _copy(current) if current is not None else {}
+            for key, value in data.items():
+                _set_path(document, [key], value)
+            self._client.docs[self.path] = document
+            return FakeWriteResult(self._client._touch(self.path))
+
+    def update(self, field_updates: Dict[str, Any], option=None, **_) -> FakeWriteResult:
+        with self._client._lock:
+            if self.path not in self._client.docs:
+                raise NotFound(f"No document to update: {self.path}")
+            if isinstance(option, LastUpdateOption) and option._last_update_time != self._client.update_times.get(self.path):
+                raise FailedPrecondition(f"Document was modified: {self.path}")
+            document = self._client.docs[self.path]
+            for key, value in field_updates.items():
+                _set_path(document, key.split('.'), value)
+            return FakeWriteResult(self._client._touch(self.path))
+
+    def delete(self, **_) -> None:
+        with self._client._lock:
+            self._client.docs.pop(self.path, None)
+            self._client.update_times.pop(self.path, None)
+
+
+class FakeQuery:
+    def __init__(self, client: FakeClient, path: str, filters=(), orders=(), limit=None, start_after=None):
+        self._client = client
+        self._path = path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self.id = path.rsplit('/', 1)[-1]
+
+    def _copy(self, **changes) -> 'FakeQuery':
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit, start_after=self._start_after)
+        state.update(changes)
+        return FakeQuery(self._client, self._path, **state)
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: Dict[str, Any]):
+        ref = self.document()
+        return ref.set(data).update_time, ref
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None, value: Any = None,
+              filter=None) -> 'FakeQuery':
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot) -> 'FakeQuery':
+        return self._copy(start_after=snapshot)
+
+    def stream(self, transaction=None, **_):
+        return iter(self._run())
+
+    def get(self, transaction=None, **_) -> List[FakeSnapshot]:
+        return self._run()
+
+    def _run(self) -> List[FakeSnapshot]:
+        with self._client._lock:
+            self._client.queries[self.id] += 1
+            prefix = self._path + '/'
+            snapshots = [
+                FakeSnapshot(FakeDocumentReference(self._client, path), _copy(data), self._client.update_times.get(path))
+                for path, data in sorted(self._client.docs.items())
+                if path.startswith(prefix) and '/' not in path[len(prefix):]
+            ]
+        snapshots = [s for s in snapshots if all(_matches(s, f) for f in self._filters)]
+        for field_path, direction in reversed(self._orders):
+            snapshots.sort(key=lambda s: _sort_key(s, field_path), reverse=str(direction).upper().startswith('DESC'))
+        if self._start_after is not None:
+            keys = [_sort_key(self._start_after, f) for f, _ in self._orders] or [self._start_after.id]
+            snapshots = [
+                s for s in snapshots
+                if ([_sort_key(s, f) for f, _ in self._orders] or [s.id]) > keys
+            ]
+        return snapshots[:self._limit] if self._limit is not None else snapshots
+
+
+class FakeWriteBatch:
+    """バッチ（commit 時にまとめて反映する）"""
+
+    def __init__(self, client: FakeClient):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge: bool = False):
+        self._ops.append(lambda: ref.set(data, merge=merge))
+
+    def update(self, ref, field_updates, option=None):
+        self._ops.append(lambda: ref.update(field_updates, option=option))
+
+    def delete(self, ref, **_):
+        self._ops.append(ref.delete)
+
+    def commit(self, **_):
+        ops, self._ops = self._ops, []
+        return [op() for op in ops]
+
+
+class FakeTransaction(FakeWriteBatch):
+    """トランザクション（テストでは transactional を素通しにするので、書き込みは即時に反映する）"""
+
+    def set(self, ref, data, merge: bool = False):
+        ref.set(data, merge=merge)
+
+    def update(self, ref, field_updates, option=None):
+        ref.update(field_updates, option=option)
+
+    def delete(self, ref, **_):
+        ref.delete()
+
+
+# ===== ドキュメントの値の操作 =====
+def _copy(value):
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _get_path(document: Dict[str, Any], field_path: str) -> Any:
+    value: Any = document
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _set_path(document: Dict[str, Any], parts: List[str], value: Any) -> None:
+    for part in parts[:-1]:
+        child = document.get(part)
+        if not isinstance(child, dict):
+            child = document[part] = {}
+        document = child
+    key = parts[-1]
+    current = document.get(key)
+    if value is transforms.DELETE_FIELD:
+        document.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        document[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        document[key] = (current or 0) + value.value
+    elif isinstance(value, transforms.Maximum):
+        document[key] = value.value if current is None else max(current, value.value)
+    elif isinstance(value, transforms.Minimum):
+        document[key] = value.value if current is None else min(current, value.value)
+    elif isinstance(value, dict):
+        document[key] = {}
+        for k, v in value.items():
+            _set_path(document[key], [k], v)
+    else:
+        document[key] = _copy(value)
+
+
+def _sort_key(snapshot, field_path: str):
+    if field_path == '__name__':
+        return snapshot.id
+    value = _get_path(snapshot.to_dict() or {}, field_path)
+    return (value is not None, value)
+
+
+def _matches(snapshot: FakeSnapshot, condition) -> bool:
+    field_path, op, expected = condition
+    value = snapshot.id if field_path == '__name__' else _get_path(snapshot.to_dict() or {}, field_path)
+    if op == '==':
+        return value == expected
+    if op == '!=':
+        return value != expected
+    if op == 'in':
+        return value in expected
+    if op == 'array_contains':
+        return isinstance(value, list) and expected in value
+    if value is None:
+        return False
+    return {'<': value < expected, '<=': value <= expected, '>': value > expected, '>=': value >= expected}[op]
@@ -0,0 +1,74 @@
+# tests/test_analysis_jobs.py
+"""集計導入前のセッションの集計作り直し（一覧表示ではバックグラウンドに積むだけ）"""
+import os
+
+import numpy as np
+
+SESSION_ID = "legacy1"
+USER_ID = "u1"
+
+
+def _seed_legacy_session(db):
+    """aggregates の無い完了済みセッション（解析は終わっている）"""
+    from telemetry_store import TelemetryChunkWriter
+
+    session_ref = db.collection("sessions").document(SESSION_ID)
+    session_ref.set({"user_id": USER_ID, "status": "completed", "analysis_status": "done", "distance": 1.0})
+    n = 120
+    ts = 1_700_000_000_000 + np.arange(n, dtype=np.int64) * 1000
+    columns = {
+        "timestamp_ms": ts, "seq": np.arange(n, dtype=np.int64),
+        "latitude": 35.0 + np.arange(n) * 1e-4, "longitude": np.full(n, 139.0), "speed": np.full(n, 36.0),
+        "event": np.full(n, "normal", dtype=object), "quality": np.full(n, "good", dtype=object),
+    }
+    for _, ref, chunk in TelemetryChunkWriter(db).operations(session_ref, "gps_logs", columns):
+        ref.set(chunk)
+    return session_ref
+
+
+def _app(modules):
+    from flask import Flask
+    from flask_login import LoginManager, UserMixin
+    import auth
+    import views
+
+    class User(UserMixin):
+        def __init__(self, user_id):
+            self.id = user_id
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    app = Flask(__name__, template_folder=os.path.join(root, "templates"), static_folder=os.path.join(root, "static"))
+    app.secret_key = "test"
+    LoginManager(app).user_loader(User)
+    app.register_blueprint(auth.auth_bp)
+    app.register_blueprint(views.views_bp)
+    app.register_blueprint(modules["sessions"].sessions_bp, url_prefix="/sessions")
+    return app
+
+
+def test_sessions_list_queues_backfill_instead_of_scanning(app_modules, monkeypatch):
+    db, modules = app_modules
+    import views
+    monkeypatch.setattr(views, "db", db)
+    session_ref = _seed_legacy_session(db)
+    runner = modules["analysis_jobs"].aggregate_backfill_runner
+    db.queries.clear()
+
+    client = _app(modules).test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = USER_ID
+    response = client.get("/sessions")
+    assert response.status_code == 200
+    assert "走行データを集計しています" in response.get_data(as_text=True)
+    assert db.queries["gps_chunks"] == 0
+    assert session_ref.get().to_dict()["aggregates_backfill_status"] == "queued"
+
+    runner._run(runner._queue.get_nowait())
+
+    data = session_ref.get().to_dict()
+    assert data["aggregates"]["counts"]["gps_logs"] == 120
+    assert data["aggregates"]["distance_km"] > 0
+    assert data["aggregates_backfill_status"] == "done"
+    # 解析ジョブの状態はそのまま
+    assert data["analysis_status"] == "done"
+    assert "analysis_step" not in data
@@ -0,0 +1,40 @@
+# tests/test_bulk_writer.py
+"""Firestore一括書き込み（バッチ分割・並列コミット）"""
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+import bulk_writer  # noqa: E402
+from bulk_writer import FirestoreBulkWriter  # noqa: E402
+from tests.fake_firestore import FakeClient  # noqa: E402
+
+
+def _ops(db, n, start=0):
+    return [('set', db.collection('items').document(f'doc{i:04d}'), {'value': i}) for i in range(start, start + n)]
+
+
+def test_commit_splits_and_writes_everything():
+    db = FakeClient()
+    result = FirestoreBulkWriter(db, batch_size=10, max_workers=3).commit(_ops(db, 35))
+    assert result['ok']
+    assert result['written'] == 35
+    assert [c['size'] for c in result['chunks']] == [10, 10, 10, 5]
+    assert len(db.collection('items').get()) == 35
+
+
+def test_thread_pool_is_created_once_per_writer(monkeypatch):
+    created = []
+    original = bulk_writer.ThreadPoolExecutor
+
+    def counting_executor(*args, **kwargs):
+        created.append(kwargs.get('max_workers'))
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(bulk_writer, 'ThreadPoolExecutor', counting_executor)
+    db = FakeClient()
+    writer = FirestoreBulkWriter(db, batch_size=5, max_workers=2)
+    for round_no in range(5):
+        assert writer.commit(_ops(db, 20, start=round_no * 20))['ok']
+    assert writer.commit(_ops(db, 3, start=100))['ok']    # 1バッチなら呼び出し元のスレッドでコミットする
+    assert created == [2]
+    assert len(db.collection('items').get()) == 103
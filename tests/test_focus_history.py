@@ -0,0 +1,58 @@
+# tests/test_focus_history.py
+"""重点ポイントの比較履歴（focus_history）"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+firestore = pytest.importorskip("google.cloud.firestore")
+
+from tests.fake_firestore import FakeClient  # noqa: E402
+import focus_history  # noqa: E402
+from focus_history import (  # noqa: E402
+    FOCUS_HISTORY_COLLECTION,
+    history_doc_id,
+    load_focus_history,
+    make_entry,
+    record_focus_history,
+    remove_session_history,
+)
+
+T0 = datetime(2024, 5, 1, tzinfo=timezone.utc)
+STATS = {"avg_speed": 30.0, "std_gx": 0.1}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(focus_history.firestore, "transactional", lambda f: f)
+    db = FakeClient()
+    # s0 が最も古い。s3 は未通過（比較に使えない stats）
+    for i in range(4):
+        ref = db.collection("sessions").document(f"s{i}")
+        ref.set({"user_id": "u1", "status": "completed", "end_time": T0 + timedelta(days=i)})
+        stats = STATS if i != 3 else {"avg_speed": 0, "std_gx": 0}
+        ref.collection("focus_feedbacks").document("p1").set({"stats": stats, "rating": i})
+    return db
+
+
+def test_missing_history_falls_back_to_scan(db):
+    entries = load_focus_history(db, "u1", "p1", exclude_session_id="s2", limit=3)
+    assert [e["session_id"] for e in entries] == ["s1", "s0"]
+    # 参照だけではドキュメントを作らない
+    assert not db.collection(FOCUS_HISTORY_COLLECTION).document(history_doc_id("u1", "p1")).get().exists
+
+
+def test_first_record_seeds_history_from_scan(db):
+    feedback = {"stats": STATS, "rating": 9, "created_at": T0 + timedelta(days=9)}
+    record_focus_history(db, "u1", "p1", make_entry("s9", feedback, T0 + timedelta(days=9)))
+    entries = load_focus_history(db, "u1", "p1", limit=10)
+    assert [e["session_id"] for e in entries] == ["s9", "s2", "s1", "s0"]
+
+
+def test_deleted_session_is_removed_from_history(db):
+    feedback = {"stats": STATS, "rating": 9}
+    record_focus_history(db, "u1", "p1", make_entry("s9", feedback, T0 + timedelta(days=9)))
+
+    assert remove_session_history(db, "u1", "s1", ["p1", "p-unknown"]) == 1
+    entries = load_focus_history(db, "u1", "p1", limit=10)
+    assert [e["session_id"] for e in entries] == ["s9", "s2", "s0"]
+    assert remove_session_history(db, "u1", "s1", ["p1"]) == 0
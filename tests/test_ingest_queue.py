@@ -0,0 +1,110 @@
+# tests/test_ingest_queue.py
+"""Write-Behind キューの再試行・失敗時の扱い・停止"""
+import threading
+import time
+
+import numpy as np
+
+from ingest_queue import WriteBehindQueue
+
+
+class _FakeSessionRef:
+    def __init__(self, session_id='s1'):
+        self.id = session_id
+        self.updates = []
+
+    def update(self, fields):
+        self.updates.append(fields)
+
+
+class _FlakyWriter:
+    """最初の failures 回は書き込みに失敗するチャンクライター"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def write_many(self, session_ref, columns_by_stream):
+        self.calls.append({s: len(c['timestamp_ms']) for s, c in columns_by_stream.items()})
+        if len(self.calls) <= self.failures:
+            raise RuntimeError('unavailable')
+        return {'ok': True, 'saved_counts': {s: len(c['timestamp_ms']) for s, c in columns_by_stream.items()}}
+
+
+def _columns(n):
+    return {'g_logs': {'timestamp_ms': np.arange(n, dtype=np.int64), 'seq': np.arange(n, dtype=np.int64)}}
+
+
+def _queue(writer, **kwargs):
+    kwargs.setdefault('flush_interval_s', 0.05)
+    kwargs.setdefault('backoff_base_s', 0.01)
+    return WriteBehindQueue(writer, num_workers=1, **kwargs)
+
+
+def test_failed_flush_is_retried():
+    writer = _FlakyWriter(failures=2)
+    q = _queue(writer, max_attempts=3)
+    q.start()
+    ref = _FakeSessionRef()
+    try:
+        assert q.enqueue('s1', ref, _columns(10))
+        assert q.flush_session('s1', timeout=5)
+    finally:
+        q.shutdown()
+    stats = q.stats()
+    assert len(writer.calls) == 3
+    assert stats['written_samples'] == 10
+    assert stats['failed_samples'] == 0
+    assert stats['retried_flushes'] == 2
+    assert ref.updates == []
+
+
+def test_giving_up_marks_session_dirty():
+    writer = _FlakyWriter(failures=99)
+    q = _queue(writer, max_attempts=2)
+    q.start()
+    ref = _FakeSessionRef()
+    try:
+        assert q.enqueue('s1', ref, _columns(10))
+        assert not q.flush_session('s1', timeout=5)
+    finally:
+        q.shutdown()
+    assert len(writer.calls) == 2
+    assert q.stats()['failed_samples'] == 10
+    assert ref.updates == [{'aggregates.dirty': True, 'score_state': None}]
+
+
+def test_background_retry_waits_for_backoff():
+    writer = _FlakyWriter(failures=1)
+    q = _queue(writer, max_attempts=3, backoff_base_s=0.2)
+    q.start()
+    try:
+        assert q.enqueue('s1', _FakeSessionRef(), _columns(10))
+        deadline = time.monotonic() + 5
+        while q.stats()['written_samples'] < 10 and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        q.shutdown()
+    assert q.stats()['written_samples'] == 10
+    assert len(writer.calls) == 2
+
+
+def test_shutdown_does_not_block_on_full_queue():
+    blocker = threading.Event()
+
+    class _BlockedWriter(_FlakyWriter):
+        def write_many(self, session_ref, columns_by_stream):
+            blocker.wait(5)
+            return super().write_many(session_ref, columns_by_stream)
+
+    q = _queue(_BlockedWriter(failures=0), max_queue_items=1, flush_interval_s=0.01)
+    q.start()
+    try:
+        q.enqueue('s1', _FakeSessionRef(), _columns(1))
+        time.sleep(0.1)     # ライターが書き込み中で止まっている間にキューを満杯にする
+        q.enqueue('s1', _FakeSessionRef(), _columns(1))
+        started = time.monotonic()
+        q.shutdown(timeout=0.3)
+        assert time.monotonic() - started < 2
+    finally:
+        blocker.set()
@@ -0,0 +1,107 @@
+# tests/test_jerk.py
+"""
+jerk.py を既知のジャーク・サンプリングのジッタ・途切れを含む合成データで確認する
+（固定 dt ではなく timestamp_ms の差で微分していること、途切れをまたいで微分しないこと）
+"""
+import numpy as np
+import pytest
+
+from jerk import jerk_series, segment_ids, valid_sample_mask
+
+
+JERK = 0.3      # g_z = 0.3 * t なのでジャークは常に 0.3 G/s
+
+
+def _ramp(rng, hz, seconds=60.0, jitter=0.3, gap_at_s=30.0, gap_s=5.0):
+    """一定ジャークの g_z（サンプル間隔にジッタ、途中に gap_s 秒の途切れ）"""
+    n = int(seconds * hz)
+    t = np.sort(np.arange(n) / hz + rng.uniform(-jitter, jitter, n) / hz)
+    t[t > gap_at_s] += gap_s
+    ts = np.round(1.7e12 + t * 1000)
+    t = (ts - 1.7e12) / 1000.0     # ミリ秒に丸めた時刻で値を作る
+    return ts, JERK * t, np.zeros(n)
+
+
+@pytest.mark.parametrize("hz", [5, 10, 25, 60])
+def test_raw_jerk_uses_actual_time_differences(hz):
+    rng = np.random.default_rng(hz)
+    ts, g_z, g_x = _ramp(rng, hz)
+    series = jerk_series(ts, (g_z, g_x))
+
+    assert series.segments == 2
+    assert series.gaps == 1
+    np.testing.assert_allclose(series.jerks[0], JERK, rtol=1e-6)
+    np.testing.assert_allclose(series.jerks[1], 0.0, atol=1e-12)
+    # 区間の長さの合計は途切れの分を含まない
+    expected = (ts[-1] - ts[0]) / 1000.0 - np.diff(ts).max() / 1000.0
+    assert series.duration_s == pytest.approx(expected)
+    assert series.duration_s < 60.0
+    assert len(series.timestamps_ms) == len(series.jerks[0]) == len(ts) - 2
+
+
+@pytest.mark.parametrize("hz", [5, 10, 25, 60])
+def test_resampled_jerk_is_rate_independent(hz):
+    rng = np.random.default_rng(100 + hz)
+    ts, g_z, g_x = _ramp(rng, hz)
+    series = jerk_series(ts, (g_z, g_x), resample_hz=10)
+
+    assert series.segments == 2
+    assert series.gaps == 1
+    np.testing.assert_allclose(series.jerks[0], JERK, rtol=1e-6)
+    assert len(series.timestamps_ms) == len(series.jerks[0])
+    # 10Hz の格子で約 60 秒分（途切れの間は格子点を作らない）
+    assert abs(len(series.jerks[0]) - 600) <= 5
+
+
+def test_step_across_gap_is_not_a_jerk():
+    ts = 1.7e12 + np.r_[np.arange(0, 1000, 100), np.arange(5000, 6000, 100)]
+    g_z = np.r_[np.zeros(10), np.ones(10)]      # 途切れの間だけ 1G 変化
+    for resample_hz in (None, 10):
+        series = jerk_series(ts, (g_z,), resample_hz=resample_hz)
+        assert series.gaps == 1
+        assert series.segments == 2
+        np.testing.assert_allclose(series.jerks[0], 0.0, atol=1e-12)
+
+
+def test_duplicate_and_backward_timestamps_are_dropped():
+    ts = 1.7e12 + np.array([0, 100, 100, 200, 150, 300], dtype=float)
+    g_z = np.array([0.0, 0.03, 9.0, 0.06, 9.0, 0.09])
+    assert valid_sample_mask(ts).tolist() == [True, True, False, True, False, True]
+
+    series = jerk_series(ts, (g_z,))
+    assert series.samples == 4
+    np.testing.assert_allclose(series.jerks[0], JERK)
+    np.testing.assert_array_equal(series.timestamps_ms, ts[[1, 3, 5]])
+
+
+def test_segment_ids_split_on_max_gap():
+    ts = np.array([0, 500, 1500, 1600, 2601, 2700], dtype=float)
+    assert segment_ids(ts).tolist() == [0, 0, 0, 0, 1, 1]
+    assert segment_ids(ts, max_gap_ms=500).tolist() == [0, 0, 1, 1, 2, 2]
+
+
+def test_too_few_samples():
+    series = jerk_series(np.array([1.7e12]), (np.array([0.1]),))
+    assert series.segments == 0
+    assert series.samples == 1
+    assert len(series.jerks[0]) == 0
+
+
+def test_resampled_event_counts_match_across_rates():
+    """同じ走行を 10Hz と 60Hz で記録しても、格子上で数えたイベント数はほぼ同じ"""
+    rng = np.random.default_rng(42)
+    centers = rng.uniform(5, 295, 25)
+
+    def record(hz):
+        n = int(300 * hz)
+        t = np.sort(np.arange(n) / hz + rng.uniform(-0.2, 0.2, n) / hz)
+        g_z = sum(0.4 * np.exp(-((t - c) ** 2) / 0.5) for c in centers)
+        return np.round(1.7e12 + t * 1000), g_z
+
+    counts = []
+    for hz in (10, 60):
+        ts, g_z = record(hz)
+        jerk = jerk_series(ts, (g_z,), resample_hz=10).jerks[0]
+        counts.append(int(np.count_nonzero(np.abs(jerk) > 0.3)))
+    assert counts[0] > 0
+    assert abs(counts[0] - counts[1]) <= max(2, 0.1 * counts[0])
@@ -0,0 +1,118 @@
+# tests/test_online_score.py
+"""
+online_score（受信バッチごとの逐次計算）が、全件からの jerk_series(..., resample_hz=10) と
+同じジャーク統計・区間数になることを、ランダムなバッチ分割・途切れ・重複時刻で確認する
+"""
+import numpy as np
+import pytest
+
+from jerk import jerk_series
+from online_score import (
+    JERK_THRESHOLD_G_PER_S,
+    SCORE_RATE_HZ,
+    finalize_score_state,
+    is_usable,
+    moments_std,
+    new_score_state,
+    update_score_state,
+)
+
+
+def _session(rng, hz, minutes, jitter=0.2, gaps=3, dups=0.0):
+    """ジッタ・途切れ・重複時刻を含む avg_g_logs 相当の列（時刻はアプリと同じミリ秒単位）"""
+    n = int(minutes * 60 * hz)
+    t = np.sort(np.arange(n) / hz + rng.uniform(-jitter, jitter, n) / hz)
+    for start in rng.uniform(0, t[-1], gaps):
+        t[t > start] += rng.uniform(2, 60)
+    g_z = 0.12 * np.sin(0.7 * t) + 0.05 * rng.standard_normal(n)
+    for center in rng.uniform(0, t[-1], 20):
+        g_z += 0.35 * np.exp(-((t - center) ** 2) / 0.05)
+    g_x = 0.1 * np.sin(0.25 * t) + 0.04 * rng.standard_normal(n)
+    speed = np.clip(35 + 10 * np.sin(0.01 * t) + rng.standard_normal(n), 0, None)
+    ts = np.round(1.7e12 + t * 1000)
+    if dups:
+        index = rng.choice(n, int(n * dups), replace=False)
+        ts[index] = ts[np.maximum(index - 1, 0)]
+    return ts, g_z, g_x, speed
+
+
+def _online(rng, ts, g_z, g_x, speed, batch_sizes):
+    state = new_score_state()
+    i = 0
+    while i < len(ts):
+        k = int(rng.integers(*batch_sizes))
+        update_score_state(state, ts[i:i + k], g_z[i:i + k], g_x[i:i + k], speed[i:i + k])
+        i += k
+    return state
+
+
+@pytest.mark.parametrize("seed, hz, minutes, jitter, gaps, dups, batch_sizes", [
+    (1, 10, 10, 0.2, 3, 0.0, (1, 700)),
+    (2, 10, 3, 0.2, 3, 0.0, (1, 3)),
+    (3, 60, 5, 0.45, 4, 0.0, (1, 700)),
+    (4, 25, 5, 0.2, 2, 0.05, (1, 200)),
+    (5, 5, 10, 0.2, 8, 0.0, (1, 50)),
+])
+def test_online_matches_resampled_jerk_series(seed, hz, minutes, jitter, gaps, dups, batch_sizes):
+    rng = np.random.default_rng(seed)
+    ts, g_z, g_x, speed = _session(rng, hz, minutes, jitter=jitter, gaps=gaps, dups=dups)
+    state = finalize_score_state(_online(rng, ts, g_z, g_x, speed, batch_sizes))
+    batch = jerk_series(ts, (g_z, g_x), resample_hz=SCORE_RATE_HZ)
+
+    assert is_usable(state)
+    assert state['late_samples'] == 0
+    assert state['data_points'] == len(ts)
+    assert state['segments'] == batch.segments
+    assert state['gaps'] == batch.gaps
+    assert state['duration_s'] == pytest.approx(batch.duration_s, rel=1e-9)
+
+    for channel, jerk in zip(('z', 'x'), batch.jerks):
+        moments = state['jerk'][channel]
+        abs_jerk = np.abs(jerk)
+        assert moments['n'] == len(jerk)
+        assert moments['mean'] == pytest.approx(np.mean(jerk), abs=1e-9)
+        assert moments_std(moments) == pytest.approx(np.std(jerk), rel=1e-9)
+        assert moments['sum_abs'] == pytest.approx(abs_jerk.sum(), rel=1e-9)
+        assert moments['max_abs'] == pytest.approx(abs_jerk.max(), rel=1e-9)
+        assert moments['events'] == int(np.count_nonzero(abs_jerk > JERK_THRESHOLD_G_PER_S))
+        assert moments['stable'] == int(np.count_nonzero(abs_jerk < JERK_THRESHOLD_G_PER_S * 0.5))
+
+
+def test_finalize_keeps_state_updatable():
+    rng = np.random.default_rng(6)
+    ts, g_z, g_x, speed = _session(rng, 10, 2, gaps=1)
+    half = len(ts) // 2
+    state = new_score_state()
+    update_score_state(state, ts[:half], g_z[:half], g_x[:half], speed[:half])
+    finalize_score_state(state)     # 途中で確定しても元の state はそのまま続けられる
+    update_score_state(state, ts[half:], g_z[half:], g_x[half:], speed[half:])
+
+    batch = jerk_series(ts, (g_z, g_x), resample_hz=SCORE_RATE_HZ)
+    final = finalize_score_state(state)
+    assert final['segments'] == batch.segments
+    assert final['jerk']['z']['n'] == len(batch.jerks[0])
+
+
+def test_late_batch_is_not_usable():
+    rng = np.random.default_rng(7)
+    ts, g_z, g_x, speed = _session(rng, 10, 2, gaps=0)
+    half = len(ts) // 2
+
+    state = new_score_state()
+    # 後半のバッチが先に届き、前半が後から届く（前の時刻の点は逐次計算に入れられない）
+    update_score_state(state, ts[half:], g_z[half:], g_x[half:], speed[half:])
+    update_score_state(state, ts[:half], g_z[:half], g_x[:half], speed[:half])
+    assert state['late_samples'] == half
+    assert not is_usable(state)
+    assert not is_usable(finalize_score_state(state))
+
+    in_order = new_score_state()
+    update_score_state(in_order, ts[:half], g_z[:half], g_x[:half], speed[:half])
+    update_score_state(in_order, ts[half:], g_z[half:], g_x[half:], speed[half:])
+    assert in_order['late_samples'] == 0
+    assert is_usable(in_order)
+
+
+def test_empty_state_is_not_usable():
+    assert not is_usable(None)
+    assert not is_usable(new_score_state())
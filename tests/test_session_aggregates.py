@@ -0,0 +1,83 @@
+# tests/test_session_aggregates.py
+"""受信時の集計・保存済み連番（ingest_cursor）の更新"""
+import numpy as np
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+from tests.fake_firestore import FakeClient  # noqa: E402
+from session_aggregates import SessionAggregator  # noqa: E402
+from telemetry_store import SEQ_MISSING, TelemetryChunkWriter, load_ingest_cursor  # noqa: E402
+
+T0 = 1_700_000_000_000
+
+
+def _gps_columns(seq, ts=None):
+    """1秒ごとのGPS点（時刻を省略すると連番から決める）"""
+    seq = np.asarray(seq, dtype=np.int64)
+    n = len(seq)
+    ts = T0 + seq * 1000 if ts is None else np.asarray(ts, dtype=np.int64)
+    return {
+        'timestamp_ms': ts,
+        'seq': seq,
+        'latitude': 35.0 + (ts - T0) * 1e-7,
+        'longitude': np.full(n, 139.0),
+        'speed': np.full(n, 36.0),
+        'event': np.full(n, 'normal', dtype=object),
+        'quality': np.full(n, 'good', dtype=object),
+    }
+
+
+@pytest.fixture
+def session_ref():
+    db = FakeClient()
+    ref = db.collection('sessions').document('s1')
+    ref.set({'user_id': 'u1', 'status': 'active'})
+    return ref
+
+
+def _apply(aggregator, session_ref, columns, any_failed=False):
+    chunks = TelemetryChunkWriter(session_ref._client).build_chunks('gps_logs', columns)
+    aggregator.apply(session_ref, chunks, any_failed=any_failed)
+
+
+def test_cursor_does_not_skip_a_failed_batch(session_ref):
+    aggregator = SessionAggregator()
+    _apply(aggregator, session_ref, _gps_columns(np.arange(0, 50)))
+    assert load_ingest_cursor(session_ref)['gps_logs'] == 49
+
+    # 50..99 のバッチは書き込みに失敗し、後の 100..149 だけ保存できた
+    _apply(aggregator, session_ref, _gps_columns(np.arange(100, 150)), any_failed=True)
+    assert load_ingest_cursor(session_ref)['gps_logs'] == 49
+
+    # 別のプロセス（キャッシュなし）でも、ドキュメントの cursor から続ける
+    _apply(SessionAggregator(), session_ref, _gps_columns(np.arange(50, 100)))
+    assert load_ingest_cursor(session_ref)['gps_logs'] == 99
+
+
+def test_cursor_ignores_samples_without_seq(session_ref):
+    _apply(SessionAggregator(), session_ref, _gps_columns(np.full(5, SEQ_MISSING), ts=T0 + np.arange(5) * 1000))
+    assert load_ingest_cursor(session_ref)['gps_logs'] == SEQ_MISSING
+
+
+def test_resent_batch_without_seq_marks_aggregates_dirty(session_ref):
+    aggregator = SessionAggregator()
+    columns = _gps_columns(np.full(20, SEQ_MISSING), ts=T0 + np.arange(20) * 1000)
+    _apply(aggregator, session_ref, columns)
+    aggregates = session_ref.get().to_dict()['aggregates']
+    assert not aggregates.get('dirty')
+    assert aggregates['counts']['gps_logs'] == 20
+
+    # 旧クライアントが保存済みのバッチを再送した（連番が無いので集計済みか区別できない）
+    _apply(aggregator, session_ref, columns)
+    assert session_ref.get().to_dict()['aggregates']['dirty'] is True
+
+
+def test_resent_batch_with_seq_is_not_counted_twice(session_ref):
+    aggregator = SessionAggregator()
+    columns = _gps_columns(np.arange(20))
+    _apply(aggregator, session_ref, columns)
+    _apply(SessionAggregator(), session_ref, columns)
+    aggregates = session_ref.get().to_dict()['aggregates']
+    assert not aggregates.get('dirty')
+    assert aggregates['counts']['gps_logs'] == 20
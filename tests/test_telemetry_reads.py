@@ -0,0 +1,93 @@
+# tests/test_telemetry_reads.py
+"""
+/sessions/end → 解析ジョブ（集計・注目ポイント・総合スコア）を通して、
+テレメトリをストリームごとに1回のクエリだけで読むことを確認する
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_login")
+pytest.importorskip("firebase_admin")
+pytest.importorskip("google.cloud.firestore")
+pytest.importorskip("google.generativeai")
+pytest.importorskip("pytz")
+
+SESSION_ID = "s1"
+USER_ID = "u1"
+
+
+def _seed_session(db):
+    from telemetry_store import TelemetryChunkWriter
+
+    db.collection("sessions").document(SESSION_ID).set(
+        {"user_id": USER_ID, "status": "active", "route_id": "r1"}
+    )
+    rng = np.random.default_rng(0)
+    n = 600
+    ts = 1_700_000_000_000 + np.arange(n, dtype=np.int64) * 100
+    seq = np.arange(n, dtype=np.int64)
+    text = {"event": np.full(n, "normal", dtype=object), "quality": np.full(n, "good", dtype=object)}
+    g = {name: rng.normal(0, 0.05, n) for name in ("g_x", "g_y", "g_z")}
+    speed = np.full(n, 30.0)
+    streams = {
+        "gps_logs": {"timestamp_ms": ts, "seq": seq, "latitude": 35.0 + np.arange(n) * 1e-5,
+                     "longitude": np.full(n, 139.0), "speed": speed, **text},
+        "g_logs": {"timestamp_ms": ts, "seq": seq, **g, "speed": speed, **text},
+        "avg_g_logs": {"timestamp_ms": ts, "seq": seq, **g, "rot_z": np.zeros(n), "speed": speed,
+                       "delta_speed": np.zeros(n), **text},
+    }
+    writer = TelemetryChunkWriter(db)
+    session_ref = db.collection("sessions").document(SESSION_ID)
+    for stream, columns in streams.items():
+        for _, ref, chunk in writer.operations(session_ref, stream, columns):
+            ref.set(chunk)
+
+
+def _app(sessions_module):
+    from flask import Flask
+    from flask_login import LoginManager, UserMixin
+
+    class User(UserMixin):
+        def __init__(self, user_id):
+            self.id = user_id
+
+    app = Flask(__name__)
+    app.secret_key = "test"
+    login_manager = LoginManager(app)
+    login_manager.user_loader(User)
+    app.register_blueprint(sessions_module.sessions_bp, url_prefix="/sessions")
+    return app
+
+
+def test_end_and_analysis_read_each_stream_once(app_modules):
+    db, modules = app_modules
+    _seed_session(db)
+    runner = modules["analysis_jobs"].analysis_runner
+    db.queries.clear()
+
+    client = _app(modules["sessions"]).test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = USER_ID
+    response = client.post("/sessions/end", json={"session_id": SESSION_ID})
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()["analysis_status"] == "queued"
+
+    job = runner._queue.get_nowait()
+    runner._run(job)
+
+    assert runner.status(SESSION_ID)["analysis_status"] == "done"
+    assert db.queries["gps_chunks"] == 1
+    assert db.queries["g_chunks"] == 1
+    assert db.queries["avg_g_chunks"] == 1
+
+    reads = job["telemetry"].read_stats()
+    assert reads["queries"] == 3
+    assert {stream: stats["queries"] for stream, stats in reads["streams"].items()} == {
+        "gps_logs": 1, "g_logs": 1, "avg_g_logs": 1,
+    }
+
+    session_data = db.collection("sessions").document(SESSION_ID).get().to_dict()
+    assert session_data["status"] == "completed"
+    assert session_data["distance"] > 0
+    assert "overall_score" in session_data
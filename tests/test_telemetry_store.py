@@ -0,0 +1,61 @@
+# tests/test_telemetry_store.py
+"""チャンクの保存・読み込み（再送の重複除去）"""
+import numpy as np
+import pytest
+
+pytest.importorskip("google.cloud.firestore")
+
+from tests.fake_firestore import FakeClient  # noqa: E402
+from telemetry_store import SEQ_MISSING, TelemetryChunkWriter, advance_cursor, load_stream_columns  # noqa: E402
+
+
+def _g_columns(ts, seq):
+    n = len(ts)
+    return {
+        'timestamp_ms': np.asarray(ts, dtype=np.int64),
+        'seq': np.asarray(seq, dtype=np.int64),
+        'g_x': np.arange(n, dtype=np.float64),
+        'g_y': np.zeros(n),
+        'g_z': np.zeros(n),
+        'speed': np.zeros(n),
+        'event': np.full(n, 'normal', dtype=object),
+        'quality': np.full(n, 'good', dtype=object),
+    }
+
+
+@pytest.fixture
+def session_ref():
+    db = FakeClient()
+    ref = db.collection('sessions').document('s1')
+    ref.set({'user_id': 'u1', 'status': 'active'})
+    return ref
+
+
+def test_resent_samples_with_seq_are_deduplicated(session_ref):
+    writer = TelemetryChunkWriter(session_ref._client)
+    ts = 1_700_000_000_000 + np.arange(10) * 100
+    writer.write_many(session_ref, {'g_logs': _g_columns(ts, np.arange(10))})
+    # 一部が重なる再送（チャンクの分かれ方が変わっても同じ (timestamp_ms, seq) は1行）
+    writer.write_many(session_ref, {'g_logs': _g_columns(ts[5:], np.arange(5, 10))})
+
+    columns = load_stream_columns(session_ref, 'g_logs')
+    assert columns['seq'].tolist() == list(range(10))
+
+
+def test_samples_without_seq_sharing_a_millisecond_are_kept(session_ref):
+    writer = TelemetryChunkWriter(session_ref._client)
+    # 時刻の無いバッチは受信時刻（同じ now_ms）がすべてのサンプルに入る
+    ts = np.full(5, 1_700_000_000_000)
+    writer.write_many(session_ref, {'g_logs': _g_columns(ts, np.full(5, SEQ_MISSING))})
+
+    columns = load_stream_columns(session_ref, 'g_logs')
+    assert len(columns['timestamp_ms']) == 5
+    assert sorted(columns['g_x'].tolist()) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_advance_cursor_stops_at_first_hole():
+    assert advance_cursor(SEQ_MISSING, np.arange(0, 10)) == 9
+    assert advance_cursor(SEQ_MISSING, np.arange(1, 10)) == SEQ_MISSING
+    assert advance_cursor(4, np.r_[3, 4, 5, 6, 8, 9]) == 6
+    assert advance_cursor(9, np.full(3, SEQ_MISSING)) == 9
+    assert advance_cursor(9, np.zeros(0, dtype=np.int64)) == 9
@@ -0,0 +1,61 @@
+# ttl_cache.py
+"""
+汎用 LRU + TTL キャッシュ機能モジュール
+セッション権限・集計状態・LLM応答のメモリキャッシュで共通に使う（外部依存なし）。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+# ===== 汎用 LRU + TTL キャッシュ =====
+class TTLCache:
+    """上限件数付き・有効期限付きのスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl_s: float = 300.0):
+        self._max_entries = max_entries
+        self._ttl_s = ttl_s
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """値を返す。未登録・期限切れは None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[key]
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'max_entries': self._max_entries,
+                'ttl_s': self._ttl_s,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
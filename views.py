@@ -6,10 +6,18 @@ from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import firestore as firestore_client
 from models import db
 from datetime import datetime, timezone, timedelta
+from telemetry_store import load_stream_columns, first_timestamp_ms, delete_session_telemetry, nearest_columns
+from session_cache import session_auth_cache
+from session_aggregates import summarize
+from analysis_jobs import aggregate_backfill_runner
+from focus_history import remove_session_history
 
 
 JST = timezone(timedelta(hours=9))
 
+# GPSの点にG値を結合するときに、この時間差までの g_logs のサンプルを同じ時刻とみなす
+GPS_G_JOIN_TOLERANCE_MS = 1000
+
 
 # Blueprintの作成
 views_bp = Blueprint('views', __name__)
@@ -17,31 +25,29 @@ views_bp = Blueprint('views', __name__)
 def get_gps_logs_for_session(session_id):
     """セッションのGPSログを取得"""
     try:
-        logs_ref = db.collection('sessions').document(session_id).collection('gps_logs')
-        logs = logs_ref.order_by('timestamp').stream()
+        session_ref = db.collection('sessions').document(session_id)
+        gps = load_stream_columns(session_ref, 'gps_logs')
+        # GPSチャンクにはG値を持たないので、g_logs から時刻が最も近いサンプルの値を結合する
+        g = nearest_columns(gps['timestamp_ms'], load_stream_columns(session_ref, 'g_logs'),
+                            ('g_x', 'g_y', 'g_z'), tolerance_ms=GPS_G_JOIN_TOLERANCE_MS)
         result = []
         
-        for log_doc in logs:
-            log_data = log_doc.to_dict()
-            if 'latitude' in log_data and 'longitude' in log_data:
-                # timestamp_msを優先して使用
-                timestamp_value = 0
-                if 'timestamp_ms' in log_data and log_data['timestamp_ms']:
-                    timestamp_value = log_data['timestamp_ms']
-                elif 'timestamp' in log_data and log_data['timestamp']:
-                    timestamp_value = log_data['timestamp'].timestamp() * 1000
-                
-                result.append({
-                    "timestamp": timestamp_value,
-                    "timestamp_ms": timestamp_value,  # 互換性のため
-                    "latitude": log_data.get('latitude'),
-                    "longitude": log_data.get('longitude'),
-                    "speed": log_data.get('speed', 0.0),
-                    "g_x": log_data.get('g_x', 0.0),
-                    "g_y": log_data.get('g_y', 0.0),
-                    "g_z": log_data.get('g_z', 0.0),
-                    "event": log_data.get('event', 'normal')
-                })
+        for timestamp_value, lat, lng, speed, g_x, g_y, g_z, event in zip(
+            gps['timestamp_ms'].tolist(), gps['latitude'].tolist(), gps['longitude'].tolist(),
+            gps['speed'].tolist(), g['g_x'].tolist(), g['g_y'].tolist(), g['g_z'].tolist(),
+            gps['event'].tolist()
+        ):
+            result.append({
+                "timestamp": timestamp_value,
+                "timestamp_ms": timestamp_value,  # 互換性のため
+                "latitude": lat,
+                "longitude": lng,
+                "speed": speed,
+                "g_x": g_x,
+                "g_y": g_y,
+                "g_z": g_z,
+                "event": event
+            })
         
         print(f"GPS logs for session {session_id}: {len(result)} records")
         if len(result) > 0:
@@ -55,25 +61,18 @@ def get_gps_logs_for_session(session_id):
 def get_g_logs_for_session(session_id):
     """セッションのGログを取得"""
     try:
-        logs_ref = db.collection('sessions').document(session_id).collection('g_logs')
-        logs = logs_ref.order_by('timestamp').stream()
+        g = load_stream_columns(db.collection('sessions').document(session_id), 'g_logs')
         result = []
         
-        for log_doc in logs:
-            log_data = log_doc.to_dict()
-            # timestamp_msを優先して使用
-            timestamp_value = 0
-            if 'timestamp_ms' in log_data and log_data['timestamp_ms']:
-                timestamp_value = log_data['timestamp_ms']
-            elif 'timestamp' in log_data and log_data['timestamp']:
-                timestamp_value = log_data['timestamp'].timestamp() * 1000
-            
+        for timestamp_value, g_x, g_y, g_z in zip(
+            g['timestamp_ms'].tolist(), g['g_x'].tolist(), g['g_y'].tolist(), g['g_z'].tolist()
+        ):
             result.append({
                 "timestamp": timestamp_value,
                 "timestamp_ms": timestamp_value,  # 互換性のため
-                "g_x": log_data.get('g_x', 0.0),
-                "g_y": log_data.get('g_y', 0.0),
-                "g_z": log_data.get('g_z', 0.0)
+                "g_x": g_x,
+                "g_y": g_y,
+                "g_z": g_z
             })
         
         print(f"G logs for session {session_id}: {len(result)} records")
@@ -88,27 +87,21 @@ def get_g_logs_for_session(session_id):
 def get_avg_g_logs_for_session(session_id):
     """セッションの平均Gログ(avg_g_logs)を取得"""
     try:
-        logs_ref = db.collection('sessions').document(session_id).collection('avg_g_logs')
-        logs = logs_ref.order_by('timestamp').stream()
+        avg = load_stream_columns(db.collection('sessions').document(session_id), 'avg_g_logs')
         result = []
 
-        for log_doc in logs:
-            log_data = log_doc.to_dict()
-            # timestamp_msを優先して使用
-            timestamp_value = 0
-            if 'timestamp_ms' in log_data and log_data['timestamp_ms']:
-                timestamp_value = log_data['timestamp_ms']
-            elif 'timestamp' in log_data and log_data['timestamp']:
-                timestamp_value = log_data['timestamp'].timestamp() * 1000
-
+        for timestamp_value, g_x, g_y, g_z, speed, event in zip(
+            avg['timestamp_ms'].tolist(), avg['g_x'].tolist(), avg['g_y'].tolist(),
+            avg['g_z'].tolist(), avg['speed'].tolist(), avg['event'].tolist()
+        ):
             result.append({
                 "timestamp": timestamp_value,
                 "timestamp_ms": timestamp_value,  # 互換性のため
-                "g_x": log_data.get('g_x', 0.0),
-                "g_y": log_data.get('g_y', 0.0),
-                "g_z": log_data.get('g_z', 0.0),
-                "speed": log_data.get('speed', 0.0),
-                "event": log_data.get('event', 'normal')
+                "g_x": g_x,
+                "g_y": g_y,
+                "g_z": g_z,
+                "speed": speed,
+                "event": event
             })
 
         print(f"avg_g_logs for session {session_id}: {len(result)} records")
@@ -254,10 +247,17 @@ def sessions():
         data['speed_violations'] = data.get('speed_violations', 0)
         data['status'] = data.get('status', 'unknown')
 
-        # 🔹 GPSログとGログの取得
-        data['gps_logs'] = get_gps_logs_for_session(session_doc.id)
-        data['g_logs'] = get_g_logs_for_session(session_doc.id)
-        data['avg_g_logs'] = get_avg_g_logs_for_session(session_doc.id)
+        # 🔹 件数・距離などは受信時の集計を使う（ログ本体は画面側で /api/replay_data から遅延取得）
+        aggregates = data.get('aggregates')
+        data['aggregates_pending'] = aggregates is None and data['status'] != 'active'
+        if data['aggregates_pending']:
+            # 集計導入前のセッションはバックグラウンドで作り直す（全件読み込みを表示のたびにしない）
+            try:
+                aggregate_backfill_runner.submit(session_doc.id, current_user.id)
+            except Exception as e:
+                print(f"❌ Aggregate backfill submit failed for {session_doc.id}: {e}")
+        data['aggregates'] = summarize(aggregates)
+        data['sample_counts'] = data['aggregates']['counts']
 
         # 🔹 audio_records（音声記録）を取得
         audio_records_ref = (
@@ -302,8 +302,8 @@ def sessions():
             data['end_time'] = data['end_time'].astimezone(JST)
 
 
-        print(f"Session {session_doc.id}: distance={data.get('distance')}, status={data.get('status')}")
-        print(f"GPS logs: {len(data['gps_logs'])}, G logs: {len(data['g_logs'])}, avg_G logs: {len(data['avg_g_logs'])}, Audio: {len(audio_records)}")
+        print(f"Session {session_doc.id}: distance={data.get('distance')}, status={data.get('status')}, "
+              f"samples={data['sample_counts']}, Audio: {len(audio_records)}")
 
         sessions_list.append(data)
 
@@ -336,21 +336,16 @@ def delete_session(sid):
         return redirect(url_for('sessions.results_page'))
 
     try:
-        # GPSログを削除
-        gps_logs_ref = session_ref.collection('gps_logs')
-        batch = db.batch()
-        for log_doc in gps_logs_ref.stream():
-            batch.delete(log_doc.reference)
-        
-        # Gログも削除
-        g_logs_ref = session_ref.collection('g_logs')
-        for log_doc in g_logs_ref.stream():
-            batch.delete(log_doc.reference)
-        
-        batch.commit()
+        # GPS/G/平均Gログ（チャンク・旧形式とも）を削除
+        delete_session_telemetry(session_ref, db)
+
+        # 重点ポイントの比較履歴からこの走行の記録を取り除く
+        pin_ids = [fb.id for fb in session_ref.collection('focus_feedbacks').stream()]
+        remove_session_history(db, current_user.id, sid, pin_ids)
 
         # セッション本体を削除
         session_ref.delete()
+        session_auth_cache.invalidate(sid)
         flash('セッションを削除しました')
     except Exception as e:
         flash(f'セッション削除中にエラーが発生しました: {e}')
@@ -397,17 +392,7 @@ def replay_active(session_id):
     end = request.args.get('end', type=int)
 
     # === Firestoreからセッション全体の最初のtimestamp_msを取得 ===
-    from google.cloud import firestore
-    db = firestore.Client()
-
-    logs_ref = db.collection(f"sessions/{session_id}/avg_g_logs") \
-                 .order_by("timestamp_ms") \
-                 .limit(1)
-    docs = list(logs_ref.stream())
-    if docs:
-        session_start = docs[0].to_dict().get("timestamp_ms", 0)
-    else:
-        session_start = 0
+    session_start = first_timestamp_ms(db.collection("sessions").document(session_id), "avg_g_logs")
 
     # === テンプレートに渡す ===
     return render_template(
@@ -960,7 +945,7 @@ def recording_completed_re(session_id):
 @views_bp.route('/api/focus_feedback/<session_id>', methods=['POST'])
 @login_required
 def api_focus_feedback(session_id):
-    from ai_evaluation import analyze_focus_points_for_session # analyze_focus_points_for_sessionをインポート
+    from analysis_jobs import analysis_runner
     db = firestore.client()
 
     try:
@@ -971,12 +956,17 @@ def api_focus_feedback(session_id):
             return jsonify({"error": "Session not found"}), 404
 
         user_id = session_doc.to_dict().get("user_id")
+        if user_id != current_user.id:
+            return jsonify({"error": "Permission denied"}), 403
 
-        # 🚀 ai_evaluation.py の新しい関数を呼び出し、解析と保存を一括実行
-        results = analyze_focus_points_for_session(session_id, user_id)
+        # 🚀 解析はバックグラウンドジョブで実行する
+        # 明示的な再生成の入口なので、完了済みでも積み直す（実行中なら二重には積まない）
+        # {"force": false} を送ると、完了済み・実行中のセッションはそのままの状態を返す
+        body = request.get_json(silent=True) or {}
+        force = body.get("force", True) is not False
+        analysis_status = analysis_runner.submit(session_id, user_id, force=force)
 
-        # 成功したピンの数をカウントして返す
-        return jsonify({"status": "success", "count": len(results)})
+        return jsonify({"status": "accepted", "analysis_status": analysis_status}), 202
     except Exception as e:
         print(f"❌ focus_feedback生成中エラー: {e}")
         import traceback